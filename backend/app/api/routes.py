@@ -1,21 +1,46 @@
 # backend/app/api/routes.py
-from datetime import datetime
+from datetime import datetime, timezone
 from uuid import UUID
 import secrets
-from typing import List
+from typing import List, Optional
 from fastapi import APIRouter, Depends, HTTPException, status, Response, Query
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy import select, func, update
+from sqlalchemy import select, update
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from .. import models, schemas
 from ..auth import (
+    Principal,
     authenticate_user,
-    create_access_token,
+    create_user_token,
+    forget_token_version,
     get_current_user,
-    get_password_hash,
+    get_password_hash_async,
+    revoke_user_tokens,
 )
 from ..db import get_db
+from ..cache import forget_session, get_session_meta, remember_session
+from ..bot_config import get_bot_config, refresh_bot_config
+from ..message_writer import allocate_seq, message_preview
+from ..api_keys import active_api_key, forget_api_key
+from ..passwords import PasswordHasherBusy
+from ..visitor_sessions import (
+    default_admin_owner,
+    find_open_session,
+    owner_by_id,
+    upsert_open_session,
+)
+from ..inbox import INBOX_PAGE_DEFAULT, INBOX_PAGE_MAX, InboxFilters, fetch_inbox_page
+from ..socket import _emit_message, _message_payload, emit_session_changed
+from ..history import (
+    MESSAGE_PAGE_DEFAULT,
+    MESSAGE_PAGE_MAX,
+    SYNC_MAX,
+    fetch_message_page,
+    mark_read,
+    serialize_message,
+    sync_messages,
+)
 
 router = APIRouter(prefix="/api")
 
@@ -26,7 +51,7 @@ router = APIRouter(prefix="/api")
 @router.get("/embed-key")
 async def get_or_create_embed_key(
     db: AsyncSession = Depends(get_db),
-    current_user: models.User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_user),
 ):
     result = await db.execute(
         select(models.ApiKey).where(
@@ -67,6 +92,16 @@ async def register(payload: schemas.RegisterRequest, db: AsyncSession = Depends(
     }
     """
 
+    # DB の接続を握る前に計算しておく（bcrypt はスレッドプールで実行）
+    try:
+        password_hash = await get_password_hash_async(payload.password)
+    except PasswordHasherBusy:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="登録が混み合っています。しばらくしてから再度お試しください",
+            headers={"Retry-After": "1"},
+        )
+
     result_user = await db.execute(
         select(models.User).where(models.User.email == payload.email)
     )
@@ -97,7 +132,7 @@ async def register(payload: schemas.RegisterRequest, db: AsyncSession = Depends(
 
     user = models.User(
         email=payload.email,
-        password_hash=get_password_hash(payload.password),
+        password_hash=password_hash,
         display_name=payload.display_name,
         role=models.UserRole.ADMIN,
         company_id=company.id,
@@ -106,7 +141,7 @@ async def register(payload: schemas.RegisterRequest, db: AsyncSession = Depends(
     await db.commit()
     await db.refresh(user)
 
-    token = create_access_token({"sub": user.email})
+    token = create_user_token(user)
     return schemas.LoginResponse(
         access_token=token,
         user=schemas.UserOut.model_validate(user),
@@ -119,15 +154,22 @@ async def register(payload: schemas.RegisterRequest, db: AsyncSession = Depends(
 # -----------------------------
 @router.post("/auth/login", response_model=schemas.LoginResponse)
 async def login(payload: schemas.LoginRequest, db: AsyncSession = Depends(get_db)):
-    # ユーザー認証
-    user = await authenticate_user(payload.email, payload.password, db)
+    # ユーザー認証（bcrypt はスレッドプールで計算。混雑時は 503 で再試行してもらう）
+    try:
+        user = await authenticate_user(payload.email, payload.password, db)
+    except PasswordHasherBusy:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="ログインが混み合っています。しばらくしてから再度お試しください",
+            headers={"Retry-After": "1"},
+        )
     if not user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Invalid email or password",
         )
 
-    token = create_access_token({"sub": user.email})
+    token = create_user_token(user)
 
     return schemas.LoginResponse(
         access_token=token,
@@ -140,8 +182,32 @@ async def login(payload: schemas.LoginRequest, db: AsyncSession = Depends(get_db
 # GET /api/auth/me
 # -----------------------------
 @router.get("/auth/me", response_model=schemas.UserOut)
-async def get_me(current_user: models.User = Depends(get_current_user)):
-    return schemas.UserOut.model_validate(current_user)
+async def get_me(
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(get_current_user),
+):
+    result = await db.execute(
+        select(models.User).where(models.User.id == current_user.id)
+    )
+    user = result.scalars().first()
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    return schemas.UserOut.model_validate(user)
+
+
+# -----------------------------
+# 認証: 発行済みトークンをすべて無効化（全端末からログアウト）
+# POST /api/auth/logout-all
+# -----------------------------
+@router.post("/auth/logout-all")
+async def logout_all(
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(get_current_user),
+):
+    await revoke_user_tokens(db, current_user.id)
+    await db.commit()
+    await forget_token_version(current_user.id)
+    return {"ok": True}
 
 # -----------------------------
 # 自分の所属会社情報取得
@@ -150,7 +216,7 @@ async def get_me(current_user: models.User = Depends(get_current_user)):
 @router.get("/company/me")
 async def get_my_company(
     db: AsyncSession = Depends(get_db),
-    current_user: models.User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_user),
 ):
     if not current_user.company_id:
         raise HTTPException(status_code=404, detail="Company not found")
@@ -197,33 +263,19 @@ async def create_or_get_session(
             detail="visitor_identifier は必須です",
         )
 
-    # --- owner を決めるロジック ---
-    owner = None
-
+    # --- owner の解決とセッションの取得/作成を 1 文で行う ---
     if api_key:
-        result_api = await db.execute(
-            select(models.ApiKey).where(
-                models.ApiKey.key == api_key,
-                models.ApiKey.is_active.is_(True),
-            )
-        )
-        api_obj = result_api.scalars().first()
-        if not api_obj:
+        key = await active_api_key(db, api_key)
+        if not key:
             raise HTTPException(
                 status_code=400,
                 detail="api_key が不正か無効です",
             )
-
-        result_user = await db.execute(
-            select(models.User).where(models.User.id == api_obj.user_id)
+        owner_query = owner_by_id(key.user_id)
+        not_found = HTTPException(
+            status_code=400,
+            detail="api_key に紐づくユーザーが存在しません",
         )
-        owner = result_user.scalars().first()
-        if not owner:
-            raise HTTPException(
-                status_code=400,
-                detail="api_key に紐づくユーザーが存在しません",
-            )
-
     else:
         if owner_id is None:
             raise HTTPException(
@@ -236,100 +288,98 @@ async def create_or_get_session(
         except ValueError:
             raise HTTPException(status_code=400, detail="owner_id が不正です")
 
-        result_user = await db.execute(
-            select(models.User).where(models.User.id == owner_id_int)
-        )
-        owner = result_user.scalars().first()
-        if not owner:
-            raise HTTPException(status_code=404, detail="owner user not found")
-
-    result_session = await db.execute(
-        select(models.Session).where(
-            models.Session.visitor_identifier == visitor_identifier,
-            models.Session.owner_user_id == owner.id,
-            models.Session.status == models.SessionStatus.OPEN,
-        )
-    )
-    session = result_session.scalars().first()
+        owner_query = owner_by_id(owner_id_int)
+        not_found = HTTPException(status_code=404, detail="owner user not found")
 
-    now = datetime.utcnow()
-
-    if not session:
-        session = models.Session(
-            visitor_identifier=visitor_identifier,
-            visitor_name=visitor_name,
-            status=models.SessionStatus.OPEN,
-            created_at=now,
-            last_active_at=now,
-            owner_user_id=owner.id,
-            company_id=owner.company_id,
-        )
-        db.add(session)
-        await db.commit()
-        await db.refresh(session)
-    else:
-        session.last_active_at = now
-        if visitor_name and not session.visitor_name:
-            session.visitor_name = visitor_name
-        await db.commit()
-        await db.refresh(session)
+    session = await upsert_open_session(db, owner_query, visitor_identifier, visitor_name)
+    if session is None:
+        raise not_found
+    await db.commit()
 
+    remember_session(session)
     return {"id": str(session.id)}
 
 
 # -----------------------------
 # 管理画面: ログイン中ユーザーのセッション一覧
 # GET /api/sessions
+# 絞り込み（すべて任意）:
+#   status=OPEN|CLOSED, handoff=true|false（既定 true）, has_unread=true|false,
+#   since / until（last_active_at の範囲 [since, until)）, name=訪問者名の前方一致
+# 並び順: order=desc|asc（last_active_at, id）
+# ページング: limit と、前のレスポンスの next_cursor を cursor に渡す
+# 返り値: {"items": [...], "next_cursor": "..." | null}
 # -----------------------------
 @router.get("/sessions")
 async def list_sessions(
+    status: Optional[models.SessionStatus] = Query(None),
+    handoff: bool = Query(True),
+    has_unread: Optional[bool] = Query(None),
+    since: Optional[datetime] = Query(None),
+    until: Optional[datetime] = Query(None),
+    name: Optional[str] = Query(None, max_length=255),
+    order: str = Query("desc", pattern="^(asc|desc)$"),
+    cursor: Optional[str] = Query(None),
+    limit: int = Query(INBOX_PAGE_DEFAULT, ge=1, le=INBOX_PAGE_MAX),
     db: AsyncSession = Depends(get_db),
-    current_user: models.User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_user),
 ):
-    stmt = (
-        select(models.Session)
-        .join(models.Message, models.Session.id == models.Message.session_id)
-        .where(
-            models.Session.owner_user_id == current_user.id,
-            models.Session.company_id == current_user.company_id,
-            models.Session.handoff_requested.is_(True),
-        )
-        .distinct()
-        .order_by(models.Session.last_active_at.desc())
+    filters = InboxFilters(
+        status=status,
+        handoff=handoff,
+        has_unread=has_unread,
+        since=_naive_utc(since),
+        until=_naive_utc(until),
+        name_prefix=(name or "").strip() or None,
     )
-    result = await db.execute(stmt)
-    sessions = result.scalars().all()
-
-    session_ids = [s.id for s in sessions]
-    if session_ids:
-        unread_stmt = (
-            select(
-                models.Message.session_id,
-                func.count(models.Message.id).label("cnt"),
-            )
-            .where(
-                models.Message.session_id.in_(session_ids),
-                models.Message.sender_type == models.SenderType.VISITOR,
-                models.Message.is_read.is_(False),
-            )
-            .group_by(models.Message.session_id)
+    try:
+        return await fetch_inbox_page(
+            db,
+            current_user.id,
+            current_user.company_id,
+            filters,
+            cursor=cursor,
+            limit=limit,
+            ascending=order == "asc",
         )
-        unread_result = await db.execute(unread_stmt)
-        unread_map = {row.session_id: row.cnt for row in unread_result}
-    else:
-        unread_map = {}
+    except ValueError:
+        raise HTTPException(status_code=400, detail="cursor が不正です")
 
-    return [
-        {
-            "id": str(s.id),
-            "visitor_name": s.visitor_name,
-            "visitor_identifier": s.visitor_identifier,
-            "status": s.status.value if hasattr(s.status, "value") else str(s.status),
-            "last_active_at": s.last_active_at.isoformat() if s.last_active_at else None,
-            "unread_count": int(unread_map.get(s.id, 0)),
-        }
-        for s in sessions
-    ]
+
+def _naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """DB の時刻はタイムゾーンなしの UTC"""
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+# -----------------------------
+# 管理画面: 起動時の情報をまとめて取得
+# GET /api/dashboard/bootstrap
+# 以降の一覧の変化は socket の session_upserted / session_removed で届く
+# -----------------------------
+@router.get("/dashboard/bootstrap")
+async def dashboard_bootstrap(
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(get_current_user),
+):
+    row = (
+        await db.execute(
+            select(models.User, models.Company)
+            .outerjoin(models.Company, models.Company.id == models.User.company_id)
+            .where(models.User.id == current_user.id)
+        )
+    ).first()
+    if row is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    user, company = row
+
+    return {
+        "user": schemas.UserOut.model_validate(user).model_dump(mode="json"),
+        "company": {"id": company.id, "name": company.name} if company else None,
+        # 一覧の 1 ページ目（続きは GET /api/sessions?cursor=...）
+        "sessions": await fetch_inbox_page(db, current_user.id, current_user.company_id),
+    }
 
 
 # -----------------------------
@@ -339,8 +389,13 @@ async def list_sessions(
 @router.get("/sessions/{session_id}/messages")
 async def get_messages(
     session_id: str,
+    before_id: Optional[int] = Query(None),
+    after_id: Optional[int] = Query(None),
+    before_seq: Optional[int] = Query(None),
+    after_seq: Optional[int] = Query(None),
+    limit: int = Query(MESSAGE_PAGE_DEFAULT, ge=1, le=MESSAGE_PAGE_MAX),
     db: AsyncSession = Depends(get_db),
-    current_user: models.User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_user),
 ):
     try:
         session_uuid = UUID(session_id)
@@ -359,38 +414,66 @@ async def get_messages(
     ):
         raise HTTPException(status_code=404, detail="Session not found")
 
-    result_msg = await db.execute(
-        select(models.Message)
-        .where(models.Message.session_id == session.id)
-        .order_by(models.Message.created_at.asc())
+    return await fetch_message_page(
+        db,
+        session.id,
+        before_id,
+        after_id,
+        limit,
+        before_seq=before_seq,
+        after_seq=after_seq,
     )
-    messages = result_msg.scalars().all()
 
-    await db.execute(
-        models.Message.__table__.update()
-        .where(
-            models.Message.session_id == session.id,
-            models.Message.sender_type == models.SenderType.VISITOR,
-            models.Message.is_read.is_(False),
-        )
-        .values(is_read=True, read_at=datetime.utcnow())
-    )
+
+# -----------------------------
+# 管理画面: 既読にする（既読位置を進めるだけ）
+# POST /api/sessions/{session_id}/read
+# body: {"seq": 12}   // 任意。省略時は最新まで
+# -----------------------------
+@router.post("/sessions/{session_id}/read")
+async def mark_session_read(
+    session_id: UUID,
+    payload: Optional[dict] = None,
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(get_current_user),
+):
+    session = await get_session_meta(db, session_id)
+    if (
+        not session
+        or session.owner_user_id != current_user.id
+        or session.company_id != current_user.company_id
+    ):
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    seq = (payload or {}).get("seq")
+    read = await mark_read(db, session_id, current_user.id, seq)
     await db.commit()
+    return read
 
-    return [
-        {
-            "id": m.id,
-            "session_id": str(m.session_id),
-            "sender_type": m.sender_type.value
-            if hasattr(m.sender_type, "value")
-            else str(m.sender_type),
-            "sender_id": m.sender_id,
-            "content": m.content,
-            "attachment_url": m.attachment_url,
-            "created_at": m.created_at.isoformat(),
-        }
-        for m in messages
-    ]
+
+# -----------------------------
+# 管理画面: 差分同期（after_seq より後のメッセージのみ）
+# GET /api/sessions/{session_id}/sync?after_seq=...
+# -----------------------------
+@router.get("/sessions/{session_id}/sync")
+async def sync_session_messages(
+    session_id: UUID,
+    after_seq: int = Query(0),
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(get_current_user),
+):
+    result = await db.execute(
+        select(models.Session).where(models.Session.id == session_id)
+    )
+    session = result.scalars().first()
+    if (
+        not session
+        or session.owner_user_id != current_user.id
+        or session.company_id != current_user.company_id
+    ):
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    return await sync_messages(db, session.id, after_seq, SYNC_MAX)
 
 
 # -----------------------------
@@ -402,7 +485,7 @@ async def post_message(
     session_id: str,
     payload: schemas.MessageCreate,
     db: AsyncSession = Depends(get_db),
-    current_user: models.User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_user),
 ):
     try:
         session_uuid = UUID(session_id)
@@ -428,8 +511,14 @@ async def post_message(
     except ValueError:
         raise HTTPException(status_code=400, detail="sender_type が不正です")
 
+    allocation = await allocate_seq(
+        db, session.id, visitor=sender_type_enum == models.SenderType.VISITOR
+    )
+
     msg = models.Message(
         session_id=session.id,
+        seq=allocation.seq,
+        visitor_count=allocation.visitor_count,
         sender_type=sender_type_enum,
         sender_id=current_user.id if sender_type_enum == models.SenderType.OPERATOR else None,
         content=payload.content,
@@ -437,20 +526,23 @@ async def post_message(
         created_at=now,
     )
     session.last_active_at = now
+    session.last_message_at = now
+    session.last_message_preview = message_preview(payload.content, payload.attachment_url)
+    session.message_count = models.Session.message_count + 1
 
     db.add(msg)
     await db.commit()
     await db.refresh(msg)
 
-    return {
-        "id": msg.id,
-        "session_id": str(msg.session_id),
-        "sender_type": msg.sender_type.value,
-        "sender_id": msg.sender_id,
-        "content": msg.content,
-        "attachment_url": msg.attachment_url,
-        "created_at": msg.created_at.isoformat(),
-    }
+    # ソケットから送ったときと同じく、訪問者とオペレーターへ配信し、受信箱の行を更新する
+    try:
+        row = {c.name: getattr(msg, c.name) for c in models.Message.__table__.columns}
+        await _emit_message(session, _message_payload(row, sender_type_enum.value.lower()))
+    except Exception as e:
+        print("[messages] emit failed:", e)
+    await emit_session_changed(session.id)
+
+    return serialize_message(msg)
 
 
 # =============================
@@ -483,8 +575,7 @@ async def widget_create_or_get_session(
             detail="visitor_identifier は必須です",
         )
 
-    # --- owner を決める ---
-    owner = None
+    # --- owner の解決とセッションの取得/作成を 1 文で行う ---
     if owner_id_raw is not None:
         try:
             owner_id_int = int(owner_id_raw)
@@ -494,57 +585,24 @@ async def widget_create_or_get_session(
                 detail="owner_id が不正です",
             )
 
-        result_user = await db.execute(
-            select(models.User).where(models.User.id == owner_id_int)
+        owner_query = owner_by_id(owner_id_int)
+        not_found = HTTPException(
+            status_code=404,
+            detail="指定された owner ユーザーが存在しません",
         )
-        owner = result_user.scalars().first()
-        if not owner:
-            raise HTTPException(
-                status_code=404,
-                detail="指定された owner ユーザーが存在しません",
-            )
     else:
-        result_user = await db.execute(
-            select(models.User).where(models.User.role == models.UserRole.ADMIN)
-        )
-        owner = result_user.scalars().first()
-        if not owner:
-            raise HTTPException(
-                status_code=500,
-                detail="ADMIN ユーザーが存在しません",
-            )
-
-    result_session = await db.execute(
-        select(models.Session).where(
-            models.Session.visitor_identifier == visitor_identifier,
-            models.Session.owner_user_id == owner.id,
-            models.Session.status == models.SessionStatus.OPEN,
+        owner_query = default_admin_owner()
+        not_found = HTTPException(
+            status_code=500,
+            detail="ADMIN ユーザーが存在しません",
         )
-    )
-    session = result_session.scalars().first()
 
-    now = datetime.utcnow()
-
-    if not session:
-        session = models.Session(
-            visitor_identifier=visitor_identifier,
-            visitor_name=visitor_name,
-            status=models.SessionStatus.OPEN,
-            created_at=now,
-            last_active_at=now,
-            owner_user_id=owner.id,
-            company_id=owner.company_id,
-        )
-        db.add(session)
-        await db.commit()
-        await db.refresh(session)
-    else:
-        session.last_active_at = now
-        if visitor_name and not session.visitor_name:
-            session.visitor_name = visitor_name
-        await db.commit()
-        await db.refresh(session)
+    session = await upsert_open_session(db, owner_query, visitor_identifier, visitor_name)
+    if session is None:
+        raise not_found
+    await db.commit()
 
+    remember_session(session)
     return {"id": str(session.id)}
 
 # =============================
@@ -554,6 +612,11 @@ async def widget_create_or_get_session(
 @router.get("/widget/sessions/{session_id}/messages")
 async def widget_get_messages(
     session_id: str,
+    before_id: Optional[int] = Query(None),
+    after_id: Optional[int] = Query(None),
+    before_seq: Optional[int] = Query(None),
+    after_seq: Optional[int] = Query(None),
+    limit: int = Query(MESSAGE_PAGE_DEFAULT, ge=1, le=MESSAGE_PAGE_MAX),
     db: AsyncSession = Depends(get_db),
 ):
     try:
@@ -568,27 +631,129 @@ async def widget_get_messages(
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
 
-    result_msg = await db.execute(
-        select(models.Message)
-        .where(models.Message.session_id == session.id)
-        .order_by(models.Message.created_at.asc())
+    return await fetch_message_page(
+        db,
+        session.id,
+        before_id,
+        after_id,
+        limit,
+        before_seq=before_seq,
+        after_seq=after_seq,
     )
-    messages = result_msg.scalars().all()
 
-    return [
-        {
-            "id": m.id,
-            "session_id": str(m.session_id),
-            "sender_type": m.sender_type.value
-            if hasattr(m.sender_type, "value")
-            else str(m.sender_type),
-            "sender_id": m.sender_id,
-            "content": m.content,
-            "attachment_url": m.attachment_url,
-            "created_at": m.created_at.isoformat(),
-        }
-        for m in messages
-    ]
+
+# =============================
+# ウィジェット用: 起動時の情報をまとめて取得
+# POST /api/widget/bootstrap
+# =============================
+@router.post("/widget/bootstrap")
+async def widget_bootstrap(
+    payload: dict,
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    body:
+    {
+      "visitor_identifier": "visitor_xxx",
+      // どちらか一方を指定:
+      // "api_key": "xxxxx",
+      // "owner_id": 1,
+      "visitor_name": "Foo",   // 任意
+      "create": false,         // true なら OPEN セッションが無ければ作成する
+      "limit": 50              // 任意: 返すメッセージ件数
+    }
+
+    Bot 設定・セッション ID・最新ページのメッセージを 1 回で返す
+    （/widget/bot → /sessions → /widget/sessions/{id}/messages の代わり）。
+    API キーの確認は 1 回だけで、DB への問い合わせは 1 トランザクションにまとめる。
+
+    返り値:
+      bot        : Bot 設定（api_key 指定時のみ。それ以外は null）
+      session_id : OPEN セッションの ID（create=false で無ければ null）
+      messages   : 最新 limit 件（古い順）
+      has_older  : さらに古いメッセージがありそうか
+    """
+    visitor_identifier = payload.get("visitor_identifier")
+    api_key = payload.get("api_key")
+    owner_id = payload.get("owner_id")
+    visitor_name = payload.get("visitor_name")
+    create = bool(payload.get("create"))
+
+    try:
+        limit = int(payload.get("limit") or MESSAGE_PAGE_DEFAULT)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="limit が不正です")
+    limit = max(1, min(limit, MESSAGE_PAGE_MAX))
+
+    if not visitor_identifier:
+        raise HTTPException(
+            status_code=400,
+            detail="visitor_identifier は必須です",
+        )
+
+    bot = None
+    if api_key:
+        key = await active_api_key(db, api_key)
+        if not key:
+            raise HTTPException(status_code=401, detail="invalid api_key")
+        owner_query = owner_by_id(key.user_id)
+
+        if key.company_id:
+            bot_config = await get_bot_config(db, key.company_id)
+            bot = schemas.BotSettingRead(
+                enabled=bot_config.enabled,
+                welcome_message=bot_config.welcome_message,
+                options=list(bot_config.options),
+            ).model_dump()
+    elif owner_id is not None:
+        try:
+            owner_query = owner_by_id(int(owner_id))
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="owner_id が不正です")
+    else:
+        raise HTTPException(
+            status_code=400,
+            detail="owner_id または api_key を指定してください",
+        )
+
+    if create:
+        session = await upsert_open_session(db, owner_query, visitor_identifier, visitor_name)
+        if session is None:
+            raise HTTPException(status_code=404, detail="owner user not found")
+    else:
+        session = await find_open_session(db, owner_query, visitor_identifier)
+
+    messages = []
+    if session is not None:
+        # セッションの作成と同じトランザクションで読む
+        messages = await fetch_message_page(db, session.id, limit=limit)
+    if create:
+        await db.commit()
+    if session is not None:
+        remember_session(session)
+
+    return {
+        "bot": bot,
+        "session_id": str(session.id) if session is not None else None,
+        "messages": messages,
+        "has_older": len(messages) >= limit,
+    }
+
+
+# =============================
+# ウィジェット用: 差分同期
+# GET /api/widget/sessions/{session_id}/sync?after_seq=...
+# =============================
+@router.get("/widget/sessions/{session_id}/sync")
+async def widget_sync_messages(
+    session_id: UUID,
+    after_seq: int = Query(0),
+    db: AsyncSession = Depends(get_db),
+):
+    data = await sync_messages(db, session_id, after_seq, SYNC_MAX)
+    if data is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return data
 
 
 # -----------------------------
@@ -599,7 +764,7 @@ async def widget_get_messages(
 async def close_session(
     session_id: UUID,
     db: AsyncSession = Depends(get_db),
-    user: models.User = Depends(get_current_user),
+    user: Principal = Depends(get_current_user),
 ):
     q = await db.execute(
         select(models.Session).where(models.Session.id == session_id)
@@ -614,6 +779,8 @@ async def close_session(
 
     session.status = models.SessionStatus.CLOSED
     await db.commit()
+    await forget_session(session.id)
+    await emit_session_changed(session.id)
     return {"status": "ok"}
 
 @router.post("/widget/sessions/{session_id}/handoff")
@@ -622,13 +789,7 @@ async def widget_request_handoff(
     api_key: str = Query(...),
     db: AsyncSession = Depends(get_db),
 ):
-    q = await db.execute(
-        select(models.ApiKey).where(
-            models.ApiKey.key == api_key,
-            models.ApiKey.is_active.is_(True),
-        )
-    )
-    key = q.scalar_one_or_none()
+    key = await active_api_key(db, api_key)
     if not key:
         raise HTTPException(status_code=401, detail="invalid api_key")
 
@@ -650,43 +811,37 @@ async def widget_request_handoff(
     session.handoff_requested_at = now
     session.last_active_at = now
 
-    bot_text = "担当者をお呼びします。少々お待ちください。"
-    q_opt = await db.execute(
-        select(models.BotOption)
-        .join(models.BotSetting, models.BotOption.bot_setting_id == models.BotSetting.id)
-        .where(
-            models.BotSetting.company_id == session.company_id,
-            models.BotOption.is_active.is_(True),
-            models.BotOption.action == "handoff",
-        )
-        .order_by(models.BotOption.sort_order.asc(), models.BotOption.id.asc())
-        .limit(1)
-    )
-    opt = q_opt.scalar_one_or_none()
-    if opt and opt.reply_text:
-        bot_text = opt.reply_text
+    bot_config = await get_bot_config(db, session.company_id)
+    bot_text = bot_config.handoff_reply
+
+    allocation = await allocate_seq(db, session.id)
 
     bot_msg = models.Message(
         session_id=session.id,
+        seq=allocation.seq,
+        visitor_count=allocation.visitor_count,
         sender_type=models.SenderType.OPERATOR,
         sender_id=None,
         content=bot_text,
         attachment_url=None,
         created_at=now,
-        is_read=True,
-        read_at=now,
     )
     db.add(bot_msg)
+    session.last_message_at = now
+    session.last_message_preview = message_preview(bot_text)
+    session.message_count = models.Session.message_count + 1
 
     await db.commit()
     await db.refresh(bot_msg)
+    await forget_session(session.id)
 
     try:
-        from .socket import sio
+        from ..socket import sio, operator_room
         await sio.emit(
             "new_message",
             {
                 "id": str(bot_msg.id),
+                "seq": bot_msg.seq,
                 "session_id": str(bot_msg.session_id),
                 "sender_type": "system",
                 "content": bot_msg.content,
@@ -699,21 +854,26 @@ async def widget_request_handoff(
             "new_message",
             {
                 "id": str(bot_msg.id),
+                "seq": bot_msg.seq,
                 "session_id": str(bot_msg.session_id),
                 "sender_type": "system",
                 "content": bot_msg.content,
                 "attachment_url": None,
                 "created_at": bot_msg.created_at.isoformat(),
             },
-            room="operators",
+            room=operator_room(session.company_id, session.owner_user_id),
         )
     except Exception as e:
         print("[handoff] emit failed:", e)
 
+    # 受信箱に出るようになったので担当者の一覧へ追加する
+    await emit_session_changed(session.id)
+
     return {
         "ok": True,
         "message": {
             "id": bot_msg.id,
+            "seq": bot_msg.seq,
             "sender_type": "SYSTEM",
             "content": bot_msg.content,
             "created_at": bot_msg.created_at.isoformat(),
@@ -772,7 +932,7 @@ async def get_embed_script(owner_id: int):
 @router.get("/bot/settings", response_model=schemas.BotSettingRead)
 async def get_bot_settings(
     db: AsyncSession = Depends(get_db),
-    current_user: models.User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_user),
 ):
     if not current_user.company_id:
         raise HTTPException(status_code=400, detail="company_id not set")
@@ -803,7 +963,7 @@ async def get_bot_settings(
 async def update_bot_settings(
     payload: schemas.BotSettingUpdate,
     db: AsyncSession = Depends(get_db),
-    current_user: models.User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_user),
 ):
     if not current_user.company_id:
         raise HTTPException(status_code=400, detail="company_id not set")
@@ -827,6 +987,7 @@ async def update_bot_settings(
 
     await db.commit()
     await db.refresh(setting)
+    await refresh_bot_config(db, current_user.company_id)
 
     return schemas.BotSettingRead(
         enabled=setting.enabled,
@@ -843,7 +1004,7 @@ async def update_bot_settings(
 async def create_bot_option(
     payload: schemas.BotOptionCreate,
     db: AsyncSession = Depends(get_db),
-    current_user: models.User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_user),
 ):
     if not current_user.company_id:
         raise HTTPException(status_code=400, detail="company_id not set")
@@ -870,6 +1031,7 @@ async def create_bot_option(
     db.add(opt)
     await db.commit()
     await db.refresh(opt)
+    await refresh_bot_config(db, current_user.company_id)
     return opt
 
 # -------------------------
@@ -881,7 +1043,7 @@ async def update_bot_option(
     option_id: int,
     payload: schemas.BotOptionUpdate,
     db: AsyncSession = Depends(get_db),
-    current_user: models.User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_user),
 ):
     if not current_user.company_id:
         raise HTTPException(status_code=400, detail="company_id not set")
@@ -903,6 +1065,7 @@ async def update_bot_option(
 
     await db.commit()
     await db.refresh(opt)
+    await refresh_bot_config(db, current_user.company_id)
     return opt
 
 
@@ -914,7 +1077,7 @@ async def update_bot_option(
 async def delete_bot_option(
     option_id: int,
     db: AsyncSession = Depends(get_db),
-    current_user: models.User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_user),
 ):
     if not current_user.company_id:
         raise HTTPException(status_code=400, detail="company_id not set")
@@ -933,6 +1096,7 @@ async def delete_bot_option(
 
     await db.delete(opt)
     await db.commit()
+    await refresh_bot_config(db, current_user.company_id)
     return {"ok": True}
 
 
@@ -945,13 +1109,7 @@ async def get_widget_bot_settings(
     api_key: str = Query(...),
     db: AsyncSession = Depends(get_db),
 ):
-    q = await db.execute(
-        select(models.ApiKey).where(
-            models.ApiKey.key == api_key,
-            models.ApiKey.is_active.is_(True),
-        )
-    )
-    key = q.scalar_one_or_none()
+    key = await active_api_key(db, api_key)
     if not key:
         raise HTTPException(status_code=401, detail="invalid api_key")
 
@@ -959,23 +1117,13 @@ async def get_widget_bot_settings(
     if not company_id:
         raise HTTPException(status_code=400, detail="company_id not found")
 
-    q2 = await db.execute(
-        select(models.BotSetting).where(models.BotSetting.company_id == company_id)
-    )
-    setting = q2.scalar_one_or_none()
-
-    if not setting:
-        setting = models.BotSetting(company_id=company_id)
-        db.add(setting)
-        await db.commit()
-        await db.refresh(setting)
-
-    options = [o for o in (setting.options or []) if o.is_active]
+    # 有効な選択肢だけを持つコンパイル済み設定（通常は DB を見ない）
+    bot_config = await get_bot_config(db, company_id)
 
     return schemas.BotSettingRead(
-        enabled=setting.enabled,
-        welcome_message=setting.welcome_message or "",
-        options=options,
+        enabled=bot_config.enabled,
+        welcome_message=bot_config.welcome_message,
+        options=list(bot_config.options),
     )
 
 from urllib.parse import quote
@@ -1035,7 +1183,7 @@ async def get_embed_js(api_key: str = Query(...)):
 @router.get("/api-keys")
 async def list_api_keys(
     db: AsyncSession = Depends(get_db),
-    current_user: models.User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_user),
 ):
     if not current_user.company_id:
         raise HTTPException(status_code=400, detail="company_id not set")
@@ -1071,7 +1219,7 @@ async def list_api_keys(
 async def create_api_key(
     payload: dict,
     db: AsyncSession = Depends(get_db),
-    current_user: models.User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_user),
 ):
     key_str = secrets.token_hex(32)
 
@@ -1099,7 +1247,7 @@ async def create_api_key(
 async def disable_api_key(
     api_key_id: int,
     db: AsyncSession = Depends(get_db),
-    current_user: models.User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_user),
 ):
     if not current_user.company_id:
         raise HTTPException(status_code=400, detail="company_id not set")
@@ -1118,6 +1266,7 @@ async def disable_api_key(
     key.is_active = False
     key.revoked_at = datetime.utcnow()
     await db.commit()
+    await forget_api_key(key.key)
     return {"ok": True}
 
 
@@ -1125,7 +1274,7 @@ async def disable_api_key(
 async def rotate_api_key(
     api_key_id: int,
     db: AsyncSession = Depends(get_db),
-    current_user: models.User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_user),
 ):
     """
     rotate = 古いの無効化 → 新しいの発行
@@ -1157,6 +1306,7 @@ async def rotate_api_key(
     db.add(new_key)
     await db.commit()
     await db.refresh(new_key)
+    await forget_api_key(old.key)
 
     return {
         "id": new_key.id,
@@ -1171,7 +1321,7 @@ from fastapi import Response
 async def delete_api_key(
     api_key_id: int,
     db: AsyncSession = Depends(get_db),
-    current_user: models.User = Depends(get_current_user),
+    current_user: Principal = Depends(get_current_user),
 ):
     if not current_user.company_id:
         raise HTTPException(status_code=400, detail="company_id not set")
@@ -1190,8 +1340,10 @@ async def delete_api_key(
     if key.is_active:
         raise HTTPException(status_code=400, detail="active key cannot be deleted")
 
+    key_str = key.key
     await db.delete(key)
     await db.commit()
+    await forget_api_key(key_str)
 
     return {"ok": True}
 
@@ -1210,4 +1362,6 @@ async def request_handoff(
     session.last_active_at = datetime.utcnow()
 
     await db.commit()
+    await forget_session(session.id)
+    await emit_session_changed(session.id)
     return {"ok": True}
\ No newline at end of file
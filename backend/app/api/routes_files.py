@@ -0,0 +1,146 @@
+# backend/app/api/routes_files.py
+import asyncio
+import gzip
+import mimetypes
+import os
+import shutil
+import stat as stat_module
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import FileResponse, RedirectResponse, Response
+
+from ..attachments import UPLOAD_URL_PREFIX, parse_content_key
+from ..storage import PRESIGN_EXPIRES, storage
+
+router = APIRouter(tags=["upload"])
+
+# 添付ファイルは名前（内容の sha256 / uuid）が変わらない限り中身も変わらない
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# 事前圧縮（.gz）を用意する種類と、最小サイズ
+COMPRESSIBLE_TYPES = {
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "image/svg+xml",
+}
+GZIP_MIN_BYTES = 1024
+
+
+def _is_compressible(media_type: Optional[str]) -> bool:
+    if not media_type:
+        return False
+    return media_type.startswith("text/") or media_type in COMPRESSIBLE_TYPES
+
+
+def _etag(key: str, stat: os.stat_result) -> str:
+    """
+    強い ETag。内容アドレスのファイルは sha256 そのもの、それ以外は mtime とサイズから。
+    """
+    digest = parse_content_key(key)
+    if digest:
+        return f'"{digest}"'
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tags = [t.strip() for t in if_none_match.split(",")]
+    # If-None-Match は弱い比較
+    return any(t == etag or t == f"W/{etag}" for t in tags)
+
+
+def _gzip_variant(path: Path) -> Optional[Path]:
+    """
+    path.gz を用意して返す（無ければ作る。スレッドで実行すること）。
+    圧縮しても小さくならなければ None。
+    """
+    gz_path = path.with_name(path.name + ".gz")
+    if not gz_path.exists():
+        # 一時ファイル名は呼び出しごとに一意にする（同時の初回アクセスで 1 つのファイルに書き混ぜない）
+        fd, tmp_name = tempfile.mkstemp(
+            dir=gz_path.parent, prefix=f".{gz_path.name}.", suffix=".part"
+        )
+        tmp = Path(tmp_name)
+        try:
+            with open(path, "rb") as src, os.fdopen(fd, "wb") as raw, gzip.GzipFile(
+                fileobj=raw, mode="wb", compresslevel=9
+            ) as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            os.replace(tmp, gz_path)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+    if gz_path.stat().st_size >= path.stat().st_size:
+        return None
+    return gz_path
+
+
+@router.api_route(UPLOAD_URL_PREFIX + "/{key:path}", methods=["GET", "HEAD"])
+async def serve_attachment(key: str, request: Request):
+    """
+    添付ファイルの配信。
+    - Cache-Control: immutable と強い ETag（If-None-Match なら 304）
+    - Range / If-Range（動画・PDF のシーク）
+    - テキスト系は gzip 済みのファイルを Content-Encoding: gzip で返す
+    - ローカル以外の保存先は署名付き URL へリダイレクト（本体はアプリを通らない）
+    """
+    # 一時ファイル（.tmp/ や .xxx.part）や親ディレクトリは見せない
+    if not key or any(part.startswith(".") for part in key.split("/")):
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    try:
+        path = storage.local_path(key)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if path is None:
+        signed = await asyncio.to_thread(storage.presign_download, key)
+        if not signed:
+            raise HTTPException(status_code=404, detail="Not Found")
+        # 署名の有効期限より短い間だけリダイレクトを使い回してもらう
+        return RedirectResponse(
+            signed,
+            status_code=302,
+            headers={"Cache-Control": f"private, max-age={max(0, PRESIGN_EXPIRES - 60)}"},
+        )
+
+    try:
+        stat = await asyncio.to_thread(os.stat, path)
+    except (FileNotFoundError, NotADirectoryError):
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not stat_module.S_ISREG(stat.st_mode):
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    media_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+    compressible = _is_compressible(media_type) and stat.st_size >= GZIP_MIN_BYTES
+
+    headers = {"Cache-Control": IMMUTABLE_CACHE_CONTROL}
+    if compressible:
+        headers["Vary"] = "Accept-Encoding"
+
+    # gzip 版は Range を使わないときだけ（バイト位置の意味が変わるため）
+    accepts_gzip = "gzip" in request.headers.get("accept-encoding", "").lower()
+    gz_path = None
+    if compressible and accepts_gzip and "range" not in request.headers:
+        gz_path = await asyncio.to_thread(_gzip_variant, path)
+
+    etag = _etag(key, stat)
+    if gz_path is not None:
+        # 表現が違うので ETag も分ける
+        etag = etag[:-1] + '-gz"'
+    headers["ETag"] = etag
+
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    if gz_path is not None:
+        headers["Content-Encoding"] = "gzip"
+        return FileResponse(gz_path, media_type=media_type, headers=headers)
+
+    return FileResponse(path, media_type=media_type, headers=headers, stat_result=stat)
@@ -0,0 +1,50 @@
+# backend/app/api/routes_search.py
+from typing import Optional
+from uuid import UUID
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..auth import Principal, get_current_user
+from ..db import get_db
+from ..search import (
+    SEARCH_PAGE_DEFAULT,
+    SEARCH_PAGE_MAX,
+    SearchScope,
+    parse_query,
+    search_backend,
+)
+
+router = APIRouter(prefix="/api", tags=["search"])
+
+
+# -----------------------------
+# 管理画面: メッセージ検索
+# GET /api/search/messages?q=料金 プラン&session_id=...&cursor=...&limit=20
+# 担当セッション（自社）のメッセージから、空白区切りの語をすべて含むものを新しい順に返す
+# 返り値: {"items": [{id, session_id, seq, sender_type, created_at, visitor_name,
+#                     snippet, snippet_prefix, snippet_suffix, highlights}],
+#          "next_cursor": "..." | null}
+# -----------------------------
+@router.get("/search/messages")
+async def search_messages(
+    q: str = Query(..., min_length=1, max_length=200),
+    session_id: Optional[UUID] = Query(None),
+    cursor: Optional[str] = Query(None),
+    limit: int = Query(SEARCH_PAGE_DEFAULT, ge=1, le=SEARCH_PAGE_MAX),
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(get_current_user),
+):
+    terms = parse_query(q)
+    if not terms:
+        raise HTTPException(status_code=400, detail="検索語を指定してください")
+
+    scope = SearchScope(
+        user_id=current_user.id,
+        company_id=current_user.company_id,
+        session_id=session_id,
+    )
+    try:
+        return await search_backend.search(db, scope, terms, cursor=cursor, limit=limit)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="cursor が不正です")
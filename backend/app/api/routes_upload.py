@@ -1,27 +1,278 @@
 # backend/app/api/routes_upload.py
-from fastapi import APIRouter, UploadFile, File, HTTPException
+import asyncio
+import base64
+from typing import List, Optional, Tuple
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
 from fastapi.responses import JSONResponse
-from pathlib import Path
-import uuid
+from sqlalchemy.ext.asyncio import AsyncSession
+
+try:
+    from python_multipart.exceptions import MultipartParseError
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # 0.0.13 より前のパッケージ名
+    from multipart.exceptions import MultipartParseError
+    from multipart.multipart import MultipartParser, parse_options_header
+
+from ..attachments import (
+    UPLOAD_MAX_BYTES,
+    UPLOAD_URL_PREFIX,
+    UploadSink,
+    UploadTooLarge,
+    attachment_url,
+    content_key,
+    is_sha256,
+    normalize_suffix,
+    parse_content_key,
+    record_attachment,
+)
+from ..db import get_db
+from ..storage import storage
+from ..thumbnails import thumbnailer
 
 router = APIRouter(prefix="/api", tags=["upload"])
 
-UPLOAD_DIR = Path("/app/uploads")
-UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+# multipart の境界やフィールド分の余裕
+UPLOAD_FORM_OVERHEAD = 64 * 1024
+UPLOAD_FORM_MAX_PARTS = 10
+
+
+def _too_large() -> HTTPException:
+    return HTTPException(
+        status_code=413,
+        detail=f"ファイルサイズが上限（{UPLOAD_MAX_BYTES // (1024 * 1024)}MB）を超えています",
+    )
+
+
+async def _register(
+    db: AsyncSession, key: str, sha256: str, size: int, content_type: Optional[str]
+) -> str:
+    url = attachment_url(key)
+    await record_attachment(
+        db, url=url, sha256=sha256, size_bytes=size, content_type=content_type
+    )
+    await db.commit()
+
+    # 画像ならプレビュー（縮小版）の生成をバックグラウンドに回す
+    thumbnailer.enqueue(key)
+    return url
+
+
+class _FilePartReader:
+    """
+    multipart/form-data の本文を受け取った順に解析し、file フィールドの中身だけを取り出す
+    （request.form() のように本文全体を一時ファイルに溜めてから読み直さない）。
+    feed() は受け取ったチャンクのうち file の中身にあたる部分を返す。
+    """
+
+    def __init__(self, boundary: bytes):
+        self.found = False
+        self.filename: Optional[str] = None
+        self.content_type: Optional[str] = None
+        self._parts = 0
+        self._in_file = False
+        self._headers: dict = {}
+        self._field = b""
+        self._value = b""
+        self._data: List[bytes] = []
+        self._parser = MultipartParser(
+            boundary,
+            {
+                "on_part_begin": self._on_part_begin,
+                "on_header_field": self._on_header_field,
+                "on_header_value": self._on_header_value,
+                "on_header_end": self._on_header_end,
+                "on_headers_finished": self._on_headers_finished,
+                "on_part_data": self._on_part_data,
+                "on_part_end": self._on_part_end,
+            },
+        )
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        self._parser.write(chunk)
+        data, self._data = self._data, []
+        return data
+
+    def finish(self) -> None:
+        self._parser.finalize()
+
+    def _on_part_begin(self):
+        self._parts += 1
+        if self._parts > UPLOAD_FORM_MAX_PARTS:
+            raise HTTPException(status_code=400, detail="フィールドが多すぎます")
+        self._headers = {}
+
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._field.lower()] = self._value
+        self._field = self._value = b""
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        if options.get(b"name") != b"file" or b"filename" not in options or self.found:
+            return
+        self.found = self._in_file = True
+        self.filename = options[b"filename"].decode("utf-8", "replace")
+        content_type = self._headers.get(b"content-type")
+        self.content_type = content_type.decode("latin-1") if content_type else None
+
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        if self._in_file:
+            self._data.append(data[start:end])
+
+    def _on_part_end(self):
+        self._in_file = False
+
+
+def _write_chunks(sink: UploadSink, chunks: List[bytes]) -> None:
+    for chunk in chunks:
+        sink.write(chunk)
+
+
+async def _receive_file(request: Request, sink: UploadSink) -> Tuple[Optional[str], Optional[str]]:
+    """本文を読みながら file フィールドを sink に書く。返り値: (filename, content_type)"""
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or not options.get(b"boundary"):
+        raise HTTPException(status_code=400, detail="multipart/form-data で送信してください")
+
+    reader = _FilePartReader(options[b"boundary"])
+    received = 0
+    try:
+        async for chunk in request.stream():
+            # Content-Length の無い（chunked の）本文もここで止める
+            received += len(chunk)
+            if received > UPLOAD_MAX_BYTES + UPLOAD_FORM_OVERHEAD:
+                raise _too_large()
+            data = reader.feed(chunk)
+            if data:
+                # ハッシュ計算と書き込みはスレッドで（イベントループを止めない）
+                await asyncio.to_thread(_write_chunks, sink, data)
+        reader.finish()
+    except MultipartParseError:
+        raise HTTPException(status_code=400, detail="multipart の形式が不正です")
+
+    if not reader.found:
+        raise HTTPException(status_code=400, detail="file を指定してください")
+    return reader.filename, reader.content_type
 
 
 @router.post("/upload")
-async def upload_file(file: UploadFile = File(...)):
-    suffix = Path(file.filename).suffix
-    new_name = f"{uuid.uuid4()}{suffix}"
-    save_path = UPLOAD_DIR / new_name
+async def upload_file(request: Request, db: AsyncSession = Depends(get_db)):
+    """
+    multipart/form-data の file フィールドを保存する（アプリサーバー経由のアップロード）。
+    Content-Length で上限超過が分かるものは本文を受け取る前に 413 を返す。
+    本文は受け取りながら解析し、file の中身をハッシュしつつ一時ファイルに 1 回だけ書く
+    （上限を超えた時点で 413）。保存先へは rename で移す。
+    保存先は内容の sha256 で決まり、同じ内容なら既存の URL を返す（書き込みなし）。
+    """
+    content_length = request.headers.get("content-length")
+    if content_length is not None:
+        try:
+            if int(content_length) > UPLOAD_MAX_BYTES + UPLOAD_FORM_OVERHEAD:
+                raise _too_large()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Content-Length が不正です")
 
+    sink = await asyncio.to_thread(UploadSink)
     try:
-        content = await file.read()
-        save_path.write_bytes(content)
+        filename, content_type = await _receive_file(request, sink)
+        key, sha256, size, _ = await asyncio.to_thread(sink.commit, filename, content_type)
+    except UploadTooLarge:
+        raise _too_large()
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"保存に失敗しました: {e}")
+    finally:
+        # commit 済みなら何もしない
+        sink.discard()
+
+    url = await _register(db, key, sha256, size, content_type)
+    return JSONResponse({"url": url})
+
+
+# -----------------------------
+# 直接アップロード（署名付き URL）
+# POST /api/uploads/presign
+# body: {"sha256": "<hex>", "size": 12345, "filename": "a.png", "content_type": "image/png"}
+#
+# - 同じ内容が既にあれば {"url": ..., "exists": true}（アップロード不要）
+# - 保存先が対応していれば {"key", "upload": {"method", "url", "headers"}}
+#   → ブラウザがストレージへ直接 PUT し、POST /api/uploads/complete を呼ぶ
+# - 対応していなければ {"upload": null} → POST /api/upload を使う
+# -----------------------------
+@router.post("/uploads/presign")
+async def presign_upload(payload: dict, db: AsyncSession = Depends(get_db)):
+    sha256 = str(payload.get("sha256") or "").lower()
+    content_type = payload.get("content_type") or None
+    try:
+        size = int(payload.get("size"))
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="size が不正です")
+
+    if not is_sha256(sha256):
+        raise HTTPException(status_code=400, detail="sha256 が不正です")
+    if size <= 0:
+        raise HTTPException(status_code=400, detail="size が不正です")
+    if size > UPLOAD_MAX_BYTES:
+        raise _too_large()
+
+    key = content_key(sha256, normalize_suffix(payload.get("filename")))
+
+    existing_size = await asyncio.to_thread(storage.size, key)
+    if existing_size is not None:
+        url = await _register(db, key, sha256, existing_size, content_type)
+        return {"key": key, "url": url, "exists": True}
+
+    checksum = base64.b64encode(bytes.fromhex(sha256)).decode()
+    upload = await asyncio.to_thread(
+        storage.presign_upload, key, content_type, size, checksum
+    )
+    return {"key": key, "url": attachment_url(key), "exists": False, "upload": upload}
+
+
+# -----------------------------
+# 直接アップロードの完了通知
+# POST /api/uploads/complete
+# body: {"key": "ab/<sha256>.png", "content_type": "image/png"}
+# -----------------------------
+@router.post("/uploads/complete")
+async def complete_upload(payload: dict, db: AsyncSession = Depends(get_db)):
+    key = payload.get("key")
+    sha256 = parse_content_key(key)
+    if not sha256:
+        raise HTTPException(status_code=400, detail="key が不正です")
+
+    size = await asyncio.to_thread(storage.size, key)
+    if size is None:
+        raise HTTPException(status_code=404, detail="アップロードされたファイルが見つかりません")
+    if size > UPLOAD_MAX_BYTES:
+        await asyncio.to_thread(storage.delete, key)
+        raise _too_large()
+
+    url = await _register(db, key, sha256, size, payload.get("content_type") or None)
+    return {"url": url}
+
+
+# -----------------------------
+# 添付ファイルのダウンロード URL
+# GET /api/uploads/download-url?url=/uploads/ab/<sha256>.png
+# 保存先が署名付き URL に対応していればそれを、そうでなければ url をそのまま返す
+# -----------------------------
+@router.get("/uploads/download-url")
+async def download_url(url: str = Query(...)):
+    prefix = f"{UPLOAD_URL_PREFIX}/"
+    if not url.startswith(prefix):
+        raise HTTPException(status_code=400, detail="url が不正です")
+    key = url[len(prefix):]
+    if ".." in key.split("/"):
+        raise HTTPException(status_code=400, detail="url が不正です")
 
-    url = f"/uploads/{new_name}"
+    signed = await asyncio.to_thread(storage.presign_download, key)
+    return {"url": signed or url}
 
-    return JSONResponse({"url": url})
\ No newline at end of file
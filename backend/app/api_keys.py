@@ -0,0 +1,75 @@
+# backend/app/api_keys.py
+import os
+from typing import NamedTuple, Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models
+from .cache import MISSING, TTLCache, invalidate
+
+API_KEY_CACHE_MAX = int(os.getenv("API_KEY_CACHE_MAX", "10000"))
+API_KEY_CACHE_TTL = float(os.getenv("API_KEY_CACHE_TTL", "300"))
+# 存在しないキーの記憶（不正なキーの連打を DB に届かせない）
+API_KEY_NEGATIVE_CACHE_MAX = int(os.getenv("API_KEY_NEGATIVE_CACHE_MAX", "50000"))
+API_KEY_NEGATIVE_CACHE_TTL = float(os.getenv("API_KEY_NEGATIVE_CACHE_TTL", "60"))
+
+
+class ApiKeyInfo(NamedTuple):
+    user_id: int
+    company_id: int
+    active: bool
+
+
+# key: api_key 文字列
+api_key_cache = TTLCache("api_key", API_KEY_CACHE_MAX, API_KEY_CACHE_TTL)
+# 不正なキーで正規のエントリが押し出されないよう別枠にする
+api_key_negative_cache = TTLCache(
+    "api_key_negative", API_KEY_NEGATIVE_CACHE_MAX, API_KEY_NEGATIVE_CACHE_TTL
+)
+
+
+async def resolve_api_key(db: AsyncSession, api_key: str) -> Optional[ApiKeyInfo]:
+    """
+    API キーの持ち主を返す。存在しなければ None（無効化済みは active=False で返す）。
+    キャッシュにあれば DB を見ない。
+    """
+    info = api_key_cache.get(api_key)
+    if info is not MISSING:
+        return info
+    if api_key_negative_cache.get(api_key) is not MISSING:
+        return None
+
+    result = await db.execute(
+        select(
+            models.ApiKey.user_id,
+            models.ApiKey.company_id,
+            models.ApiKey.is_active,
+        ).where(models.ApiKey.key == api_key)
+    )
+    row = result.first()
+    if row is None:
+        api_key_negative_cache.set(api_key, True)
+        return None
+
+    info = ApiKeyInfo(
+        user_id=row.user_id,
+        company_id=row.company_id,
+        active=bool(row.is_active),
+    )
+    api_key_cache.set(api_key, info)
+    return info
+
+
+async def active_api_key(db: AsyncSession, api_key: str) -> Optional[ApiKeyInfo]:
+    """有効な API キーなら持ち主を返す"""
+    info = await resolve_api_key(db, api_key)
+    if info is None or not info.active:
+        return None
+    return info
+
+
+async def forget_api_key(api_key: str):
+    """無効化・ローテーション・削除のコミット後に呼ぶ（全ワーカーで即時反映）"""
+    await invalidate(api_key_cache, api_key)
+    await invalidate(api_key_negative_cache, api_key)
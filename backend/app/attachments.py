@@ -0,0 +1,133 @@
+# backend/app/attachments.py
+import hashlib
+import os
+import re
+import tempfile
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, Tuple
+
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models
+from .storage import storage
+
+# ==== 添付ファイルの設定 ====
+UPLOAD_URL_PREFIX = "/uploads"
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(20 * 1024 * 1024)))
+
+_SUFFIX_RE = re.compile(r"^\.[a-z0-9]{1,10}$")
+_KEY_RE = re.compile(r"^([0-9a-f]{2})/(\1[0-9a-f]{62})(\.[a-z0-9]{1,10})?$")
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+def normalize_suffix(filename: Optional[str]) -> str:
+    """保存名に使う拡張子（小文字・英数字のみ。使えなければ無し）"""
+    suffix = Path(filename or "").suffix.lower()
+    return suffix if _SUFFIX_RE.match(suffix) else ""
+
+
+def is_sha256(value: Optional[str]) -> bool:
+    return bool(value) and bool(_SHA256_RE.match(value))
+
+
+def content_key(digest: str, suffix: str) -> str:
+    """内容のハッシュから決まる保存先（ディレクトリを先頭 2 文字で分ける）"""
+    return f"{digest[:2]}/{digest}{suffix}"
+
+
+def parse_content_key(key: Optional[str]) -> Optional[str]:
+    """内容アドレスのキーなら sha256 を返す"""
+    m = _KEY_RE.match(key or "")
+    return m.group(2) if m else None
+
+
+class UploadSink:
+    """
+    アップロードを 1 回読むだけで保存する。チャンクを書くたびに sha256 とサイズを進め、
+    一時ファイル（storage.temp_dir() 内。ローカルなら保存先と同じファイルシステム）に書く。
+    最後に内容アドレスのキーへ put_path で移す（ローカルは rename のみ）。
+    メソッドはブロッキングなので、非同期コードからはスレッドで呼ぶこと。
+    """
+
+    def __init__(self, max_bytes: int = UPLOAD_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._digest = hashlib.sha256()
+        fd, tmp = tempfile.mkstemp(dir=storage.temp_dir(), prefix=".upload-", suffix=".part")
+        self.path = Path(tmp)
+        self._file = os.fdopen(fd, "wb")
+
+    def write(self, chunk: bytes) -> None:
+        """上限を超えたら UploadTooLarge"""
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise UploadTooLarge()
+        self._digest.update(chunk)
+        self._file.write(chunk)
+
+    def discard(self) -> None:
+        if not self._file.closed:
+            self._file.close()
+        self.path.unlink(missing_ok=True)
+
+    def commit(
+        self, filename: Optional[str], content_type: Optional[str] = None
+    ) -> Tuple[str, str, int, bool]:
+        """
+        保存して (key, sha256, size, 新規に書き込んだか) を返す。
+        同じ内容が既にあれば（同時アップロードで先を越された場合も）書き込まずに成功とする。
+        """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+        digest = self._digest.hexdigest()
+        key = content_key(digest, normalize_suffix(filename))
+        try:
+            if storage.exists(key):
+                return key, digest, self.size, False
+            try:
+                storage.put_path(self.path, key, content_type)
+            except OSError:
+                if not storage.exists(key):
+                    raise
+                return key, digest, self.size, False
+            return key, digest, self.size, True
+        finally:
+            self.path.unlink(missing_ok=True)
+
+
+def attachment_url(key: str) -> str:
+    return f"{UPLOAD_URL_PREFIX}/{key}"
+
+
+async def record_attachment(
+    db: AsyncSession,
+    *,
+    url: str,
+    sha256: str,
+    size_bytes: int,
+    content_type: Optional[str],
+) -> None:
+    """attachments に登録する（既にあれば last_uploaded_at だけ進める）。コミットは呼び出し側"""
+    now = datetime.utcnow()
+    table = models.Attachment.__table__
+    stmt = pg_insert(table).values(
+        url=url,
+        sha256=sha256,
+        size_bytes=size_bytes,
+        content_type=content_type,
+        created_at=now,
+        last_uploaded_at=now,
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.url],
+        set_={"last_uploaded_at": stmt.excluded.last_uploaded_at},
+    )
+    await db.execute(stmt)
@@ -1,22 +1,29 @@
 # backend/app/auth.py
+import os
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import NamedTuple, Optional
 
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from passlib.context import CryptContext
-from sqlalchemy import select
+from sqlalchemy import select, update
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from .db import AsyncSessionLocal
+from .db import AsyncSessionLocal, get_db
 from . import models
+from .cache import MISSING, TTLCache, invalidate
+from .passwords import password_hasher
 
 # ==== JWT 設定 ====
 SECRET_KEY = "CHANGE_ME_TO_SOMETHING_SECURE" 
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24
 
+# トークン失効（token_version）の確認結果をどれだけ使い回すか
+TOKEN_VERSION_CACHE_MAX = int(os.getenv("TOKEN_VERSION_CACHE_MAX", "10000"))
+TOKEN_VERSION_CACHE_TTL = float(os.getenv("TOKEN_VERSION_CACHE_TTL", "30"))
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
@@ -30,6 +37,15 @@ def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
 
+# 非同期ハンドラーからはこちらを使う（bcrypt をイベントループの外で計算する）
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await password_hasher.run(verify_password, plain_password, hashed_password)
+
+
+async def get_password_hash_async(password: str) -> str:
+    return await password_hasher.run(get_password_hash, password)
+
+
 async def get_user_by_email(db: AsyncSession, email: str) -> Optional[models.User]:
     result = await db.execute(select(models.User).where(models.User.email == email))
     return result.scalars().first()
@@ -39,7 +55,10 @@ async def authenticate_user(email: str, password: str, db: AsyncSession) -> Opti
     user = await get_user_by_email(db, email)
     if not user:
         return None
-    if not verify_password(password, user.password_hash):
+    # bcrypt の待ち・計算の間に DB 接続を握らないよう、読み取りのトランザクションを終えて接続をプールに返す
+    # （expire_on_commit=False なので user の属性はそのまま使える）
+    await db.commit()
+    if not await verify_password_async(password, user.password_hash):
         return None
     return user
 
@@ -52,26 +71,119 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     return encoded_jwt
 
 
-async def get_current_user(token: str = Depends(oauth2_scheme)) -> models.User:
+def create_user_token(user: models.User) -> str:
+    """認可に必要な情報をクレームに入れて発行する（リクエストごとにユーザーを引かなくて済むように）"""
+    role = user.role.value if hasattr(user.role, "value") else str(user.role)
+    return create_access_token(
+        {
+            "sub": user.email,
+            "uid": user.id,
+            "cid": user.company_id,
+            "role": role,
+            "ver": user.token_version or 0,
+        }
+    )
+
+
+class Principal(NamedTuple):
+    """JWT のクレームから組み立てた認証済みユーザー（DB の User ではない）"""
+
+    id: int
+    company_id: Optional[int]
+    role: models.UserRole
+    email: Optional[str]
+    token_version: int
+
+
+# key: user_id -> 現在の token_version（存在しないユーザーは None）
+token_version_cache = TTLCache("token_version", TOKEN_VERSION_CACHE_MAX, TOKEN_VERSION_CACHE_TTL)
+
+
+async def _current_token_version(user_id: int, db: Optional[AsyncSession]) -> Optional[int]:
+    version = token_version_cache.get(user_id)
+    if version is not MISSING:
+        return version
+
+    stmt = select(models.User.token_version).where(models.User.id == user_id)
+    if db is not None:
+        version = (await db.execute(stmt)).scalar_one_or_none()
+    else:
+        async with AsyncSessionLocal() as own_db:
+            version = (await own_db.execute(stmt)).scalar_one_or_none()
+
+    token_version_cache.set(user_id, version)
+    return version
+
+
+async def get_principal_from_token(
+    token: str, db: Optional[AsyncSession] = None
+) -> Optional[Principal]:
+    """
+    JWT を検証して Principal を返す。不正・失効済みなら None。
+    失効確認はキャッシュが効いていれば DB を見ない。見る場合も db があればそれを使う。
+    HTTP 以外（Socket.IO の接続認証など）からも使う。
+    """
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+
+    try:
+        user_id = int(payload["uid"])
+        role = models.UserRole(payload["role"])
+        version = int(payload.get("ver", 0))
+    except (KeyError, TypeError, ValueError):
+        # uid などを持たない旧形式のトークンは再ログインしてもらう
+        return None
+
+    current = await _current_token_version(user_id, db)
+    if current is None or current != version:
+        return None
+
+    return Principal(
+        id=user_id,
+        company_id=payload.get("cid"),
+        role=role,
+        email=payload.get("sub"),
+        token_version=version,
+    )
+
+
+async def get_current_user(
+    token: str = Depends(oauth2_scheme),
+    db: AsyncSession = Depends(get_db),
+) -> Principal:
+    """
+    ルートと同じ get_db のセッションを使う（リクエストあたり接続は 1 本まで）。
+    失効確認がキャッシュに載っていれば認証のためのクエリは発行しない。
+    """
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-    except JWTError:
+    principal = await get_principal_from_token(token, db)
+    if principal is None:
         raise credentials_exception
+    return principal
 
-    email: str = payload.get("sub")
-    if email is None:
-        raise credentials_exception
 
-    async with AsyncSessionLocal() as db:
-        user = await get_user_by_email(db, email)
-        if user is None:
-            raise credentials_exception
-        return user
+async def revoke_user_tokens(db: AsyncSession, user_id: int) -> int:
+    """
+    ユーザーの発行済みトークンをすべて無効にする（token_version を進める）。
+    コミットは呼び出し側。コミット後に forget_token_version() を呼ぶこと。
+    """
+    result = await db.execute(
+        update(models.User)
+        .where(models.User.id == user_id)
+        .values(token_version=models.User.token_version + 1)
+        .returning(models.User.token_version)
+    )
+    return result.scalar_one()
+
+
+async def forget_token_version(user_id: int):
+    await invalidate(token_version_cache, user_id)
 
 
 async def ensure_default_admin():
@@ -95,7 +207,7 @@ async def ensure_default_admin():
         if not admin:
             admin = models.User(
                 email="admin@example.com",
-                password_hash=get_password_hash("admin123"),
+                password_hash=await get_password_hash_async("admin123"),
                 display_name="Admin",
                 role=models.UserRole.ADMIN,
                 company=company,
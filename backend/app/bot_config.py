@@ -0,0 +1,144 @@
+# backend/app/bot_config.py
+import os
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models
+from .cache import MISSING, TTLCache, invalidate
+
+BOT_CONFIG_CACHE_MAX = int(os.getenv("BOT_CONFIG_CACHE_MAX", "5000"))
+BOT_CONFIG_CACHE_TTL = float(os.getenv("BOT_CONFIG_CACHE_TTL", "600"))
+
+DEFAULT_REPLY = "承知しました。"
+DEFAULT_LINK_REPLY = "こちらをご覧ください。"
+DEFAULT_HANDOFF_REPLY = "担当者をお呼びします。少々お待ちください。"
+
+
+def resolve_reply(action: Optional[str], reply_text: Optional[str], link_url: Optional[str]) -> str:
+    """選択肢がクリックされたときに Bot が返す文面"""
+    if action == "link":
+        if link_url:
+            return f"{reply_text or DEFAULT_LINK_REPLY}\n{link_url}"
+        return reply_text or DEFAULT_LINK_REPLY
+    if action == "handoff":
+        return reply_text or DEFAULT_HANDOFF_REPLY
+    return reply_text or DEFAULT_REPLY
+
+
+@dataclass(frozen=True)
+class CompiledBotOption:
+    id: int
+    label: str
+    reply_text: Optional[str]
+    action: Optional[str]
+    link_url: Optional[str]
+    sort_order: int
+    is_active: bool
+    reply: str
+
+
+@dataclass(frozen=True)
+class CompiledBotConfig:
+    """
+    会社ごとの Bot 設定をメモリ上で引ける形にしたもの。
+    有効な選択肢のみを sort_order 順に持つ。
+    """
+
+    company_id: int
+    enabled: bool
+    welcome_message: str
+    options: Tuple[CompiledBotOption, ...] = ()
+    options_by_id: Dict[int, CompiledBotOption] = field(default_factory=dict)
+    options_by_action: Dict[str, Tuple[CompiledBotOption, ...]] = field(default_factory=dict)
+
+    def option(self, option_id: int) -> Optional[CompiledBotOption]:
+        return self.options_by_id.get(option_id)
+
+    def first_option(self, action: str) -> Optional[CompiledBotOption]:
+        opts = self.options_by_action.get(action)
+        return opts[0] if opts else None
+
+    @property
+    def handoff_reply(self) -> str:
+        opt = self.first_option("handoff")
+        if opt and opt.reply_text:
+            return opt.reply_text
+        return DEFAULT_HANDOFF_REPLY
+
+
+def compile_bot_config(company_id: int, setting: Optional[models.BotSetting], options) -> CompiledBotConfig:
+    active = sorted(
+        (o for o in options if o.is_active),
+        key=lambda o: (o.sort_order or 0, o.id),
+    )
+    compiled = tuple(
+        CompiledBotOption(
+            id=o.id,
+            label=o.label,
+            reply_text=o.reply_text,
+            action=o.action,
+            link_url=o.link_url,
+            sort_order=o.sort_order or 0,
+            is_active=True,
+            reply=resolve_reply(o.action, o.reply_text, o.link_url),
+        )
+        for o in active
+    )
+
+    by_action: Dict[str, list] = {}
+    for o in compiled:
+        by_action.setdefault(o.action or "reply", []).append(o)
+
+    return CompiledBotConfig(
+        company_id=company_id,
+        enabled=bool(setting.enabled) if setting is not None else True,
+        welcome_message=(setting.welcome_message or "") if setting is not None else "",
+        options=compiled,
+        options_by_id={o.id: o for o in compiled},
+        options_by_action={k: tuple(v) for k, v in by_action.items()},
+    )
+
+
+# key: company_id
+bot_config_cache = TTLCache("bot_config", BOT_CONFIG_CACHE_MAX, BOT_CONFIG_CACHE_TTL)
+
+
+async def _load_bot_config(db: AsyncSession, company_id: int) -> CompiledBotConfig:
+    q = await db.execute(
+        select(models.BotSetting)
+        .where(models.BotSetting.company_id == company_id)
+        .execution_options(populate_existing=True)
+    )
+    setting = q.scalar_one_or_none()
+
+    options = []
+    if setting is not None:
+        q_opt = await db.execute(
+            select(models.BotOption)
+            .where(models.BotOption.bot_setting_id == setting.id)
+            .execution_options(populate_existing=True)
+        )
+        options = q_opt.scalars().all()
+
+    config = compile_bot_config(company_id, setting, options)
+    bot_config_cache.set(company_id, config)
+    return config
+
+
+async def get_bot_config(db: AsyncSession, company_id: int) -> CompiledBotConfig:
+    """キャッシュ済みならそのまま返す。無ければ DB から組み立てる"""
+    config = bot_config_cache.get(company_id)
+    if config is not MISSING:
+        return config
+    return await _load_bot_config(db, company_id)
+
+
+async def refresh_bot_config(db: AsyncSession, company_id: int) -> CompiledBotConfig:
+    """
+    設定変更のコミット後に呼ぶ。自プロセスでは作り直し、他ワーカーには無効化を通知する。
+    """
+    await invalidate(bot_config_cache, company_id)
+    return await _load_bot_config(db, company_id)
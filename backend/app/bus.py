@@ -0,0 +1,219 @@
+# backend/app/bus.py
+import asyncio
+import json
+import os
+import uuid
+
+import socketio
+from socketio.async_pubsub_manager import AsyncPubSubManager
+
+# ==== プロセス間メッセージバス設定 ====
+# 未設定ならプロセス内の部屋管理のみ（ワーカー 1 つ前提）
+#   redis://chat-redis:6379/0  → Redis Pub/Sub
+#   amqp://guest:guest@mq//    → RabbitMQ
+#   memory://                  → プロセス内ブローカー（テスト用）
+MESSAGE_QUEUE_URL = os.getenv("MESSAGE_QUEUE_URL", "")
+MESSAGE_QUEUE_CHANNEL = os.getenv("MESSAGE_QUEUE_CHANNEL", "chat-socketio")
+
+
+class LocalPubSubManager(AsyncPubSubManager):
+    """
+    同一プロセス内の複数 AsyncServer をつなぐ Pub/Sub マネージャー。
+    Redis などを立てずに「別ノードへの配送」の経路をテストするための代替品。
+    """
+
+    name = "localpubsub"
+
+    # channel -> 購読中キューの一覧（プロセス全体で共有）
+    _subscribers: dict = {}
+
+    def __init__(self, channel="socketio", write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self._queue = None
+
+    def initialize(self):
+        if not self.write_only:
+            self._queue = asyncio.Queue()
+            self._subscribers.setdefault(self.channel, []).append(self._queue)
+        super().initialize()
+
+    async def _publish(self, data):
+        for queue in list(self._subscribers.get(self.channel, [])):
+            queue.put_nowait(data)
+
+    async def _listen(self):
+        while True:
+            yield await self._queue.get()
+
+    @classmethod
+    def reset(cls):
+        cls._subscribers.clear()
+
+
+# URL の先頭 → マネージャーを作る関数 factory(url, channel=..., write_only=...)。
+# 組み込み以外のブローカー（テスト用の中継など）は register_client_manager で足す
+_manager_factories: dict = {}
+
+
+def register_client_manager(prefix: str, factory):
+    """app.socket を import する（sio を作る）前に呼ぶこと"""
+    _manager_factories[prefix] = factory
+
+
+def create_client_manager(url: str = None, channel: str = None, write_only: bool = False):
+    """
+    MESSAGE_QUEUE_URL から Socket.IO のクライアントマネージャーを作る。
+    None を返した場合は python-socketio 既定のプロセス内マネージャーになる。
+    """
+    url = MESSAGE_QUEUE_URL if url is None else url
+    channel = channel or MESSAGE_QUEUE_CHANNEL
+
+    if not url:
+        return None
+    for prefix, factory in _manager_factories.items():
+        if url.startswith(prefix):
+            return factory(url, channel=channel, write_only=write_only)
+    if url.startswith("memory://"):
+        return LocalPubSubManager(channel=channel, write_only=write_only)
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return socketio.AsyncRedisManager(url, channel=channel, write_only=write_only)
+    if url.startswith(("amqp://", "amqps://")):
+        return socketio.AsyncAioPikaManager(url, channel=channel, write_only=write_only)
+
+    raise ValueError(f"unsupported MESSAGE_QUEUE_URL: {url}")
+
+
+# -----------------------------
+# アプリ内イベント（キャッシュ無効化など）のプロセス間通知
+# Socket.IO と同じ MESSAGE_QUEUE_URL を使う（Redis: Pub/Sub、RabbitMQ: fanout exchange）。
+# それ以外ではプロセス内のみ（ワーカー 1 つ前提。check_event_transport で確かめる）
+# -----------------------------
+EVENT_CHANNEL = f"{MESSAGE_QUEUE_CHANNEL}:events"
+# uvicorn --workers と同じ値（Dockerfile / docker-compose.yml）
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+_host_id = uuid.uuid4().hex
+
+
+class _RedisEvents:
+    def __init__(self, url: str):
+        import redis.asyncio as aioredis
+
+        self._client = aioredis.Redis.from_url(url)
+
+    async def publish(self, data: str):
+        await self._client.publish(EVENT_CHANNEL, data)
+
+    async def listen(self):
+        pubsub = self._client.pubsub()
+        try:
+            await pubsub.subscribe(EVENT_CHANNEL)
+            async for message in pubsub.listen():
+                if message.get("type") == "message":
+                    yield message["data"]
+        finally:
+            await pubsub.close()
+
+
+class _AmqpEvents:
+    """
+    fanout exchange（名前は EVENT_CHANNEL）に送り、ワーカーごとの排他キューで受け取る。
+    aio_pika は amqp:// を使うときだけ必要（Socket.IO の AsyncAioPikaManager と同じ）
+    """
+
+    def __init__(self, url: str):
+        import aio_pika
+
+        self._aio_pika = aio_pika
+        self._url = url
+        self._connection = None
+        self._exchange = None
+        self._lock = asyncio.Lock()
+
+    async def _channel(self):
+        async with self._lock:
+            if self._connection is None:
+                self._connection = await self._aio_pika.connect_robust(self._url)
+                channel = await self._connection.channel()
+                self._exchange = await channel.declare_exchange(
+                    EVENT_CHANNEL, self._aio_pika.ExchangeType.FANOUT
+                )
+            return self._exchange
+
+    async def publish(self, data: str):
+        exchange = await self._channel()
+        await exchange.publish(self._aio_pika.Message(body=data.encode("utf-8")), routing_key="")
+
+    async def listen(self):
+        exchange = await self._channel()
+        channel = await self._connection.channel()
+        try:
+            queue = await channel.declare_queue(exclusive=True, auto_delete=True)
+            await queue.bind(exchange)
+            async with queue.iterator() as messages:
+                async for message in messages:
+                    async with message.process():
+                        yield message.body
+        finally:
+            await channel.close()
+
+
+_events = None
+
+
+def _event_transport():
+    global _events
+    if _events is None:
+        if MESSAGE_QUEUE_URL.startswith(("redis://", "rediss://", "unix://")):
+            _events = _RedisEvents(MESSAGE_QUEUE_URL)
+        elif MESSAGE_QUEUE_URL.startswith(("amqp://", "amqps://")):
+            _events = _AmqpEvents(MESSAGE_QUEUE_URL)
+    return _events
+
+
+def check_event_transport():
+    """
+    ワーカーが複数なのにイベントを共有できない設定なら起動を止める（lifespan の最初に呼ぶ）。
+    キャッシュの無効化が他ワーカーに届かず、古いセッション情報を使い続けるため。
+    """
+    if WEB_CONCURRENCY > 1 and not MESSAGE_QUEUE_URL.startswith(
+        ("redis://", "rediss://", "unix://", "amqp://", "amqps://")
+    ):
+        raise RuntimeError(
+            f"WEB_CONCURRENCY={WEB_CONCURRENCY} requires MESSAGE_QUEUE_URL to be redis:// or amqp:// "
+            f"(got {MESSAGE_QUEUE_URL!r})"
+        )
+
+
+async def publish_event(event: dict):
+    """
+    他ワーカーにイベントを通知する。自プロセスには届かないので、
+    呼び出し側は自分の状態を先に更新しておくこと。
+    """
+    transport = _event_transport()
+    if transport is None:
+        return
+    try:
+        await transport.publish(json.dumps({**event, "host_id": _host_id}))
+    except Exception as e:
+        print("[bus] publish failed:", e)
+
+
+async def listen_events(handler):
+    """他ワーカーからのイベントを handler(event) に渡し続ける（lifespan で起動）"""
+    transport = _event_transport()
+    if transport is None:
+        return
+
+    while True:
+        try:
+            async for data in transport.listen():
+                event = json.loads(data)
+                if event.get("host_id") == _host_id:
+                    continue
+                handler(event)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print("[bus] event listener error, reconnecting:", e)
+            await asyncio.sleep(1)
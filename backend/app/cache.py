@@ -0,0 +1,120 @@
+# backend/app/cache.py
+import os
+import time
+from collections import OrderedDict
+from typing import Any, NamedTuple, Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models
+from .bus import publish_event
+
+# キャッシュに存在しないことを表す値（None もキャッシュしたいので別に用意）
+MISSING = object()
+
+
+class TTLCache:
+    """
+    件数上限付き LRU + TTL のプロセス内キャッシュ。
+    同じ name のキャッシュは他ワーカーからの無効化通知を受け取る。
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Any, tuple]" = OrderedDict()
+        _caches[name] = self
+
+    def get(self, key, default=MISSING):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        value, expires_at = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+_caches: dict = {}
+
+
+async def invalidate(cache: TTLCache, key):
+    """自プロセスのエントリを消し、他ワーカーにも無効化を通知する"""
+    cache.invalidate(key)
+    await publish_event({"type": "cache_invalidate", "cache": cache.name, "key": key})
+
+
+def handle_invalidation(event: dict):
+    """バス経由で届いた無効化通知を反映する（bus.listen_events のハンドラー）"""
+    if event.get("type") != "cache_invalidate":
+        return
+    cache = _caches.get(event.get("cache"))
+    if cache is not None:
+        cache.invalidate(event.get("key"))
+
+
+# -----------------------------
+# セッションのメタ情報
+# -----------------------------
+SESSION_CACHE_MAX = int(os.getenv("SESSION_CACHE_MAX", "10000"))
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", "300"))
+
+
+class SessionMeta(NamedTuple):
+    id: Any
+    company_id: Optional[int]
+    owner_user_id: int
+    status: models.SessionStatus
+
+
+# key: str(session_id)
+session_cache = TTLCache("session", SESSION_CACHE_MAX, SESSION_CACHE_TTL)
+
+
+def remember_session(session: models.Session) -> SessionMeta:
+    meta = SessionMeta(
+        id=session.id,
+        company_id=session.company_id,
+        owner_user_id=session.owner_user_id,
+        status=session.status,
+    )
+    session_cache.set(str(session.id), meta)
+    return meta
+
+
+async def get_session_meta(db: AsyncSession, session_id) -> Optional[SessionMeta]:
+    """キャッシュにあれば DB を見ずに返す。無ければ 1 回だけ SELECT してキャッシュする"""
+    meta = session_cache.get(str(session_id))
+    if meta is not MISSING:
+        return meta
+
+    result = await db.execute(
+        select(models.Session).where(models.Session.id == session_id)
+    )
+    session = result.scalar_one_or_none()
+    if session is None:
+        return None
+    return remember_session(session)
+
+
+async def forget_session(session_id):
+    await invalidate(session_cache, str(session_id))
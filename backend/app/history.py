@@ -0,0 +1,295 @@
+# backend/app/history.py
+import os
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from sqlalchemy import case, func, literal, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models
+from .thumbnails import preview_url
+from .transcripts import (
+    MESSAGE_COLUMNS,
+    find_block_message_seq,
+    load_block_messages,
+    messages_since,
+)
+
+# メッセージ履歴の 1 ページあたり件数
+MESSAGE_PAGE_DEFAULT = 50
+MESSAGE_PAGE_MAX = 200
+
+
+def serialize_message(m) -> dict:
+    """m: ORM の Message、または同じキーを持つ dict（列の SELECT 結果・圧縮ブロックの中身）"""
+    get = m.get if isinstance(m, dict) else lambda key: getattr(m, key)
+    sender_type = get("sender_type")
+    return {
+        "id": get("id"),
+        "seq": get("seq"),
+        "session_id": str(get("session_id")),
+        "sender_type": sender_type.value
+        if hasattr(sender_type, "value")
+        else str(sender_type),
+        "sender_id": get("sender_id"),
+        "content": get("content"),
+        "attachment_url": get("attachment_url"),
+        "preview_url": preview_url(get("attachment_url")),
+        "created_at": get("created_at").isoformat(),
+    }
+
+
+async def _seq_of(
+    db: AsyncSession, session_id, message_id: int, archived_through: int, since: datetime
+) -> Optional[int]:
+    seq = await db.scalar(
+        select(models.Message.seq).where(
+            models.Message.session_id == session_id,
+            models.Message.id == message_id,
+            models.Message.created_at >= since,
+        )
+    )
+    if seq is None and archived_through > 0:
+        seq = await find_block_message_seq(db, session_id, message_id)
+    return seq
+
+
+def _merge(rows: List[dict], archived: List[dict]) -> List[dict]:
+    """行と圧縮ブロックの中身を連番でつなぐ（移動中に両方にあるものは 1 つに）"""
+    by_seq = {m["seq"]: m for m in archived}
+    by_seq.update((m["seq"], m) for m in rows)
+    return [by_seq[seq] for seq in sorted(by_seq)]
+
+
+async def fetch_message_page(
+    db: AsyncSession,
+    session_id,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    limit: int = MESSAGE_PAGE_DEFAULT,
+    *,
+    before_seq: Optional[int] = None,
+    after_seq: Optional[int] = None,
+) -> List[dict]:
+    """
+    (session_id, seq) インデックスを使ったキーセットページング。
+    - before_seq / before_id: それより古いものを新しい順に limit 件
+    - after_seq / after_id  : それより新しいものを古い順に limit 件
+    - どれも無し: 最新 limit 件
+    返り値は常に古い順で、serialize_message() 済みの dict。
+    アーカイブ済み（transcript_blocks に移した）範囲は、必要なときだけブロックを展開してつなぐ。
+    """
+    session = (
+        await db.execute(
+            select(models.Session.archived_through_seq, models.Session.created_at).where(
+                models.Session.id == session_id
+            )
+        )
+    ).first()
+    if session is None:
+        return []
+    archived_through = session.archived_through_seq
+    # セッション作成より前の月のパーティションは読まない
+    since = messages_since(session.created_at)
+
+    # id のカーソル（従来のクライアント）は連番に直す
+    if after_id is not None and after_seq is None:
+        after_seq = await _seq_of(db, session_id, after_id, archived_through, since)
+        if after_seq is None:
+            return []
+    if before_id is not None and before_seq is None:
+        before_seq = await _seq_of(db, session_id, before_id, archived_through, since)
+        if before_seq is None:
+            return []
+
+    m = models.Message
+    stmt = select(*MESSAGE_COLUMNS).where(m.session_id == session_id, m.created_at >= since)
+
+    if after_seq is not None:
+        result = await db.execute(
+            stmt.where(m.seq > after_seq).order_by(m.seq.asc()).limit(limit)
+        )
+        rows = [row._asdict() for row in result.all()]
+        if after_seq < archived_through:
+            archived = await load_block_messages(
+                db, session_id, after_seq=after_seq, limit=limit
+            )
+            rows = _merge(rows, archived)[:limit]
+    else:
+        if before_seq is not None:
+            stmt = stmt.where(m.seq < before_seq)
+        result = await db.execute(stmt.order_by(m.seq.desc()).limit(limit))
+        rows = [row._asdict() for row in reversed(result.all())]
+        # 行だけで limit 件あり、すべてアーカイブ範囲より新しければブロックは見ない
+        if archived_through > 0 and (len(rows) < limit or rows[0]["seq"] <= archived_through):
+            archived = await load_block_messages(
+                db, session_id, before_seq=before_seq, limit=limit
+            )
+            rows = _merge(rows, archived)[-limit:]
+
+    for row in rows:
+        row["session_id"] = session_id
+    return [serialize_message(row) for row in rows]
+
+
+# 差分同期で一度に返す最大件数。これより離れていたら最新ページから取り直させる
+SYNC_MAX = int(os.getenv("SYNC_MAX", "500"))
+# 払い出しからこの秒数が経っても保存されていない連番は、書き込みに失敗したとみなす
+SYNC_SETTLE_SECONDS = float(os.getenv("SYNC_SETTLE_SECONDS", "60"))
+
+
+async def sync_messages(
+    db: AsyncSession,
+    session_id,
+    after_seq: int,
+    limit: int = SYNC_MAX,
+) -> Optional[dict]:
+    """
+    after_seq より後のメッセージだけを返す（再接続・取りこぼし時の差分同期）。
+    セッションが存在しなければ None。
+
+    返り値:
+      last_seq : サーバー側で払い出し済みの最大連番
+      messages : seq > after_seq のメッセージ（seq 順）
+      missing  : after_seq〜last_seq の間で、まだ保存されていない連番
+                 （書き込みパイプライン上にある分。少し待って再同期すればよい）
+      dropped  : 保存されないまま SYNC_SETTLE_SECONDS 以上経った連番（書き込みに失敗した・
+                 払い出し後に送信が取りやめられた）。もう届かないので欠けとして待たない
+      reset    : True ならクライアントの状態は使えないので messages（最新ページ）で置き換える
+    """
+    session = (
+        await db.execute(
+            select(models.Session.last_seq, models.Session.last_seq_at).where(
+                models.Session.id == session_id
+            )
+        )
+    ).first()
+    if session is None:
+        return None
+    last_seq = session.last_seq
+
+    if after_seq < 0 or after_seq > last_seq or last_seq - after_seq > limit:
+        return {
+            "reset": True,
+            "last_seq": last_seq,
+            "missing": [],
+            "dropped": [],
+            "messages": await fetch_message_page(db, session_id),
+        }
+
+    messages = []
+    if last_seq > after_seq:
+        messages = await fetch_message_page(
+            db, session_id, after_seq=after_seq, limit=last_seq - after_seq
+        )
+
+    # 連番は払い出し順に増え、created_at は払い出しの後に決まる。
+    # よって保存済みの連番 s の created_at が十分古ければ、s より前の欠番は十分前に払い出されたもの。
+    # 末尾の欠番は last_seq_at（最後の払い出し時刻）で判断する。
+    settled_before = datetime.utcnow() - timedelta(seconds=SYNC_SETTLE_SECONDS)
+    if session.last_seq_at is None or session.last_seq_at < settled_before:
+        settled_seq = last_seq
+    else:
+        settled_seq = max(
+            (
+                m["seq"]
+                for m in messages
+                if datetime.fromisoformat(m["created_at"]) < settled_before
+            ),
+            default=after_seq,
+        )
+
+    present = {m["seq"] for m in messages}
+    gaps = [n for n in range(after_seq + 1, last_seq + 1) if n not in present]
+
+    return {
+        "reset": False,
+        "last_seq": last_seq,
+        "missing": [n for n in gaps if n > settled_seq],
+        "dropped": [n for n in gaps if n <= settled_seq],
+        "messages": messages,
+    }
+
+
+async def mark_read(
+    db: AsyncSession,
+    session_id,
+    reader_user_id: int,
+    up_to_seq: Optional[int] = None,
+) -> dict:
+    """
+    reader_user_id の既読位置を up_to_seq（省略時は最新）まで進める。1 文の UPSERT のみ。
+    既読位置は後戻りしない（進まなかった場合 last_read_seq は None）。
+    呼び出し側でセッションの存在・権限を確認し、コミットすること。
+    """
+    sessions = models.Session.__table__
+    messages = models.Message.__table__
+    blocks = models.TranscriptBlock.__table__
+    reads = models.SessionRead.__table__
+
+    if up_to_seq is None:
+        seq = sessions.c.last_seq
+        visitor_count = sessions.c.visitor_message_count
+    else:
+        seq = func.least(max(0, int(up_to_seq)), sessions.c.last_seq)
+        # 既読数 = 既読位置までの訪問者メッセージ数。行（または圧縮ブロック）が持つ累計を 1 件引くだけ。
+        # 既読位置の行がまだ書き込み待ちなら、その手前の保存済みの行の累計を使う
+        # （未読数が一時的に多めに出るだけで、少なく出ることはない）
+        row_count = (
+            select(messages.c.visitor_count)
+            .where(
+                messages.c.session_id == sessions.c.id,
+                messages.c.created_at >= messages_since(sessions.c.created_at),
+                messages.c.seq <= seq,
+                messages.c.visitor_count.isnot(None),
+            )
+            .order_by(messages.c.seq.desc())
+            .limit(1)
+            .scalar_subquery()
+        )
+        block_count = (
+            select(blocks.c.visitor_count_to)
+            .where(
+                blocks.c.session_id == sessions.c.id,
+                blocks.c.seq_to <= seq,
+                blocks.c.visitor_count_to.isnot(None),
+            )
+            .order_by(blocks.c.seq_to.desc())
+            .limit(1)
+            .scalar_subquery()
+        )
+        visitor_count = case(
+            (seq >= sessions.c.last_seq, sessions.c.visitor_message_count),
+            else_=func.greatest(func.coalesce(row_count, 0), func.coalesce(block_count, 0)),
+        )
+
+    now = datetime.utcnow()
+    source = select(
+        sessions.c.id,
+        literal(reader_user_id),
+        seq,
+        visitor_count,
+        literal(now),
+    ).where(sessions.c.id == session_id)
+
+    stmt = pg_insert(reads).from_select(
+        ["session_id", "reader_user_id", "last_read_seq", "read_visitor_count", "read_at"],
+        source,
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[reads.c.session_id, reads.c.reader_user_id],
+        set_={
+            "last_read_seq": stmt.excluded.last_read_seq,
+            "read_visitor_count": stmt.excluded.read_visitor_count,
+            "read_at": stmt.excluded.read_at,
+        },
+        where=reads.c.last_read_seq < stmt.excluded.last_read_seq,
+    ).returning(reads.c.last_read_seq)
+
+    result = await db.execute(stmt)
+    return {
+        "session_id": str(session_id),
+        "last_read_seq": result.scalar_one_or_none(),
+        "read_at": now.isoformat(),
+    }
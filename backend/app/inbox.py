@@ -0,0 +1,175 @@
+# backend/app/inbox.py
+import base64
+import json
+import uuid
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional, Tuple
+
+from sqlalchemy import String, bindparam, func, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models
+
+# 受信箱の 1 ページあたり件数
+INBOX_PAGE_DEFAULT = 50
+INBOX_PAGE_MAX = 200
+
+
+def serialize_session_summary(s: models.Session, read_visitor_count: Optional[int] = 0) -> dict:
+    unread = (s.visitor_message_count or 0) - (read_visitor_count or 0)
+    return {
+        "id": str(s.id),
+        "visitor_name": s.visitor_name,
+        "visitor_identifier": s.visitor_identifier,
+        "status": s.status.value if hasattr(s.status, "value") else str(s.status),
+        "last_active_at": s.last_active_at.isoformat() if s.last_active_at else None,
+        "unread_count": max(0, int(unread)),
+        "message_count": int(s.message_count or 0),
+        "last_message_preview": s.last_message_preview,
+        "last_message_at": s.last_message_at.isoformat() if s.last_message_at else None,
+    }
+
+
+def inbox_query(user_id: int, company_id: Optional[int], handoff: bool = True):
+    """
+    管理画面の受信箱に出るセッション（担当分 × ハンドオフ状態 × メッセージあり）と既読数。
+    集計値を持っているので messages は見ない（ix_sessions_inbox の範囲走査のみ）。
+    未読数は既読ウォーターマークとの差分で求める。
+    """
+    return (
+        select(models.Session, models.SessionRead.read_visitor_count)
+        .outerjoin(
+            models.SessionRead,
+            (models.SessionRead.session_id == models.Session.id)
+            & (models.SessionRead.reader_user_id == user_id),
+        )
+        .where(
+            models.Session.owner_user_id == user_id,
+            models.Session.handoff_requested == handoff,
+            models.Session.company_id == company_id,
+            models.Session.message_count > 0,
+        )
+    )
+
+
+@dataclass(frozen=True)
+class InboxFilters:
+    status: Optional[models.SessionStatus] = None
+    handoff: bool = True
+    has_unread: Optional[bool] = None
+    # last_active_at の範囲 [since, until)
+    since: Optional[datetime] = None
+    until: Optional[datetime] = None
+    # 訪問者名の前方一致（大文字小文字を区別しない）
+    name_prefix: Optional[str] = None
+
+
+def encode_cursor(last_active_at: datetime, session_id) -> str:
+    raw = json.dumps([last_active_at.isoformat(), str(session_id)], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, uuid.UUID]:
+    """不正なカーソルは ValueError"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        ts, sid = json.loads(raw)
+        return datetime.fromisoformat(ts), uuid.UUID(sid)
+    except (TypeError, ValueError) as e:
+        raise ValueError("invalid cursor") from e
+
+
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+async def fetch_inbox_page(
+    db: AsyncSession,
+    user_id: int,
+    company_id: Optional[int],
+    filters: InboxFilters = InboxFilters(),
+    cursor: Optional[str] = None,
+    limit: int = INBOX_PAGE_DEFAULT,
+    ascending: bool = False,
+) -> dict:
+    """
+    受信箱の 1 ページ。(last_active_at, id) のキーセットページングなので、
+    何ページ目でも担当セッションの総数によらずインデックスの範囲走査 limit 件分で済む。
+    返り値: {"items": [...], "next_cursor": 次ページのカーソル or None}
+    """
+    s = models.Session
+    stmt = inbox_query(user_id, company_id, filters.handoff)
+
+    if filters.status is not None:
+        stmt = stmt.where(s.status == filters.status)
+    if filters.has_unread is not None:
+        read_count = func.coalesce(models.SessionRead.read_visitor_count, 0)
+        if filters.has_unread:
+            stmt = stmt.where(s.visitor_message_count > read_count)
+        else:
+            stmt = stmt.where(s.visitor_message_count <= read_count)
+    if filters.since is not None:
+        stmt = stmt.where(s.last_active_at >= filters.since)
+    if filters.until is not None:
+        stmt = stmt.where(s.last_active_at < filters.until)
+    if filters.name_prefix:
+        # ix_sessions_owner_visitor_name（varchar_pattern_ops）で前方一致を引く。
+        # パターンがバインド変数だとインデックスを使わないプランになり得るので定数で埋め込む
+        pattern = bindparam(
+            None,
+            _escape_like(filters.name_prefix.lower()) + "%",
+            type_=String,
+            literal_execute=True,
+        )
+        stmt = stmt.where(func.lower(s.visitor_name).like(pattern, escape="\\"))
+
+    key = tuple_(s.last_active_at, s.id)
+    if cursor:
+        cursor_key = tuple_(*decode_cursor(cursor))
+        stmt = stmt.where(key > cursor_key if ascending else key < cursor_key)
+
+    if ascending:
+        stmt = stmt.order_by(s.last_active_at.asc(), s.id.asc())
+    else:
+        stmt = stmt.order_by(s.last_active_at.desc(), s.id.desc())
+
+    # 1 件多く取って次ページの有無を判定する
+    rows = (await db.execute(stmt.limit(limit + 1))).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1][0]
+        next_cursor = encode_cursor(last.last_active_at, last.id)
+
+    return {
+        "items": [serialize_session_summary(row, read_count) for row, read_count in rows],
+        "next_cursor": next_cursor,
+    }
+
+
+async def load_inbox_entry(db: AsyncSession, session_id) -> Optional[tuple]:
+    """
+    セッション 1 件の受信箱の行を担当者から見た形で返す（差分通知用）。
+    返り値: (company_id, owner_user_id, 一覧の行 or None)。セッションが無ければ None。
+    一覧の行が None なら、そのセッションは受信箱の条件から外れている。
+    """
+    owner = (
+        await db.execute(
+            select(models.Session.company_id, models.Session.owner_user_id).where(
+                models.Session.id == session_id
+            )
+        )
+    ).first()
+    if owner is None:
+        return None
+
+    row = (
+        await db.execute(
+            inbox_query(owner.owner_user_id, owner.company_id).where(
+                models.Session.id == session_id
+            )
+        )
+    ).first()
+    summary = serialize_session_summary(row[0], row[1]) if row is not None else None
+    return owner.company_id, owner.owner_user_id, summary
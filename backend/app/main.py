@@ -1,14 +1,54 @@
 # backend/app/main.py
+import asyncio
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
 
 from .api.routes import router as core_router
-from .api import routes_upload
+from .api import routes_files, routes_search, routes_upload
 from .socket import sio
+from .message_writer import message_writer
+from .bus import check_event_transport, listen_events
+from .cache import handle_invalidation
+from .passwords import password_hasher, password_stats_loop
+from .thumbnails import thumbnailer
+from .upload_gc import upload_gc_loop
+from .message_archive import message_archive_loop, message_partition_loop
 import socketio
 
-fastapi_app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 複数ワーカーでキャッシュの無効化を共有できない設定なら起動しない
+    check_event_transport()
+    await message_writer.start()
+    await thumbnailer.start()
+    # 他ワーカーからのキャッシュ無効化通知を受け取る
+    event_listener = asyncio.create_task(listen_events(handle_invalidation))
+    # 未参照アップロードの定期掃除（advisory lock で 1 ワーカーだけが実行する）
+    upload_gc_task = asyncio.create_task(upload_gc_loop())
+    # messages の先の月のパーティション作成（起動時と定期的に。アーカイブとは別）
+    message_partition_task = asyncio.create_task(message_partition_loop())
+    # 古いセッションのアーカイブ（advisory lock で 1 ワーカーだけが実行する）
+    message_archive_task = asyncio.create_task(message_archive_loop())
+    # パスワードハッシュの待ち時間などを定期的にログに出す
+    password_stats_task = asyncio.create_task(password_stats_loop())
+    try:
+        yield
+    finally:
+        event_listener.cancel()
+        upload_gc_task.cancel()
+        message_partition_task.cancel()
+        message_archive_task.cancel()
+        password_stats_task.cancel()
+        # 未保存のメッセージを書き切ってから終了する
+        await message_writer.stop()
+        password_hasher.shutdown()
+        await thumbnailer.stop()
+
+
+fastapi_app = FastAPI(lifespan=lifespan)
 
 fastapi_app.add_middleware(
     CORSMiddleware,
@@ -22,11 +62,10 @@ fastapi_app.include_router(core_router)
 
 fastapi_app.include_router(routes_upload.router)
 
-fastapi_app.mount(
-    "/uploads",
-    StaticFiles(directory="/app/uploads"),
-    name="uploads",
-)
+fastapi_app.include_router(routes_search.router)
+
+# /uploads/...（キャッシュ前提の配信。S3 などは署名付き URL へリダイレクト）
+fastapi_app.include_router(routes_files.router)
 
 app = socketio.ASGIApp(
     sio,
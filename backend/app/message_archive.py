@@ -0,0 +1,216 @@
+# backend/app/message_archive.py
+import asyncio
+import os
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from sqlalchemy import select, text
+
+from . import models
+from .cache import forget_session
+from .db import AsyncSessionLocal
+from .partitions import drop_empty_partitions, ensure_message_partitions
+from .transcript_compaction import TranscriptCompactor
+from .transcripts import prepare_blocks, write_blocks
+
+# ==== メッセージの保存期間とアーカイブ ====
+# クローズしてからこの日数が経ったセッションのメッセージを transcript_blocks に移す（0 なら移さない）
+MESSAGE_ARCHIVE_AFTER_DAYS = float(os.getenv("MESSAGE_ARCHIVE_AFTER_DAYS", "90"))
+# 定期実行の間隔（0 なら定期実行しない）
+MESSAGE_ARCHIVE_INTERVAL = float(os.getenv("MESSAGE_ARCHIVE_INTERVAL", "3600"))
+# パーティション作成の間隔（起動時には必ず 1 回行う。0 なら起動時のみ）。
+# 書き込みが失敗しないよう、アーカイブの設定とは別に動かす
+MESSAGE_PARTITION_INTERVAL = float(os.getenv("MESSAGE_PARTITION_INTERVAL", "3600"))
+MESSAGE_ARCHIVE_BATCH = int(os.getenv("MESSAGE_ARCHIVE_BATCH", "50"))
+MESSAGE_ARCHIVE_BATCH_SLEEP = float(os.getenv("MESSAGE_ARCHIVE_BATCH_SLEEP", "0.5"))
+
+# 複数ワーカー / 複数ノードで同時に走らないようにする
+MESSAGE_ARCHIVE_LOCK_ID = 727_002
+MESSAGE_PARTITION_LOCK_ID = 727_003
+
+
+@dataclass
+class ArchiveReport:
+    dry_run: bool
+    sessions: int = 0
+    messages: int = 0
+    partitions_dropped: List[str] = field(default_factory=list)
+    # 長い会話の圧縮（期間に関係なく古い側をブロックにする）
+    compacted_sessions: int = 0
+    compacted_messages: int = 0
+    skipped: bool = False
+
+
+class MessageArchiver:
+    """
+    1. 保存期間を過ぎたクローズ済みセッションのメッセージを、圧縮した transcript_blocks に移す
+       （履歴 API はブロックを展開して従来どおり返す）
+    2. 行が多すぎるセッションの古い側を transcript_blocks に移す（TranscriptCompactor）
+    3. 保存期間より前に終わる、空になったパーティションを消す
+    先の月のパーティション作成は maintain_message_partitions（message_partition_loop）で行う。
+    """
+
+    def __init__(
+        self,
+        session_factory=AsyncSessionLocal,
+        after_days: float = MESSAGE_ARCHIVE_AFTER_DAYS,
+        batch: int = MESSAGE_ARCHIVE_BATCH,
+        batch_sleep: float = MESSAGE_ARCHIVE_BATCH_SLEEP,
+        compactor: Optional[TranscriptCompactor] = None,
+    ):
+        self._session_factory = session_factory
+        self._compactor = compactor or TranscriptCompactor(session_factory)
+        self._after_days = after_days
+        self._batch = batch
+        self._batch_sleep = batch_sleep
+
+    async def run(self, dry_run: bool = False) -> ArchiveReport:
+        report = ArchiveReport(dry_run=dry_run)
+
+        async with self._session_factory() as lock_db:
+            locked = (
+                await lock_db.execute(
+                    text("SELECT pg_try_advisory_lock(:id)"), {"id": MESSAGE_ARCHIVE_LOCK_ID}
+                )
+            ).scalar()
+            if not locked:
+                report.skipped = True
+                return report
+            try:
+                cutoff = None
+                if self._after_days > 0:
+                    cutoff = datetime.utcnow() - timedelta(days=self._after_days)
+                    await self._archive_closed(cutoff, report)
+
+                compacted = await self._compactor.run(dry_run=dry_run)
+                report.compacted_sessions = compacted.sessions
+                report.compacted_messages = compacted.messages
+
+                if cutoff is not None and not dry_run:
+                    async with self._session_factory() as db:
+                        report.partitions_dropped = await drop_empty_partitions(db, cutoff)
+                        await db.commit()
+            finally:
+                await lock_db.execute(
+                    text("SELECT pg_advisory_unlock(:id)"), {"id": MESSAGE_ARCHIVE_LOCK_ID}
+                )
+                await lock_db.commit()
+
+        return report
+
+    def _candidates(self, cutoff: datetime):
+        s = models.Session
+        return select(s.id, s.last_seq).where(
+            s.status == models.SessionStatus.CLOSED,
+            s.last_active_at < cutoff,
+            s.archived_through_seq < s.last_seq,
+        )
+
+    async def _archive_closed(self, cutoff: datetime, report: ArchiveReport):
+        s = models.Session
+        last_id = None
+        while True:
+            async with self._session_factory() as db:
+                stmt = self._candidates(cutoff).order_by(s.id).limit(self._batch)
+                if last_id is not None:
+                    stmt = stmt.where(s.id > last_id)
+                candidates = (await db.execute(stmt)).all()
+            if not candidates:
+                return
+            last_id = candidates[-1].id
+
+            for candidate in candidates:
+                if report.dry_run:
+                    report.sessions += 1
+                    continue
+                moved = await self._archive_session(candidate.id, candidate.last_seq, cutoff)
+                if moved:
+                    report.sessions += 1
+                    report.messages += moved
+
+            await asyncio.sleep(self._batch_sleep)
+
+    async def _archive_session(self, session_id, last_seq: int, cutoff: datetime) -> int:
+        """1 セッション分を移す（圧縮はロックの外で済ませ、書き込みだけを 1 トランザクションで）"""
+        s = models.Session
+        async with self._session_factory() as db:
+            pending = await prepare_blocks(db, session_id, last_seq)
+        if not pending.blocks:
+            return 0
+
+        async with self._session_factory() as db:
+            # 訪問者の発言で再オープンされる（連番の払い出しで行ロックを取る）のと競合しないようにロックして確認し直す
+            row = (
+                await db.execute(
+                    select(s.id)
+                    .where(
+                        s.id == session_id,
+                        s.status == models.SessionStatus.CLOSED,
+                        s.last_active_at < cutoff,
+                    )
+                    .with_for_update()
+                )
+            ).first()
+            if row is None:
+                return 0
+
+            moved = await write_blocks(db, pending)
+            await db.commit()
+
+        if moved:
+            await forget_session(session_id)
+        return moved
+
+
+message_archiver = MessageArchiver()
+
+
+async def message_archive_loop(interval: float = MESSAGE_ARCHIVE_INTERVAL):
+    """lifespan で起動する定期実行（interval が 0 以下なら何もしない）"""
+    if interval <= 0:
+        return
+    while True:
+        try:
+            report = await message_archiver.run()
+            if not report.skipped and (
+                report.sessions
+                or report.compacted_sessions
+                or report.partitions_dropped
+            ):
+                print("[message_archive]", asdict(report))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print("[message_archive] failed:", e)
+        await asyncio.sleep(interval)
+
+
+async def maintain_message_partitions(session_factory=AsyncSessionLocal) -> List[str]:
+    """
+    messages の月別パーティションを先の月まで作る。返り値: 作成したパーティション名
+    同時に呼んだワーカーはトランザクション単位の advisory lock で順番待ちにする（後のものは作る物が無い）
+    """
+    async with session_factory() as db:
+        await db.execute(
+            text("SELECT pg_advisory_xact_lock(:id)"), {"id": MESSAGE_PARTITION_LOCK_ID}
+        )
+        created = await ensure_message_partitions(db)
+        await db.commit()
+    return created
+
+
+async def message_partition_loop(interval: float = MESSAGE_PARTITION_INTERVAL):
+    """lifespan で起動する。起動時に 1 回作り、interval が 0 より大きければ以降も定期的に作る"""
+    while True:
+        try:
+            created = await maintain_message_partitions()
+            if created:
+                print("[message_archive] partitions created:", created)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print("[message_archive] partition upkeep failed:", e)
+        if interval <= 0:
+            return
+        await asyncio.sleep(interval)
@@ -0,0 +1,430 @@
+# backend/app/message_writer.py
+import asyncio
+import os
+from collections import deque
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import Integer, bindparam, exists, insert, text, update
+from sqlalchemy.dialects.postgresql import UUID
+
+from .db import AsyncSessionLocal
+from . import models
+
+# ==== 書き込みパイプライン設定 ====
+MESSAGE_WRITER_QUEUE_MAX = int(os.getenv("MESSAGE_WRITER_QUEUE_MAX", "10000"))
+MESSAGE_WRITER_BATCH_MAX = int(os.getenv("MESSAGE_WRITER_BATCH_MAX", "500"))
+MESSAGE_WRITER_FLUSH_MS = int(os.getenv("MESSAGE_WRITER_FLUSH_MS", "5"))
+MESSAGE_WRITER_ENQUEUE_TIMEOUT = float(os.getenv("MESSAGE_WRITER_ENQUEUE_TIMEOUT", "2.0"))
+MESSAGE_ID_BLOCK = int(os.getenv("MESSAGE_ID_BLOCK", "100"))
+
+
+MESSAGE_PREVIEW_LENGTH = 120
+
+
+def message_preview(content: Optional[str], attachment_url: Optional[str] = None) -> str:
+    """受信箱に表示する最終メッセージの抜粋"""
+    if content:
+        return content[:MESSAGE_PREVIEW_LENGTH]
+    if attachment_url:
+        return "[画像]"
+    return ""
+
+
+class MessageWriterBusy(Exception):
+    """キューが埋まったまま空かなかった（DB が追いついていない）"""
+
+
+class SeqAllocation(NamedTuple):
+    seq: int
+    # この連番までの訪問者メッセージの累計（messages.visitor_count に保存する）
+    visitor_count: int
+
+
+async def allocate_seq(db, session_id, visitor: bool = False) -> Optional[SeqAllocation]:
+    """
+    セッションのメッセージ連番を 1 つ払い出して返す。セッションが存在しなければ None。
+    訪問者のメッセージなら visitor_message_count も同じ UPDATE で進める
+    （既読ウォーターマークの未読数計算が常に last_seq と整合するように）。
+    行ロックはトランザクション終了まで続くので、呼び出し側は早めにコミットすること。
+    """
+    sessions = models.Session.__table__
+    values = {"last_seq": sessions.c.last_seq + 1, "last_seq_at": datetime.utcnow()}
+    if visitor:
+        values["visitor_message_count"] = sessions.c.visitor_message_count + 1
+
+    row = (
+        await db.execute(
+            update(sessions)
+            .where(sessions.c.id == session_id)
+            .values(**values)
+            .returning(sessions.c.last_seq, sessions.c.visitor_message_count)
+        )
+    ).first()
+    if row is None:
+        return None
+    return SeqAllocation(row.last_seq, row.visitor_message_count)
+
+
+# 複数セッションの連番を 1 文でまとめて払い出す。
+# 行ロックはセッション id 順に取る（_write の sessions 更新と同じ順番でデッドロックしない）
+_ALLOCATE_SEQS = text(
+    "WITH locked AS ("
+    "SELECT id FROM sessions WHERE id = ANY(CAST(:ids AS uuid[])) "
+    "ORDER BY id FOR NO KEY UPDATE"
+    "), req AS ("
+    "SELECT * FROM unnest(CAST(:ids AS uuid[]), CAST(:ns AS integer[]), CAST(:nvs AS integer[])) "
+    "AS r(id, n, nv)"
+    ") "
+    "UPDATE sessions s SET "
+    "last_seq = s.last_seq + req.n, "
+    "visitor_message_count = s.visitor_message_count + req.nv, "
+    "last_seq_at = :now "
+    "FROM locked JOIN req ON req.id = locked.id "
+    "WHERE s.id = locked.id "
+    "RETURNING s.id, s.last_seq, s.visitor_message_count"
+).columns(id=UUID(as_uuid=True), last_seq=Integer, visitor_message_count=Integer)
+
+
+class MessageWriter:
+    """
+    メッセージの書き込みをまとめて行うバックグラウンド処理。
+
+    - ソケットハンドラーは enqueue() で行を渡し、すぐに emit できる
+    - 数ミリ秒ごとに、溜まった行を 1 回の multi-row INSERT + 1 COMMIT で保存
+    - 同じバッチ内の sessions の集計値（last_active_at / 件数 / 最終メッセージ）
+      の更新もまとめて 1 回で行う
+    - キューは上限付きで、満杯なら enqueue() が待たされる（バックプレッシャー）。
+      空きは連番の払い出し前に確保し、書き込みが終わるまで持つ
+    - stop() でキューに残っている分を書き切ってから終了
+    - 1 件ずつのやり直しでも保存できなかった行は on_dropped(row) で通知する
+      （emit 済みなので、受け取った側で取り消してもらう）
+    - 訪問者の発言で CLOSED から OPEN に戻したセッションは、コミット後に on_reopened(ids) で通知する
+    """
+
+    def __init__(
+        self,
+        session_factory=AsyncSessionLocal,
+        queue_max: int = MESSAGE_WRITER_QUEUE_MAX,
+        batch_max: int = MESSAGE_WRITER_BATCH_MAX,
+        flush_ms: int = MESSAGE_WRITER_FLUSH_MS,
+        enqueue_timeout: float = MESSAGE_WRITER_ENQUEUE_TIMEOUT,
+        id_block: int = MESSAGE_ID_BLOCK,
+    ):
+        self._session_factory = session_factory
+        self._queue_max = queue_max
+        self._batch_max = batch_max
+        self._flush_interval = flush_ms / 1000
+        self._enqueue_timeout = enqueue_timeout
+        self._id_block = id_block
+
+        self._queue: Optional[asyncio.Queue] = None
+        # キューの空き。連番を払い出す前に確保する（満杯で積めずに連番が欠番になるのを防ぐ）
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._task: Optional[asyncio.Task] = None
+        self._ids = deque()
+        self._id_lock = asyncio.Lock()
+        # 連番の払い出し待ち（session_id, 訪問者か, Future）と、それを処理するタスク
+        self._seq_waiters: List[Tuple[object, bool, asyncio.Future]] = []
+        self._seq_task: Optional[asyncio.Task] = None
+        # 保存できなかった行の通知先（async def on_dropped(row)。socket.py で設定する）
+        self.on_dropped: Optional[Callable[[dict], Awaitable[None]]] = None
+        # OPEN に戻したセッションの通知先（async def on_reopened(session_ids)。socket.py で設定する）
+        self.on_reopened: Optional[Callable[[List[object]], Awaitable[None]]] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        if self.running:
+            return
+        self._queue = asyncio.Queue(maxsize=self._queue_max)
+        self._slots = asyncio.Semaphore(self._queue_max)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """キューに残っているメッセージを書き切ってから止める"""
+        if not self.running:
+            return
+        await self._queue.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def next_id(self) -> int:
+        """
+        messages.id を払い出す。
+        シーケンスからまとめて確保しておき、INSERT 前に id を決めて emit できるようにする。
+        """
+        if not self._ids:
+            async with self._id_lock:
+                if not self._ids:
+                    async with self._session_factory() as db:
+                        result = await db.execute(
+                            text(
+                                "SELECT nextval('messages_id_seq') "
+                                "FROM generate_series(1, :n)"
+                            ),
+                            {"n": self._id_block},
+                        )
+                        self._ids.extend(result.scalars().all())
+        return self._ids.popleft()
+
+    async def next_seq(self, session_id, visitor: bool = False) -> Optional[SeqAllocation]:
+        """
+        連番は全ワーカーで共有する必要があるので DB で払い出す。
+        1 件ずつ UPDATE・コミットせず、払い出し中に来た要求を次の 1 文（_ALLOCATE_SEQS）に
+        まとめる（グループコミットと同じ考え方。待ち時間は最大でも 1 往復分）。
+        セッションが存在しなければ None。
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._seq_waiters.append((session_id, visitor, future))
+        if self._seq_task is None or self._seq_task.done():
+            self._seq_task = asyncio.create_task(self._allocate_seqs())
+        return await future
+
+    async def _allocate_seqs(self):
+        while self._seq_waiters:
+            waiters, self._seq_waiters = self._seq_waiters, []
+            try:
+                seqs = await self._allocate_batch(waiters)
+            except Exception as e:
+                for _, _, future in waiters:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, _, future), seq in zip(waiters, seqs):
+                # 呼び出し側がキャンセル済みなら連番は欠番になる（差分同期は待ち続けない）
+                if not future.done():
+                    future.set_result(seq)
+
+    async def _allocate_batch(self, waiters) -> List[Optional[SeqAllocation]]:
+        counts: Dict[object, List[int]] = {}
+        for session_id, visitor, _ in waiters:
+            count = counts.setdefault(session_id, [0, 0])
+            count[0] += 1
+            count[1] += int(visitor)
+        ids = sorted(counts)
+
+        # 小さな UPDATE だけのトランザクションなので同期コミットは待たない
+        # （後続のメッセージ INSERT のコミットで WAL ごと永続化される）
+        async with self._session_factory() as db:
+            await db.execute(text("SET LOCAL synchronous_commit TO OFF"))
+            result = await db.execute(
+                _ALLOCATE_SEQS,
+                {
+                    "ids": ids,
+                    "ns": [counts[i][0] for i in ids],
+                    "nvs": [counts[i][1] for i in ids],
+                    "now": datetime.utcnow(),
+                },
+            )
+            rows = result.all()
+            await db.commit()
+
+        # セッションごとに n 個（訪問者分は nv 個）進めたので、要求の順に先頭から割り当てる
+        cursors = {
+            row.id: [
+                row.last_seq - counts[row.id][0],
+                row.visitor_message_count - counts[row.id][1],
+            ]
+            for row in rows
+        }
+        allocations = []
+        for session_id, visitor, _ in waiters:
+            cursor = cursors.get(session_id)
+            if cursor is None:
+                allocations.append(None)
+                continue
+            cursor[0] += 1
+            cursor[1] += int(visitor)
+            allocations.append(SeqAllocation(cursor[0], cursor[1]))
+        return allocations
+
+    async def enqueue(
+        self,
+        *,
+        session_id,
+        sender_type: models.SenderType,
+        content: str,
+        attachment_url: Optional[str] = None,
+        sender_id: Optional[int] = None,
+        reopen: bool = False,
+    ) -> Optional[dict]:
+        """
+        メッセージ 1 件を書き込みキューに積む。
+        返り値は INSERT される行（id / seq / created_at 確定済み）。
+        セッションが存在しなければ None。
+        reopen=True ならセッションを OPEN に戻す（訪問者からの発言）。
+        """
+        if not self.running:
+            raise RuntimeError("MessageWriter is not running")
+
+        # 先にキューの空きを確保する。連番を払い出した後で満杯だと分かると、その連番は欠番になる
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=self._enqueue_timeout)
+        except asyncio.TimeoutError:
+            raise MessageWriterBusy("message write queue is full")
+
+        queued = False
+        try:
+            allocation = await self.next_seq(
+                session_id, visitor=sender_type == models.SenderType.VISITOR
+            )
+            if allocation is None:
+                return None
+
+            now = datetime.utcnow()
+            row = {
+                "id": await self.next_id(),
+                "seq": allocation.seq,
+                "visitor_count": allocation.visitor_count,
+                "session_id": session_id,
+                "sender_type": sender_type,
+                "sender_id": sender_id,
+                "content": content,
+                "attachment_url": attachment_url,
+                "created_at": now,
+            }
+            # 空きは確保済みなので待たずに積める
+            self._queue.put_nowait((row, reopen))
+            queued = True
+        finally:
+            if not queued:
+                self._slots.release()
+
+        return row
+
+    async def _run(self):
+        while True:
+            item = await self._queue.get()
+            batch = [item]
+
+            # 少しだけ待って、その間に来たメッセージを同じコミットに乗せる
+            await asyncio.sleep(self._flush_interval)
+            while len(batch) < self._batch_max:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+
+            try:
+                await self._flush(batch)
+            except Exception as e:
+                print("[message_writer] flush failed:", e)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+                    self._slots.release()
+
+    async def _flush(self, batch):
+        try:
+            reopened = await self._write(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                row, reopen = batch[0]
+                if reopen:
+                    # 再オープンが競合しただけならメッセージは保存する
+                    print("[message_writer] reopen failed, saving without it:", row.get("id"), e)
+                    await self._flush([(row, False)])
+                    return
+                print("[message_writer] drop message:", row.get("id"), e)
+                await self._notify_dropped(row)
+                return
+            # 1 行の不正（存在しないセッションなど）でバッチ全体を失わないよう 1 件ずつやり直す
+            print("[message_writer] batch failed, retrying one by one:", e)
+            for item in batch:
+                await self._flush([item])
+            return
+
+        if reopened and self.on_reopened is not None:
+            try:
+                await self.on_reopened(reopened)
+            except Exception as e:
+                print("[message_writer] reopen notification failed:", e)
+
+    async def _notify_dropped(self, row: dict):
+        if self.on_dropped is None:
+            return
+        try:
+            await self.on_dropped(row)
+        except Exception as e:
+            print("[message_writer] drop notification failed:", row.get("id"), e)
+
+    async def _write(self, batch) -> List[object]:
+        """返り値: CLOSED から OPEN に戻したセッション id"""
+        rows = [row for row, _ in batch]
+
+        # セッションごとに、件数・最終メッセージをまとめる
+        summaries = {}
+        reopen_ids = set()
+        for row, reopen in batch:
+            sid = row["session_id"]
+            summary = summaries.setdefault(
+                sid, {"b_id": sid, "b_count": 0, "b_last": None}
+            )
+            summary["b_count"] += 1
+            if summary["b_last"] is None or summary["b_last"]["seq"] < row["seq"]:
+                summary["b_last"] = row
+            if reopen:
+                reopen_ids.add(sid)
+
+        params = [
+            {
+                "b_id": summary["b_id"],
+                "b_count": summary["b_count"],
+                "b_last_at": summary["b_last"]["created_at"],
+                "b_preview": message_preview(
+                    summary["b_last"]["content"], summary["b_last"]["attachment_url"]
+                ),
+            }
+            # 行ロックを取る順番をワーカー間でそろえる（バラバラだとデッドロックして 1 件ずつのやり直しになる）
+            for summary in sorted(summaries.values(), key=lambda x: x["b_id"])
+        ]
+
+        sessions = models.Session.__table__
+
+        async with self._session_factory() as db:
+            await db.execute(insert(models.Message.__table__), rows)
+
+            await db.execute(
+                update(sessions)
+                .where(sessions.c.id == bindparam("b_id"))
+                .values(
+                    last_active_at=bindparam("b_last_at"),
+                    last_message_at=bindparam("b_last_at"),
+                    last_message_preview=bindparam("b_preview"),
+                    message_count=sessions.c.message_count + bindparam("b_count"),
+                ),
+                params,
+            )
+
+            reopened = []
+            if reopen_ids:
+                # 同じ訪問者の別セッションが既に OPEN なら戻さない（ux_sessions_open_visitor）
+                other = sessions.alias("other")
+                result = await db.execute(
+                    update(sessions)
+                    .where(
+                        sessions.c.id.in_(reopen_ids),
+                        sessions.c.status != models.SessionStatus.OPEN,
+                        ~exists().where(
+                            other.c.visitor_identifier == sessions.c.visitor_identifier,
+                            other.c.owner_user_id == sessions.c.owner_user_id,
+                            other.c.status == models.SessionStatus.OPEN,
+                        ),
+                    )
+                    .values(status=models.SessionStatus.OPEN)
+                    .returning(sessions.c.id)
+                )
+                reopened = result.scalars().all()
+
+            await db.commit()
+        return reopened
+
+
+message_writer = MessageWriter()
@@ -6,6 +6,7 @@ from enum import Enum
 from sqlalchemy import (
     Column,
     Integer,
+    BigInteger,
     String,
     DateTime,
     Boolean,
@@ -13,9 +14,12 @@ from sqlalchemy import (
     Text,
     text,
     ForeignKey,
+    Index,
+    LargeBinary,
+    Sequence,
     func,
 )
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects.postgresql import ARRAY, UUID
 from sqlalchemy.orm import relationship
 
 from .db import Base
@@ -69,6 +73,8 @@ class User(Base):
         default=UserRole.ADMIN,
     )
     created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    # 進めると発行済みの JWT がすべて無効になる
+    token_version = Column(Integer, nullable=False, server_default=text("0"))
 
     company_id = Column(Integer, ForeignKey("companies.id"), nullable=True)
     company = relationship("Company", back_populates="users")
@@ -78,6 +84,39 @@ class User(Base):
 
 class Session(Base):
     __tablename__ = "sessions"
+    __table_args__ = (
+        # 管理画面の受信箱（担当者 × ハンドオフ済み × 最終更新順、(last_active_at, id) でキーセット）
+        Index(
+            "ix_sessions_inbox",
+            "owner_user_id",
+            "handoff_requested",
+            "last_active_at",
+            "id",
+        ),
+        # 受信箱をステータスで絞り込むとき
+        Index(
+            "ix_sessions_inbox_status",
+            "owner_user_id",
+            "handoff_requested",
+            "status",
+            "last_active_at",
+            "id",
+        ),
+        # 訪問者名の前方一致（lower(visitor_name) LIKE 'xx%'）
+        Index(
+            "ix_sessions_owner_visitor_name",
+            "owner_user_id",
+            text("lower(visitor_name) varchar_pattern_ops"),
+        ),
+        # 訪問者 × 担当者ごとに OPEN なセッションは 1 つだけ（ウィジェットの同時読み込み対策）
+        Index(
+            "ux_sessions_open_visitor",
+            "visitor_identifier",
+            "owner_user_id",
+            unique=True,
+            postgresql_where=text("status = 'OPEN'"),
+        ),
+    )
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     visitor_identifier = Column(String(255), nullable=False, index=True)
@@ -104,26 +143,152 @@ class Session(Base):
     handoff_requested = Column(Boolean, nullable=False, server_default=text("false"))
     handoff_requested_at = Column(DateTime, nullable=True)
 
+    # セッション内メッセージ連番の払い出し済み最大値（差分同期用）
+    last_seq = Column(Integer, nullable=False, server_default=text("0"))
+    # last_seq を最後に進めた時刻。これより十分前に払い出した連番で保存されていないものは
+    # 書き込みに失敗したとみなす（差分同期で待ち続けない）
+    last_seq_at = Column(DateTime, nullable=True)
+
+    # 受信箱表示用の集計値（メッセージ書き込み時に更新する）
+    message_count = Column(Integer, nullable=False, server_default=text("0"))
+    # 訪問者メッセージの累計（last_seq と同時に払い出すので常に整合する）
+    visitor_message_count = Column(Integer, nullable=False, server_default=text("0"))
+    last_message_preview = Column(String(255), nullable=True)
+    last_message_at = Column(DateTime, nullable=True)
+
+    # この連番までのメッセージは transcript_blocks に移してある（0 なら無し）
+    archived_through_seq = Column(Integer, nullable=False, server_default=text("0"))
+    archived_at = Column(DateTime, nullable=True)
+
 
 class Message(Base):
+    """
+    created_at の月ごとにパーティション分割する（messages_pYYYYMM。作成は partitions.py）。
+    パーティションキーを含める必要があるので主キーは (id, created_at)。
+    id は messages_id_seq から払い出すので、それだけで一意。
+    """
+
     __tablename__ = "messages"
+    __table_args__ = (
+        # 履歴のキーセットページング用（session_id 単体の検索もこれで賄う）
+        Index("ix_messages_session_created_id", "session_id", "created_at", "id"),
+        # 連番での取得（履歴・差分同期）。パーティションをまたぐ一意制約は張れないので通常のインデックス
+        Index("ix_messages_session_seq", "session_id", "seq"),
+        # 添付ファイルの参照確認用（Attachment の掃除など）
+        Index(
+            "ix_messages_attachment_url",
+            "attachment_url",
+            postgresql_where=text("attachment_url IS NOT NULL"),
+        ),
+        # 本文の部分一致検索（小文字にした文字 2-gram の配列。関数は init_db で作成する）
+        Index(
+            "ix_messages_content_bigram",
+            text("message_bigrams(content)"),
+            postgresql_using="gin",
+        ),
+        {"postgresql_partition_by": "RANGE (created_at)"},
+    )
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(
+        Integer,
+        Sequence("messages_id_seq"),
+        primary_key=True,
+        server_default=text("nextval('messages_id_seq')"),
+    )
     session_id = Column(
         UUID(as_uuid=True),
         ForeignKey("sessions.id"),
         nullable=False,
-        index=True,
     )
+    # セッション内で単調増加する連番（1 始まり）
+    seq = Column(Integer, nullable=False)
+    # この連番までの訪問者メッセージの累計（払い出し時に決まる）。既読位置から既読数を求めるのに使う
+    visitor_count = Column(Integer, nullable=True)
     sender_type = Column(SAEnum(SenderType, name="sender_types"), nullable=False)
     sender_id = Column(Integer, ForeignKey("users.id"), nullable=True)
     content = Column(Text, nullable=False)
     attachment_url = Column(String(1024), nullable=True)
+    created_at = Column(DateTime, primary_key=True, nullable=False, default=datetime.utcnow)
+    session = relationship("Session", back_populates="messages")
+
+
+class TranscriptBlock(Base):
+    """
+    セッションの古いメッセージを連番の範囲ごとにまとめて圧縮したもの（作成後は変更しない）。
+    payload は codec（transcripts.py）で圧縮した JSON 配列。
+    履歴 API は、この範囲を messages の行と同じ形に戻してつなげて返す。
+    """
+
+    __tablename__ = "transcript_blocks"
+    __table_args__ = (
+        Index("ux_transcript_blocks_session_seq", "session_id", "seq_from", unique=True),
+        # 添付ファイルの参照確認用（未参照アップロードの掃除）
+        Index("ix_transcript_blocks_attachment_urls", "attachment_urls", postgresql_using="gin"),
+        # メッセージ検索（本文の 2-gram。messages の ix_messages_content_bigram と同じ考え方）
+        Index("ix_transcript_blocks_search_grams", "search_grams", postgresql_using="gin"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    session_id = Column(UUID(as_uuid=True), ForeignKey("sessions.id"), nullable=False)
+    seq_from = Column(Integer, nullable=False)
+    seq_to = Column(Integer, nullable=False)
+    message_count = Column(Integer, nullable=False)
+    first_created_at = Column(DateTime, nullable=False)
+    last_created_at = Column(DateTime, nullable=False)
+    # ブロック内のメッセージ id の最小・最大（id からブロックを引く。古いブロックは NULL）
+    id_from = Column(Integer, nullable=True)
+    id_to = Column(Integer, nullable=True)
+    # seq_to までの訪問者メッセージの累計（Message.visitor_count と同じ意味）
+    visitor_count_to = Column(Integer, nullable=True)
+    codec = Column(String(16), nullable=False)
+    payload = Column(LargeBinary, nullable=False)
+    attachment_urls = Column(ARRAY(String(1024)), nullable=False, server_default=text("'{}'"))
+    # ブロック内の本文の 2-gram（小文字。ngrams.text_bigrams）。検索の候補を絞るのに使う（古いブロックは NULL）
+    search_grams = Column(ARRAY(Text), nullable=True)
     created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
-    is_read = Column(Boolean, nullable=False, server_default=text("false"))
-    read_at = Column(DateTime(timezone=False), nullable=True)
 
-    session = relationship("Session", back_populates="messages")
+
+class SessionRead(Base):
+    """
+    既読の位置（ウォーターマーク）。オペレーターごと・セッションごとに 1 行。
+    未読数 = sessions.visitor_message_count - read_visitor_count
+    """
+
+    __tablename__ = "session_reads"
+
+    session_id = Column(
+        UUID(as_uuid=True),
+        ForeignKey("sessions.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    reader_user_id = Column(
+        Integer,
+        ForeignKey("users.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    last_read_seq = Column(Integer, nullable=False, server_default=text("0"))
+    # last_read_seq 時点での訪問者メッセージ累計
+    read_visitor_count = Column(Integer, nullable=False, server_default=text("0"))
+    read_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+class Attachment(Base):
+    """
+    アップロードされたファイル（内容の sha256 で保存先が決まる）。
+    同じ内容・拡張子のアップロードは同じ行 / 同じファイルを指す。
+    メッセージからは messages.attachment_url == url で参照される。
+    """
+
+    __tablename__ = "attachments"
+
+    id = Column(Integer, primary_key=True)
+    sha256 = Column(String(64), nullable=False, index=True)
+    url = Column(String(1024), nullable=False, unique=True)
+    size_bytes = Column(BigInteger, nullable=False)
+    content_type = Column(String(255), nullable=True)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    # 最後に同じ内容がアップロードされた時刻（未参照ファイルの猶予期間の起点）
+    last_uploaded_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
 
 class ApiKey(Base):
     __tablename__ = "api_keys"
@@ -0,0 +1,18 @@
+# backend/app/ngrams.py
+from typing import Iterable, List, Set
+
+# メッセージ検索で使う文字 n-gram。
+# Postgres 側の message_bigrams()（scripts/init_db.py）と同じく、小文字にした本文の 2-gram
+NGRAM = 2
+
+
+def ngrams(text: str, n: int = NGRAM) -> Set[str]:
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def text_bigrams(texts: Iterable[str]) -> List[str]:
+    """複数の本文の 2-gram をまとめたもの（transcript_blocks.search_grams に保存する）"""
+    grams: Set[str] = set()
+    for text in texts:
+        grams |= ngrams((text or "").lower())
+    return sorted(grams)
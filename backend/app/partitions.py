@@ -0,0 +1,143 @@
+# backend/app/partitions.py
+import os
+import re
+from datetime import datetime
+from typing import List, NamedTuple, Optional
+
+from sqlalchemy import text
+
+# ==== messages の月別パーティション ====
+# 何か月先まで作っておくか（月が変わる前に次の月のパーティションがあるように）
+MESSAGE_PARTITION_MONTHS_AHEAD = int(os.getenv("MESSAGE_PARTITION_MONTHS_AHEAD", "2"))
+
+MESSAGES_TABLE = "messages"
+DEFAULT_PARTITION = "messages_default"
+
+_BOUND_RE = re.compile(r"FROM \((.+?)\) TO \((.+?)\)")
+
+
+class Partition(NamedTuple):
+    name: str
+    # None は MINVALUE / MAXVALUE（と DEFAULT パーティション）
+    lower: Optional[datetime]
+    upper: Optional[datetime]
+    is_default: bool
+
+
+def month_start(dt: datetime) -> datetime:
+    return datetime(dt.year, dt.month, 1)
+
+
+def add_months(dt: datetime, months: int) -> datetime:
+    index = dt.year * 12 + dt.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: datetime) -> str:
+    return f"{MESSAGES_TABLE}_p{month:%Y%m}"
+
+
+def _parse_bound(value: str) -> Optional[datetime]:
+    value = value.strip()
+    if value in ("MINVALUE", "MAXVALUE"):
+        return None
+    return datetime.fromisoformat(value.strip("'"))
+
+
+async def list_partitions(db) -> List[Partition]:
+    """db は AsyncSession / AsyncConnection のどちらでもよい"""
+    rows = (
+        await db.execute(
+            text(
+                "SELECT c.relname AS name, pg_get_expr(c.relpartbound, c.oid) AS bound "
+                "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = CAST(:parent AS regclass)"
+            ),
+            {"parent": MESSAGES_TABLE},
+        )
+    ).all()
+
+    partitions = []
+    for row in rows:
+        if row.bound == "DEFAULT":
+            partitions.append(Partition(row.name, None, None, True))
+            continue
+        m = _BOUND_RE.search(row.bound or "")
+        if not m:
+            continue
+        partitions.append(
+            Partition(row.name, _parse_bound(m.group(1)), _parse_bound(m.group(2)), False)
+        )
+    return partitions
+
+
+def _overlaps(p: Partition, lower: datetime, upper: datetime) -> bool:
+    if p.is_default:
+        return False
+    return (p.lower is None or p.lower < upper) and (p.upper is None or lower < p.upper)
+
+
+async def ensure_message_partitions(
+    db, now: Optional[datetime] = None, months_ahead: int = MESSAGE_PARTITION_MONTHS_AHEAD
+) -> List[str]:
+    """
+    今月から months_ahead か月先までの月別パーティションと、DEFAULT パーティションを用意する。
+    既存のパーティション（移行元の messages_legacy など）と範囲が重なる月は作らない。
+    返り値: 作成したパーティション名
+    """
+    partitions = await list_partitions(db)
+    created = []
+
+    if not any(p.is_default for p in partitions):
+        await db.execute(
+            text(f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF {MESSAGES_TABLE} DEFAULT")
+        )
+        created.append(DEFAULT_PARTITION)
+
+    start = month_start(now or datetime.utcnow())
+    for i in range(months_ahead + 1):
+        lower = add_months(start, i)
+        upper = add_months(lower, 1)
+        if any(_overlaps(p, lower, upper) for p in partitions):
+            continue
+
+        # DEFAULT に同じ範囲の行があると作れない（時計のずれなど）。その月は DEFAULT のままにする
+        stray = await db.scalar(
+            text(
+                f"SELECT 1 FROM {DEFAULT_PARTITION} "
+                "WHERE created_at >= :lower AND created_at < :upper LIMIT 1"
+            ),
+            {"lower": lower, "upper": upper},
+        )
+        if stray:
+            print("[partitions] rows in default partition, skip:", partition_name(lower))
+            continue
+
+        await db.execute(
+            text(
+                f"CREATE TABLE IF NOT EXISTS {partition_name(lower)} "
+                f"PARTITION OF {MESSAGES_TABLE} "
+                f"FOR VALUES FROM ('{lower.isoformat()}') TO ('{upper.isoformat()}')"
+            )
+        )
+        created.append(partition_name(lower))
+
+    return created
+
+
+async def drop_empty_partitions(db, older_than: datetime) -> List[str]:
+    """
+    older_than より前で終わる空のパーティションを消す
+    （保存期間を過ぎたセッションをアーカイブし終えた月）。
+    """
+    dropped = []
+    for p in await list_partitions(db):
+        if p.is_default or p.upper is None or p.upper > older_than:
+            continue
+        has_rows = await db.scalar(text(f'SELECT 1 FROM "{p.name}" LIMIT 1'))
+        if has_rows:
+            continue
+        await db.execute(text(f'ALTER TABLE {MESSAGES_TABLE} DETACH PARTITION "{p.name}"'))
+        await db.execute(text(f'DROP TABLE "{p.name}"'))
+        dropped.append(p.name)
+    return dropped
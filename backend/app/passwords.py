@@ -0,0 +1,127 @@
+# backend/app/passwords.py
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# ==== パスワードハッシュ処理の設定 ====
+# bcrypt は 1 回数十ミリ秒 CPU を使うので、イベントループの外（スレッド）で実行する
+# （bcrypt は計算中 GIL を手放すのでスレッドで並列に動く）
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+# 実行待ちの上限。超えたら PasswordHasherBusy（ログイン連打で待ち行列が伸び続けないように）
+PASSWORD_HASH_QUEUE_MAX = int(os.getenv("PASSWORD_HASH_QUEUE_MAX", "64"))
+# これ以上待たされたらログに出す
+PASSWORD_HASH_SLOW_WAIT_MS = float(os.getenv("PASSWORD_HASH_SLOW_WAIT_MS", "200"))
+# stats() をログに出す間隔（秒。0 なら出さない）
+PASSWORD_HASH_STATS_INTERVAL = float(os.getenv("PASSWORD_HASH_STATS_INTERVAL", "300"))
+
+
+class PasswordHasherBusy(Exception):
+    """ハッシュ処理の待ち行列が埋まっている"""
+
+
+class PasswordHasher:
+    """
+    bcrypt の計算を上限付きのスレッドプールで行う。
+
+    - 同時実行数は workers まで（セマフォ）
+    - 待ちが queue_max を超えたら即座に PasswordHasherBusy
+    - 待ち時間 / 実行時間を stats() で確認できる（password_stats_loop が定期的にログに出す）
+    """
+
+    def __init__(
+        self,
+        workers: int = PASSWORD_HASH_WORKERS,
+        queue_max: int = PASSWORD_HASH_QUEUE_MAX,
+        slow_wait_ms: float = PASSWORD_HASH_SLOW_WAIT_MS,
+    ):
+        self._workers = max(1, workers)
+        self._queue_max = queue_max
+        self._slow_wait = slow_wait_ms / 1000
+        self._executor = None
+        self._semaphore = None
+        self._waiting = 0
+
+        self._calls = 0
+        self._rejected = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._run_total = 0.0
+
+    def _ensure_started(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self._workers, thread_name_prefix="password-hash"
+            )
+            self._semaphore = asyncio.Semaphore(self._workers)
+
+    async def run(self, func, *args):
+        self._ensure_started()
+        if self._waiting >= self._queue_max:
+            self._rejected += 1
+            raise PasswordHasherBusy("password hashing queue is full")
+
+        queued_at = time.monotonic()
+        self._waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self._waiting -= 1
+
+        semaphore = self._semaphore
+        started_at = time.monotonic()
+        wait = started_at - queued_at
+        self._wait_total += wait
+        self._wait_max = max(self._wait_max, wait)
+        if wait > self._slow_wait:
+            print(f"[passwords] waited {wait * 1000:.0f}ms for a hashing slot")
+
+        def finished(_future):
+            self._calls += 1
+            self._run_total += time.monotonic() - started_at
+            semaphore.release()
+
+        try:
+            future = asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        except BaseException:
+            semaphore.release()
+            raise
+        # 呼び出し側がキャンセルされてもスレッドの計算は止まらないので、
+        # 枠はスレッドが終わったときに返す（キャンセルで同時実行数が workers を超えないように）
+        future.add_done_callback(finished)
+        return await asyncio.shield(future)
+
+    def stats(self) -> dict:
+        calls = self._calls or 1
+        return {
+            "workers": self._workers,
+            "waiting": self._waiting,
+            "calls": self._calls,
+            "rejected": self._rejected,
+            "avg_wait_ms": round(self._wait_total / calls * 1000, 2),
+            "max_wait_ms": round(self._wait_max * 1000, 2),
+            "avg_run_ms": round(self._run_total / calls * 1000, 2),
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+            self._semaphore = None
+
+
+password_hasher = PasswordHasher()
+
+
+async def password_stats_loop(interval: float = PASSWORD_HASH_STATS_INTERVAL):
+    """lifespan で起動する。前回から呼び出し・拒否があったときだけ stats() をログに出す"""
+    if interval <= 0:
+        return
+    last = None
+    while True:
+        await asyncio.sleep(interval)
+        stats = password_hasher.stats()
+        current = (stats["calls"], stats["rejected"])
+        if current != last:
+            print("[passwords]", stats)
+            last = current
@@ -0,0 +1,48 @@
+# backend/app/scripts/archive_messages.py
+# メッセージのアーカイブ・長い会話の圧縮とパーティションの作成・削除を手動で実行する
+#   python -m app.scripts.archive_messages --dry-run
+import argparse
+import asyncio
+import json
+from dataclasses import asdict
+
+from app.message_archive import (
+    MESSAGE_ARCHIVE_AFTER_DAYS,
+    MESSAGE_ARCHIVE_BATCH,
+    MESSAGE_ARCHIVE_BATCH_SLEEP,
+    MessageArchiver,
+    maintain_message_partitions,
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="保存期間を過ぎたクローズ済みセッションのメッセージを transcript_blocks に移す"
+    )
+    parser.add_argument("--dry-run", action="store_true", help="移さず対象のセッション数だけ表示する")
+    parser.add_argument("--after-days", type=float, default=MESSAGE_ARCHIVE_AFTER_DAYS)
+    parser.add_argument("--batch", type=int, default=MESSAGE_ARCHIVE_BATCH)
+    parser.add_argument("--sleep", type=float, default=MESSAGE_ARCHIVE_BATCH_SLEEP)
+    return parser.parse_args()
+
+
+async def main():
+    args = parse_args()
+    archiver = MessageArchiver(
+        after_days=args.after_days,
+        batch=args.batch,
+        batch_sleep=args.sleep,
+    )
+    if not args.dry_run:
+        created = await maintain_message_partitions()
+        print("partitions created:", created)
+
+    report = await archiver.run(dry_run=args.dry_run)
+    if report.skipped:
+        print("↩️ another archiver is running")
+        return
+    print(json.dumps(asdict(report), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,41 @@
+# backend/app/scripts/gc_uploads.py
+# 未参照アップロードの掃除を手動で実行する
+#   python -m app.scripts.gc_uploads --dry-run
+import argparse
+import asyncio
+import json
+from dataclasses import asdict
+
+from app.upload_gc import (
+    UPLOAD_GC_BATCH,
+    UPLOAD_GC_BATCH_SLEEP,
+    UPLOAD_GC_GRACE_HOURS,
+    UploadGarbageCollector,
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="どのメッセージからも参照されていないアップロードを削除する")
+    parser.add_argument("--dry-run", action="store_true", help="削除せず対象だけ表示する")
+    parser.add_argument("--grace-hours", type=float, default=UPLOAD_GC_GRACE_HOURS)
+    parser.add_argument("--batch", type=int, default=UPLOAD_GC_BATCH)
+    parser.add_argument("--sleep", type=float, default=UPLOAD_GC_BATCH_SLEEP)
+    return parser.parse_args()
+
+
+async def main():
+    args = parse_args()
+    gc = UploadGarbageCollector(
+        grace_hours=args.grace_hours,
+        batch=args.batch,
+        batch_sleep=args.sleep,
+    )
+    report = await gc.run(dry_run=args.dry_run)
+    if report.skipped:
+        print("↩️ another GC is running")
+        return
+    print(json.dumps(asdict(report), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,7 +1,10 @@
 # backend/app/scripts/init_db.py
 import asyncio
-from sqlalchemy import select
+from datetime import datetime
+from sqlalchemy import select, text
 from app import models
+from app.message_writer import MESSAGE_PREVIEW_LENGTH
+from app.partitions import add_months, ensure_message_partitions, month_start
 from app.db import engine, AsyncSessionLocal
 from app.auth import get_password_hash
 
@@ -9,9 +12,221 @@ ADMIN_EMAIL = "admin@example.com"
 ADMIN_PASSWORD = "password"
 COMPANY_NAME = "Demo Company"
 
+# create_all は既存テーブルを変更しないため、既存 DB 向けの変更はここに追記する（冪等な SQL のみ）
+SCHEMA_PATCHES = [
+    "CREATE INDEX IF NOT EXISTS ix_messages_session_created_id "
+    "ON messages (session_id, created_at, id)",
+    "DROP INDEX IF EXISTS ix_messages_session_id",
+    # メッセージ連番（差分同期）
+    "ALTER TABLE sessions ADD COLUMN IF NOT EXISTS last_seq INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE messages ADD COLUMN IF NOT EXISTS seq INTEGER",
+    "UPDATE messages m SET seq = r.rn "
+    "FROM (SELECT id, row_number() OVER (PARTITION BY session_id ORDER BY created_at, id) AS rn "
+    "FROM messages) r "
+    "WHERE m.id = r.id AND m.seq IS NULL",
+    "UPDATE sessions s SET last_seq = c.max_seq "
+    "FROM (SELECT session_id, max(seq) AS max_seq FROM messages GROUP BY session_id) c "
+    "WHERE s.id = c.session_id AND s.last_seq < c.max_seq",
+    "ALTER TABLE messages ALTER COLUMN seq SET NOT NULL",
+    # パーティション分割前の表にだけ張る（分割後は ix_messages_session_seq）
+    "DO $$ BEGIN "
+    "IF (SELECT relkind FROM pg_class WHERE oid = 'messages'::regclass) = 'r' THEN "
+    "CREATE UNIQUE INDEX IF NOT EXISTS ux_messages_session_seq ON messages (session_id, seq); "
+    "END IF; END $$",
+    # 受信箱用の集計値
+    "ALTER TABLE sessions ADD COLUMN IF NOT EXISTS message_count INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE sessions ADD COLUMN IF NOT EXISTS last_message_preview VARCHAR(255)",
+    "ALTER TABLE sessions ADD COLUMN IF NOT EXISTS last_message_at TIMESTAMP WITHOUT TIME ZONE",
+    "UPDATE sessions s SET "
+    "message_count = c.cnt, last_message_at = c.last_at "
+    "FROM (SELECT session_id, count(*) AS cnt, max(created_at) AS last_at "
+    "FROM messages GROUP BY session_id) c "
+    "WHERE s.id = c.session_id AND s.message_count = 0",
+    # 最終メッセージの抜粋は message_preview() と同じ（本文 → 添付なら [画像] → 空）。
+    # 以前の版が本文も添付も無いメッセージに付けた '[画像]' もここで直す
+    "UPDATE sessions s SET last_message_preview = m.preview "
+    "FROM (SELECT DISTINCT ON (session_id) session_id, CASE "
+    f"WHEN content <> '' THEN left(content, {MESSAGE_PREVIEW_LENGTH}) "
+    "WHEN attachment_url <> '' THEN '[画像]' ELSE '' END AS preview FROM messages "
+    "ORDER BY session_id, created_at DESC, id DESC) m "
+    "WHERE s.id = m.session_id AND (s.last_message_preview IS NULL "
+    "OR (s.last_message_preview = '[画像]' AND m.preview <> '[画像]'))",
+    "CREATE INDEX IF NOT EXISTS ix_sessions_owner_handoff_active "
+    "ON sessions (owner_user_id, handoff_requested, last_active_at)",
+    # 既読ウォーターマーク（messages.is_read / read_at からの移行）
+    "ALTER TABLE sessions ADD COLUMN IF NOT EXISTS visitor_message_count INTEGER NOT NULL DEFAULT 0",
+    "UPDATE sessions s SET visitor_message_count = c.cnt "
+    "FROM (SELECT session_id, count(*) AS cnt FROM messages "
+    "WHERE sender_type = 'VISITOR' GROUP BY session_id) c "
+    "WHERE s.id = c.session_id AND s.visitor_message_count = 0",
+    "DO $$ BEGIN "
+    "IF EXISTS (SELECT 1 FROM information_schema.columns "
+    "WHERE table_name = 'messages' AND column_name = 'is_read') THEN "
+    "INSERT INTO session_reads (session_id, reader_user_id, last_read_seq, read_visitor_count, read_at) "
+    "SELECT s.id, s.owner_user_id, COALESCE(max(m.seq), 0), count(m.id), "
+    "COALESCE(max(m.read_at), now() AT TIME ZONE 'utc') "
+    "FROM sessions s JOIN messages m ON m.session_id = s.id "
+    "AND m.sender_type = 'VISITOR' AND m.is_read "
+    "GROUP BY s.id, s.owner_user_id "
+    "ON CONFLICT DO NOTHING; "
+    "END IF; END $$",
+    "ALTER TABLE messages DROP COLUMN IF EXISTS is_read",
+    "ALTER TABLE messages DROP COLUMN IF EXISTS read_at",
+    "ALTER TABLE sessions DROP COLUMN IF EXISTS unread_visitor_count",
+    # 重複した OPEN セッションは最終更新が新しいもの以外を CLOSED にしてから一意化
+    "UPDATE sessions s SET status = 'CLOSED' "
+    "WHERE s.status = 'OPEN' AND EXISTS ("
+    "SELECT 1 FROM sessions d "
+    "WHERE d.visitor_identifier = s.visitor_identifier "
+    "AND d.owner_user_id = s.owner_user_id AND d.status = 'OPEN' "
+    "AND (d.last_active_at, d.id) > (s.last_active_at, s.id))",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ux_sessions_open_visitor "
+    "ON sessions (visitor_identifier, owner_user_id) WHERE status = 'OPEN'",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS token_version INTEGER NOT NULL DEFAULT 0",
+    "CREATE INDEX IF NOT EXISTS ix_messages_attachment_url "
+    "ON messages (attachment_url) WHERE attachment_url IS NOT NULL",
+    # 受信箱の絞り込み・キーセットページング
+    "CREATE INDEX IF NOT EXISTS ix_sessions_inbox "
+    "ON sessions (owner_user_id, handoff_requested, last_active_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_sessions_inbox_status "
+    "ON sessions (owner_user_id, handoff_requested, status, last_active_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_sessions_owner_visitor_name "
+    "ON sessions (owner_user_id, lower(visitor_name) varchar_pattern_ops)",
+    "DROP INDEX IF EXISTS ix_sessions_owner_handoff_active",
+    # メッセージ検索（大きな既存テーブルでは事前に CREATE INDEX CONCURRENTLY で作っておくこと）。
+    # pg_trgm は 3 文字未満の語に効かないので、2-gram の配列に置き換える
+    "CREATE INDEX IF NOT EXISTS ix_messages_content_bigram "
+    "ON messages USING gin (message_bigrams(content))",
+    "DROP INDEX IF EXISTS ix_messages_content_trgm",
+    # メッセージのアーカイブ（transcript_blocks に移した連番の上限）
+    "ALTER TABLE sessions ADD COLUMN IF NOT EXISTS archived_through_seq INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE sessions ADD COLUMN IF NOT EXISTS archived_at TIMESTAMP WITHOUT TIME ZONE",
+    # 連番の払い出し時刻（差分同期で保存に失敗した連番を見分ける）
+    "ALTER TABLE sessions ADD COLUMN IF NOT EXISTS last_seq_at TIMESTAMP WITHOUT TIME ZONE",
+    # 連番ごとの訪問者メッセージ累計（既読数は既読位置の累計で決まる）。
+    # アーカイブ済みのセッションは途中から数えられないので埋めない（未読数は多めに出る）
+    "ALTER TABLE messages ADD COLUMN IF NOT EXISTS visitor_count INTEGER",
+    "ALTER TABLE transcript_blocks ADD COLUMN IF NOT EXISTS visitor_count_to INTEGER",
+    "UPDATE messages m SET visitor_count = r.vc "
+    "FROM (SELECT x.id, x.created_at, count(*) FILTER (WHERE x.sender_type = 'VISITOR') "
+    "OVER (PARTITION BY x.session_id ORDER BY x.seq) AS vc "
+    "FROM messages x JOIN sessions s ON s.id = x.session_id "
+    "WHERE s.archived_through_seq = 0) r "
+    "WHERE m.id = r.id AND m.created_at = r.created_at AND m.visitor_count IS NULL",
+    # ブロック内のメッセージ id の範囲（既存のブロックは NULL のまま。id からの検索は総当たりになる）
+    "ALTER TABLE transcript_blocks ADD COLUMN IF NOT EXISTS id_from INTEGER",
+    "ALTER TABLE transcript_blocks ADD COLUMN IF NOT EXISTS id_to INTEGER",
+    # ブロックの中のメッセージ検索（既存のブロックは NULL のまま。検索時に展開して確かめる）
+    "ALTER TABLE transcript_blocks ADD COLUMN IF NOT EXISTS search_grams TEXT[]",
+    "CREATE INDEX IF NOT EXISTS ix_transcript_blocks_search_grams "
+    "ON transcript_blocks USING gin (search_grams)",
+]
+
+# メッセージ検索のインデックス（ix_messages_content_bigram）の式。
+# 小文字にした本文の文字 2-gram（重複なし）。ngrams.py の ngrams()（2-gram）と同じものを返すこと
+MESSAGE_BIGRAMS_FUNCTION = (
+    "CREATE OR REPLACE FUNCTION message_bigrams(content text) RETURNS text[] "
+    "LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE AS $$ "
+    "SELECT coalesce(array_agg(DISTINCT substr(l.s, i, 2)), '{}') "
+    "FROM (SELECT lower(content) AS s) l, generate_series(1, char_length(l.s) - 1) AS i "
+    "$$"
+)
+
+# 分割前の messages を messages_legacy に改名し、パーティション分割した messages の
+# 1 パーティション（来月の初めまで）として取り込む。行はコピーしない。
+#
+# 時間のかかる処理は、書き込みを止めずに済む準備段階（PARTITION_PREPARE）で先に済ませる:
+#   - 新しい主キー・インデックスは CREATE INDEX CONCURRENTLY で作る（トランザクション外で実行）
+#   - 範囲の CHECK 制約は NOT VALID で付けてから VALIDATE する（検証中も読み書きできる）
+#     ATTACH と SET NOT NULL はこの制約があるので表を読まない
+#   範囲の上限を来月の初めにするのは、準備中に書かれる行も制約を満たすようにするため
+#   （月末ぎりぎりに実行しないこと）。
+# そのあとの改名・ATTACH（PARTITION_MIGRATION / PARTITION_ATTACH）は 1 トランザクションで
+# ACCESS EXCLUSIVE ロックを取るが、カタログの変更だけなので短い。
+# ただし実行中のクエリが終わるまでロックを待つので、その間 messages への読み書きは止まる。
+# 長いクエリ（集計・バックアップ）が走っていない時間帯に実行すること。
+PARTITION_PREPARE = [
+    # 親の主キー (id, created_at) に対応するもの
+    "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS messages_legacy_pkey "
+    "ON messages (id, created_at)",
+    # 親の ix_messages_session_seq は一意ではないので、一意インデックスでは代わりにならない
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS messages_legacy_session_seq_idx "
+    "ON messages (session_id, seq)",
+    "DO $$ BEGIN "
+    "IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'messages_legacy_range') THEN "
+    "ALTER TABLE messages ADD CONSTRAINT messages_legacy_range "
+    "CHECK (created_at IS NOT NULL AND created_at < :bound) NOT VALID; "
+    "END IF; END $$",
+    "ALTER TABLE messages VALIDATE CONSTRAINT messages_legacy_range",
+]
+
+PARTITION_MIGRATION = [
+    "ALTER SEQUENCE messages_id_seq OWNED BY NONE",
+    "ALTER TABLE messages DROP CONSTRAINT IF EXISTS messages_pkey",
+    "ALTER TABLE messages RENAME TO messages_legacy",
+    "ALTER INDEX IF EXISTS ix_messages_session_created_id RENAME TO messages_legacy_session_created_id",
+    "ALTER INDEX IF EXISTS ux_messages_session_seq RENAME TO messages_legacy_session_seq",
+    "ALTER INDEX IF EXISTS ix_messages_attachment_url RENAME TO messages_legacy_attachment_url",
+    "ALTER INDEX IF EXISTS ix_messages_content_bigram RENAME TO messages_legacy_content_bigram",
+    "ALTER INDEX IF EXISTS ix_messages_id RENAME TO messages_legacy_id",
+]
+
+PARTITION_ATTACH = [
+    "ALTER TABLE messages_legacy ADD PRIMARY KEY USING INDEX messages_legacy_pkey",
+    "ALTER TABLE messages ATTACH PARTITION messages_legacy "
+    "FOR VALUES FROM (MINVALUE) TO (:bound)",
+    "ALTER TABLE messages_legacy DROP CONSTRAINT messages_legacy_range",
+    "SELECT setval('messages_id_seq', GREATEST((SELECT max(id) FROM messages), 1))",
+]
+
+
+async def messages_partitioned(conn) -> bool:
+    relkind = await conn.scalar(
+        text("SELECT relkind FROM pg_class WHERE oid = 'messages'::regclass")
+    )
+    return relkind != "r"
+
+
+def _with_bound(sql: str, bound: str) -> str:
+    # DDL はバインド変数を受け付けないので、範囲の上限は定数で埋め込む
+    return sql.replace(":bound", bound)
+
+
+async def prepare_messages_partitions(bound: str):
+    """CONCURRENTLY はトランザクション内で実行できないので autocommit の接続で流す"""
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        for sql in PARTITION_PREPARE:
+            await conn.execute(text(_with_bound(sql, bound)))
+
+
+async def migrate_messages_partitions(conn, bound: str):
+    for sql in PARTITION_MIGRATION:
+        await conn.execute(text(sql))
+    # messages_id_seq や enum は既存のものを使う
+    await conn.run_sync(lambda c: models.Message.__table__.create(c, checkfirst=True))
+
+    for sql in PARTITION_ATTACH:
+        await conn.execute(text(_with_bound(sql, bound)))
+    print("✅ messages partitioned (legacy rows kept in messages_legacy)")
+
 async def main():
     async with engine.begin() as conn:
+        # create_all で作るインデックスが使う関数
+        await conn.execute(text(MESSAGE_BIGRAMS_FUNCTION))
         await conn.run_sync(models.Base.metadata.create_all)
+        for sql in SCHEMA_PATCHES:
+            await conn.execute(text(sql))
+        partitioned = await messages_partitioned(conn)
+
+    if not partitioned:
+        bound = f"'{add_months(month_start(datetime.utcnow()), 1).isoformat()}'"
+        await prepare_messages_partitions(bound)
+        async with engine.begin() as conn:
+            await migrate_messages_partitions(conn, bound)
+
+    async with engine.begin() as conn:
+        await ensure_message_partitions(conn)
     print("✅ DB tables created")
 
     async with AsyncSessionLocal() as db:
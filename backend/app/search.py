@@ -0,0 +1,480 @@
+# backend/app/search.py
+import asyncio
+import os
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy import String, Text, bindparam, func, or_, select
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models
+from .message_writer import MESSAGE_ID_BLOCK
+from .ngrams import NGRAM, ngrams
+from .transcripts import decode_messages
+
+# ==== メッセージ検索 ====
+#   postgres → message_bigrams(content) の GIN インデックス（ix_messages_content_bigram）
+#   local    → プロセス内の n-gram 転置インデックス（開発・テスト用。ワーカー 1 つ前提）
+# どちらも小文字にした文字 2-gram で候補を絞り、部分一致で確かめる（大文字小文字は lower で揃える）
+# 圧縮済みのメッセージ（transcript_blocks）も search_grams で候補のブロックを絞って展開して探す
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "postgres")
+SEARCH_PAGE_DEFAULT = 20
+SEARCH_PAGE_MAX = 100
+SEARCH_MAX_TERMS = 8
+# 抜粋の長さ（文字数）
+SEARCH_SNIPPET_CHARS = int(os.getenv("SEARCH_SNIPPET_CHARS", "80"))
+
+
+@dataclass(frozen=True)
+class SearchScope:
+    """検索できる範囲（管理画面の受信箱と同じく、担当者 × 会社）"""
+
+    user_id: int
+    company_id: Optional[int]
+    session_id: Optional[object] = None
+
+
+def parse_query(q: Optional[str]) -> List[str]:
+    """
+    空白（全角スペースも）区切りの語。すべて含むメッセージを探す（AND）。
+    日本語は分かち書きしないので、語はそのまま部分一致で扱う。
+    """
+    terms = []
+    for term in (q or "").split():
+        # Postgres の lower() と揃える（casefold は ß → ss など別の文字列になる）
+        term = term.lower()
+        if term not in terms:
+            terms.append(term)
+    return terms[:SEARCH_MAX_TERMS]
+
+
+def make_snippet(content: str, terms: List[str], width: int = SEARCH_SNIPPET_CHARS) -> dict:
+    """
+    最初に一致した語の周辺を width 文字切り出す。
+    highlights は snippet 内の一致位置 [開始, 終了)（HTML に埋め込まないのでそのまま表示できる）
+    """
+    folded = content.lower()
+    # lower で長さが変わる文字（İ など）があると位置がずれるので、その文字はそのまま残す
+    if len(folded) != len(content):
+        folded = "".join(c if len(c.lower()) != 1 else c.lower() for c in content)
+
+    first = min(
+        (pos for pos in (folded.find(t) for t in terms) if pos >= 0),
+        default=0,
+    )
+    start = max(0, min(first - width // 4, len(content) - width))
+    end = min(len(content), start + width)
+
+    highlights = []
+    for term in terms:
+        pos = folded.find(term, start)
+        while 0 <= pos < end:
+            highlights.append([pos - start, min(pos + len(term), end) - start])
+            pos = folded.find(term, pos + len(term))
+    highlights.sort()
+
+    # 重なった範囲はまとめる
+    merged: List[list] = []
+    for s, e in highlights:
+        if merged and s <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], e)
+        else:
+            merged.append([s, e])
+
+    return {
+        "snippet": content[start:end],
+        "snippet_prefix": start > 0,
+        "snippet_suffix": end < len(content),
+        "highlights": merged,
+    }
+
+
+def _serialize_hit(
+    *,
+    id: int,
+    session_id,
+    seq: int,
+    sender_type,
+    created_at: datetime,
+    content: str,
+    visitor_name: Optional[str],
+    terms: List[str],
+) -> dict:
+    return {
+        "id": id,
+        "session_id": str(session_id),
+        "seq": seq,
+        "sender_type": sender_type.value if hasattr(sender_type, "value") else str(sender_type),
+        "created_at": created_at.isoformat(),
+        "visitor_name": visitor_name,
+        **make_snippet(content, terms),
+    }
+
+
+def _parse_cursor(cursor: Optional[str]) -> Optional[int]:
+    """カーソルは最後に返したメッセージの id（新しい順に並べているので、次はそれより小さい id）"""
+    if not cursor:
+        return None
+    return int(cursor)
+
+
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _matches(content: str, terms: List[str]) -> bool:
+    folded = (content or "").lower()
+    return all(t in folded for t in terms)
+
+
+class PostgresSearch:
+    """
+    message_bigrams(content) @> 語の 2-gram で候補を絞り、lower(content) LIKE '%語%' で確かめる。
+    2 文字以上の語があればインデックスで候補を絞れる（日本語の 2 文字の語も）。
+    1 文字の語だけの検索は担当セッションのメッセージを走査する（LocalSearch と同じ）。
+    transcript_blocks は search_grams @> 語の 2-gram で候補のブロックを絞り、展開して確かめる。
+    """
+
+    async def search(
+        self,
+        db: AsyncSession,
+        scope: SearchScope,
+        terms: List[str],
+        cursor: Optional[str] = None,
+        limit: int = SEARCH_PAGE_DEFAULT,
+    ) -> dict:
+        m = models.Message
+        s = models.Session
+        grams = sorted({g for t in terms for g in ngrams(t)})
+        before_id = _parse_cursor(cursor)
+
+        stmt = (
+            select(
+                m.id,
+                m.session_id,
+                m.seq,
+                m.sender_type,
+                m.created_at,
+                m.content,
+                s.visitor_name,
+            )
+            .join(s, s.id == m.session_id)
+            .where(
+                s.owner_user_id == scope.user_id,
+                s.company_id == scope.company_id,
+            )
+        )
+        if scope.session_id is not None:
+            stmt = stmt.where(m.session_id == scope.session_id)
+        if grams:
+            stmt = stmt.where(
+                func.message_bigrams(m.content, type_=ARRAY(Text)).contains(
+                    bindparam(None, grams, type_=ARRAY(Text))
+                )
+            )
+        for term in terms:
+            # パターンは定数で埋め込む（バインド変数だと選択度を見積もれない）
+            pattern = bindparam(
+                None, f"%{_escape_like(term)}%", type_=String, literal_execute=True
+            )
+            stmt = stmt.where(func.lower(m.content).like(pattern, escape="\\"))
+        if before_id is not None:
+            stmt = stmt.where(m.id < before_id)
+
+        rows = (await db.execute(stmt.order_by(m.id.desc()).limit(limit + 1))).all()
+        hits = {row.id: row._asdict() for row in rows}
+        await self._search_blocks(db, scope, terms, grams, before_id, limit, hits)
+
+        ordered = sorted(hits.values(), key=lambda x: x["id"], reverse=True)
+        next_cursor = str(ordered[limit - 1]["id"]) if len(ordered) > limit else None
+        return {
+            "items": [_serialize_hit(**hit, terms=terms) for hit in ordered[:limit]],
+            "next_cursor": next_cursor,
+        }
+
+    async def _search_blocks(
+        self,
+        db: AsyncSession,
+        scope: SearchScope,
+        terms: List[str],
+        grams: List[str],
+        before_id: Optional[int],
+        limit: int,
+        hits: Dict[int, dict],
+    ):
+        """
+        圧縮済みのメッセージから一致するものを hits に足す。
+        ブロックは id の上限が大きい順に見て、既に limit + 1 件あり、それより古いブロックしか
+        残っていなければやめる（id の範囲を持たない古いブロックは最後にすべて確かめる）。
+        """
+        b = models.TranscriptBlock
+        s = models.Session
+        stmt = (
+            select(b.id, b.session_id, b.id_to, s.visitor_name)
+            .join(s, s.id == b.session_id)
+            .where(
+                s.owner_user_id == scope.user_id,
+                s.company_id == scope.company_id,
+            )
+        )
+        if scope.session_id is not None:
+            stmt = stmt.where(b.session_id == scope.session_id)
+        if grams:
+            stmt = stmt.where(
+                or_(
+                    b.search_grams.contains(bindparam(None, grams, type_=ARRAY(Text))),
+                    b.search_grams.is_(None),
+                )
+            )
+        if before_id is not None:
+            stmt = stmt.where(or_(b.id_from < before_id, b.id_from.is_(None)))
+        blocks = (await db.execute(stmt.order_by(b.id_to.desc().nullslast()))).all()
+
+        for block in blocks:
+            if block.id_to is not None and len(hits) > limit:
+                threshold = sorted(hits, reverse=True)[limit]
+                if block.id_to < threshold:
+                    break
+            payload = (
+                await db.execute(select(b.codec, b.payload).where(b.id == block.id))
+            ).one()
+            messages = await asyncio.to_thread(decode_messages, payload.payload, payload.codec)
+            for x in messages:
+                if before_id is not None and x["id"] >= before_id:
+                    continue
+                if x["id"] in hits or not _matches(x["content"], terms):
+                    continue
+                hits[x["id"]] = {
+                    "id": x["id"],
+                    "session_id": block.session_id,
+                    "seq": x["seq"],
+                    "sender_type": x["sender_type"],
+                    "created_at": x["created_at"],
+                    "content": x["content"],
+                    "visitor_name": block.visitor_name,
+                }
+
+
+# -----------------------------
+# ローカル（プロセス内）の n-gram 転置インデックス
+# -----------------------------
+class NgramIndex:
+    """
+    文字 n-gram（既定は 2-gram）→ 文書 id の転置インデックス。
+    語の n-gram をすべて含む文書を候補にし、最後に部分一致で確かめる（語の区切りが無い日本語向け）。
+    """
+
+    def __init__(self, n: int = NGRAM):
+        self.n = n
+        self._postings: Dict[str, Set[int]] = {}
+        self._docs: Dict[int, str] = {}
+
+    def __len__(self):
+        return len(self._docs)
+
+    def __contains__(self, doc_id: int) -> bool:
+        return doc_id in self._docs
+
+    def add(self, doc_id: int, text: str):
+        self.discard(doc_id)
+        folded = text.lower()
+        self._docs[doc_id] = folded
+        for gram in ngrams(folded, self.n):
+            self._postings.setdefault(gram, set()).add(doc_id)
+
+    def discard(self, doc_id: int):
+        folded = self._docs.pop(doc_id, None)
+        if folded is None:
+            return
+        for gram in ngrams(folded, self.n):
+            ids = self._postings.get(gram)
+            if ids is not None:
+                ids.discard(doc_id)
+                if not ids:
+                    del self._postings[gram]
+
+    def search(self, terms: List[str], within: Optional[Set[int]] = None) -> Set[int]:
+        """terms をすべて含む文書 id（within を指定するとその中だけ）"""
+        candidates: Optional[Set[int]] = None
+        # 短い posting から積集合を取る
+        grams = sorted(
+            {g for t in terms for g in ngrams(t, self.n)},
+            key=lambda g: len(self._postings.get(g, ())),
+        )
+        for gram in grams:
+            ids = self._postings.get(gram)
+            if not ids:
+                return set()
+            candidates = set(ids) if candidates is None else candidates & ids
+            if not candidates:
+                return set()
+
+        if candidates is None:
+            # n 文字未満の語だけ → 全件を確認する
+            candidates = set(self._docs) if within is None else set(within)
+        if within is not None:
+            candidates &= within
+
+        return {
+            doc_id
+            for doc_id in candidates
+            if all(t in self._docs[doc_id] for t in terms)
+        }
+
+
+@dataclass(frozen=True)
+class _LocalDoc:
+    session_id: object
+    seq: int
+    sender_type: object
+    created_at: datetime
+    content: str
+
+
+class LocalSearch:
+    """
+    NgramIndex を使う検索（開発・テスト用）。
+    初回の検索で messages と transcript_blocks を読み込み、以降は検索のたびに新しい行・ブロックだけを取り込む。
+    id はワーカーごとにブロック単位で払い出されるので、取り込み済みの最大 id より
+    少し手前から読み直して、遅れてコミットされた行も拾う。
+    """
+
+    def __init__(self, batch: int = 5000, rescan_window: int = MESSAGE_ID_BLOCK * 64):
+        self._index = NgramIndex()
+        self._docs: Dict[int, _LocalDoc] = {}
+        self._by_session: Dict[object, Set[int]] = {}
+        self._max_id = 0
+        self._max_block_id = 0
+        self._batch = batch
+        self._rescan_window = rescan_window
+        self._lock = asyncio.Lock()
+
+    def add(self, doc_id: int, doc: _LocalDoc):
+        self._docs[doc_id] = doc
+        self._by_session.setdefault(doc.session_id, set()).add(doc_id)
+        self._index.add(doc_id, doc.content)
+        self._max_id = max(self._max_id, doc_id)
+
+    async def _catch_up(self, db: AsyncSession):
+        m = models.Message
+        async with self._lock:
+            after_id = max(0, self._max_id - self._rescan_window)
+            while True:
+                rows = (
+                    await db.execute(
+                        select(m.id, m.session_id, m.seq, m.sender_type, m.created_at, m.content)
+                        .where(m.id > after_id)
+                        .order_by(m.id)
+                        .limit(self._batch)
+                    )
+                ).all()
+                for row in rows:
+                    if row.id not in self._docs:
+                        self.add(
+                            row.id,
+                            _LocalDoc(
+                                session_id=row.session_id,
+                                seq=row.seq,
+                                sender_type=row.sender_type,
+                                created_at=row.created_at,
+                                content=row.content or "",
+                            ),
+                        )
+                if len(rows) < self._batch:
+                    break
+                after_id = rows[-1].id
+            await self._catch_up_blocks(db)
+
+    async def _catch_up_blocks(self, db: AsyncSession):
+        """圧縮済みのメッセージ（取り込む前に行から消えたものもある）を取り込む"""
+        b = models.TranscriptBlock
+        while True:
+            blocks = (
+                await db.execute(
+                    select(b.id, b.session_id, b.codec, b.payload)
+                    .where(b.id > self._max_block_id)
+                    .order_by(b.id)
+                    .limit(50)
+                )
+            ).all()
+            for block in blocks:
+                messages = await asyncio.to_thread(decode_messages, block.payload, block.codec)
+                for x in messages:
+                    if x["id"] not in self._docs:
+                        self.add(
+                            x["id"],
+                            _LocalDoc(
+                                session_id=block.session_id,
+                                seq=x["seq"],
+                                sender_type=x["sender_type"],
+                                created_at=x["created_at"],
+                                content=x["content"] or "",
+                            ),
+                        )
+                self._max_block_id = block.id
+            if len(blocks) < 50:
+                return
+
+    async def search(
+        self,
+        db: AsyncSession,
+        scope: SearchScope,
+        terms: List[str],
+        cursor: Optional[str] = None,
+        limit: int = SEARCH_PAGE_DEFAULT,
+    ) -> dict:
+        await self._catch_up(db)
+
+        s = models.Session
+        stmt = select(s.id, s.visitor_name).where(
+            s.owner_user_id == scope.user_id,
+            s.company_id == scope.company_id,
+        )
+        if scope.session_id is not None:
+            stmt = stmt.where(s.id == scope.session_id)
+        visitor_names = {row.id: row.visitor_name for row in (await db.execute(stmt)).all()}
+
+        within: Set[int] = set()
+        for session_id in visitor_names:
+            within |= self._by_session.get(session_id, set())
+
+        before_id = _parse_cursor(cursor)
+        hits = sorted(
+            (
+                doc_id
+                for doc_id in self._index.search(terms, within)
+                if before_id is None or doc_id < before_id
+            ),
+            reverse=True,
+        )
+        next_cursor = str(hits[limit - 1]) if len(hits) > limit else None
+
+        items = []
+        for doc_id in hits[:limit]:
+            doc = self._docs[doc_id]
+            items.append(
+                _serialize_hit(
+                    id=doc_id,
+                    session_id=doc.session_id,
+                    seq=doc.seq,
+                    sender_type=doc.sender_type,
+                    created_at=doc.created_at,
+                    content=doc.content,
+                    visitor_name=visitor_names.get(doc.session_id),
+                    terms=terms,
+                )
+            )
+        return {"items": items, "next_cursor": next_cursor}
+
+
+def create_search_backend():
+    if SEARCH_BACKEND == "local":
+        return LocalSearch()
+    if SEARCH_BACKEND == "postgres":
+        return PostgresSearch()
+    raise RuntimeError(f"unknown SEARCH_BACKEND: {SEARCH_BACKEND}")
+
+
+search_backend = create_search_backend()
@@ -1,19 +1,66 @@
 # backend/app/socket.py
+import os
 import socketio
-from datetime import datetime
 import uuid
 
-from sqlalchemy import select
-
 from .db import AsyncSessionLocal
 from . import models
+from .auth import get_principal_from_token
+from .bus import create_client_manager
+from .message_writer import message_writer, MessageWriterBusy
+from .cache import forget_session, get_session_meta
+from .bot_config import get_bot_config
+from .history import mark_read as mark_session_read, sync_messages
+from .inbox import load_inbox_entry
+from .thumbnails import preview_url
+
+# MESSAGE_QUEUE_URL を設定すると、複数ワーカー / 複数ノード間で emit が共有される
+sio = socketio.AsyncServer(
+    async_mode="asgi",
+    cors_allowed_origins="*",
+    client_manager=create_client_manager(),
+)
+
+# オペレーター向け通知の範囲
+#   owner   → セッション担当ユーザーのみ（管理画面の一覧と同じ範囲）
+#   company → 同じ会社のオペレーター全員
+OPERATOR_ROOM_SCOPE = os.getenv("OPERATOR_ROOM_SCOPE", "owner")
+
+
+def company_room(company_id) -> str:
+    return f"operators:company:{company_id}"
 
-sio = socketio.AsyncServer(async_mode="asgi", cors_allowed_origins="*")
+
+def owner_room(company_id, user_id) -> str:
+    return f"operators:company:{company_id}:user:{user_id}"
+
+
+def operator_room(company_id, owner_user_id) -> str:
+    """セッションのメッセージを通知するオペレーター用ルーム名"""
+    if OPERATOR_ROOM_SCOPE == "company":
+        return company_room(company_id)
+    return owner_room(company_id, owner_user_id)
 
 
 @sio.event
-async def connect(sid, environ):
-    print(f"[socket] connect: {sid}")
+async def connect(sid, environ, auth=None):
+    """
+    管理画面は auth={"token": "<JWT>"} 付きで接続する。
+    トークンが有効なら、その会社 / ユーザーのオペレータールームに入る。
+    ウィジェット（訪問者）は auth なしで接続する。
+    """
+    token = (auth or {}).get("token") if isinstance(auth, dict) else None
+    user = await get_principal_from_token(token) if token else None
+
+    if user is not None and user.company_id is not None:
+        await sio.save_session(
+            sid,
+            {"user_id": user.id, "company_id": user.company_id},
+        )
+        await sio.enter_room(sid, company_room(user.company_id))
+        await sio.enter_room(sid, owner_room(user.company_id, user.id))
+
+    print(f"[socket] connect: {sid}", "operator" if user else "visitor")
 
 
 @sio.event
@@ -31,12 +78,97 @@ async def join_session(sid, data):
 
     await sio.enter_room(sid, str(session_id))
 
-    if role and role.lower() == "operator":
-        await sio.enter_room(sid, "operators")
+    # 以降のメッセージで SELECT しなくて済むよう、ここでメタ情報を読み込んでおく
+    try:
+        session_uuid = uuid.UUID(str(session_id))
+    except ValueError:
+        return
+    async with AsyncSessionLocal() as db:
+        await get_session_meta(db, session_uuid)
 
     print("[socket] join_session:", sid, session_id, role)
 
 
+def _message_payload(row: dict, sender_type: str) -> dict:
+    return {
+        "id": str(row["id"]),
+        "seq": row["seq"],
+        "session_id": str(row["session_id"]),
+        "sender_type": sender_type,
+        "content": row["content"],
+        "attachment_url": row["attachment_url"],
+        "preview_url": preview_url(row["attachment_url"]),
+        "created_at": row["created_at"].isoformat(),
+    }
+
+
+async def _emit_message(sess, payload: dict, event: str = "new_message"):
+    """sess: SessionMeta"""
+    await sio.emit(event, payload, room=str(sess.id))
+    await sio.emit(
+        event,
+        payload,
+        room=operator_room(sess.company_id, sess.owner_user_id),
+    )
+
+
+async def _emit_message_failed(row: dict):
+    """
+    MessageWriter が保存できなかったメッセージの取り消し（new_message は emit 済みのため）。
+      message_failed: {"id", "seq", "session_id"}
+    クライアントは該当メッセージを消し、連番の抜けとして扱う。
+    """
+    payload = {
+        "id": str(row["id"]),
+        "seq": row["seq"],
+        "session_id": str(row["session_id"]),
+    }
+    async with AsyncSessionLocal() as db:
+        sess = await get_session_meta(db, row["session_id"])
+    if sess is None:
+        await sio.emit("message_failed", payload, room=str(row["session_id"]))
+        return
+    await _emit_message(sess, payload, event="message_failed")
+
+
+message_writer.on_dropped = _emit_message_failed
+
+
+async def emit_session_changed(session_id):
+    """
+    受信箱の行が変わったことを担当オペレーターへ通知する（コミット後に呼ぶ）。
+      session_upserted: {"session": 一覧の行}
+      session_removed : {"session_id": ...}（受信箱の条件から外れた）
+    一覧は担当者ごとなので、通知先は OPERATOR_ROOM_SCOPE によらず担当者のルーム。
+    """
+    try:
+        async with AsyncSessionLocal() as db:
+            entry = await load_inbox_entry(db, session_id)
+        if entry is None:
+            return
+        company_id, owner_user_id, summary = entry
+        room = owner_room(company_id, owner_user_id)
+        if summary is None:
+            await sio.emit("session_removed", {"session_id": str(session_id)}, room=room)
+        else:
+            await sio.emit("session_upserted", {"session": summary}, room=room)
+    except Exception as e:
+        print("[socket] session change emit failed:", e)
+
+
+async def _emit_sessions_reopened(session_ids):
+    """
+    訪問者の発言で OPEN に戻ったセッションの受信箱の行を送り直す（MessageWriter のコミット後）。
+    キャッシュの status は実際に戻したときだけ変わるよう、ここで（全ワーカーの）キャッシュを捨てる
+    """
+    for session_id in session_ids:
+        await forget_session(session_id)
+        await emit_session_changed(session_id)
+
+
+message_writer.on_reopened = _emit_sessions_reopened
+
+
 @sio.event
 async def visitor_message(sid, data):
     """
@@ -61,120 +193,68 @@ async def visitor_message(sid, data):
     session_uuid = uuid.UUID(session_id_str)
 
     async with AsyncSessionLocal() as db:
-        q_sess = await db.execute(
-            select(models.Session).where(models.Session.id == session_uuid)
-        )
-        sess = q_sess.scalar_one_or_none()
+        sess = await get_session_meta(db, session_uuid)
         if not sess:
             return
 
         option = None
-        if bot_option_id is not None:
-            q_opt = await db.execute(
-                select(models.BotOption).where(
-                    models.BotOption.id == int(bot_option_id),
-                    models.BotOption.company_id == sess.company_id,
-                    models.BotOption.is_active.is_(True),
-                )
-            )
-            option = q_opt.scalar_one_or_none()
+        config = None
+        if bot_option_id is not None and sess.company_id is not None:
+            config = await get_bot_config(db, sess.company_id)
+            option = config.option(int(bot_option_id))
             if option:
                 content = option.label
 
-        msg = models.Message(
+    # 保存は MessageWriter がまとめて行う。ここでは積んだらすぐ配信する
+    try:
+        row = await message_writer.enqueue(
             session_id=session_uuid,
             sender_type=models.SenderType.VISITOR,
             content=content,
             attachment_url=attachment_url,
-            created_at=datetime.utcnow(),
-            is_read=False,
-            read_at=None,
+            reopen=True,
         )
-        db.add(msg)
+    except MessageWriterBusy:
+        return {"ok": False, "error": "busy"}
+    if row is None:
+        return {"ok": False, "error": "session not found"}
 
-        await db.execute(
-            models.Session.__table__.update()
-            .where(models.Session.id == session_uuid)
-            .values(last_active_at=datetime.utcnow(), status=models.SessionStatus.OPEN)
-        )
+    await _emit_message(sess, _message_payload(row, "visitor"))
 
-        await db.commit()
-        await db.refresh(msg)
-
-        payload = {
-            "id": str(msg.id),
-            "session_id": str(msg.session_id),
-            "sender_type": "visitor",
-            "content": msg.content,
-            "attachment_url": msg.attachment_url,
-            "created_at": msg.created_at.isoformat(),
-        }
-
-        await sio.emit("new_message", payload, room=session_id_str)
-        await sio.emit("new_message", payload, room="operators")
-
-        if option is not None:
-            q_setting = await db.execute(
-                select(models.BotSetting).where(models.BotSetting.company_id == sess.company_id)
+    if option is not None and config.enabled:
+        bot_text = option.reply
+
+        try:
+            bot_row = await message_writer.enqueue(
+                session_id=session_uuid,
+                sender_type=models.SenderType.SYSTEM,
+                content=bot_text,
             )
-            setting = q_setting.scalar_one_or_none()
-            if setting and setting.enabled:
-                bot_text = ""
-
-                if option.action == "reply":
-                    bot_text = option.reply_text or "承知しました。"
-                elif option.action == "link":
-                    if option.link_url:
-                        bot_text = f"{option.reply_text or 'こちらをご覧ください。'}\n{option.link_url}"
-                    else:
-                        bot_text = option.reply_text or "こちらをご覧ください。"
-                elif option.action == "handoff":
-                    bot_text = option.reply_text or "担当者をお呼びします。少々お待ちください。"
-                else:
-                    bot_text = option.reply_text or "承知しました。"
-
-                bot_msg = models.Message(
-                    session_id=session_uuid,
-                    sender_type=models.SenderType.SYSTEM,
-                    content=bot_text,
-                    attachment_url=None,
-                    created_at=datetime.utcnow(),
-                    is_read=True,
-                    read_at=datetime.utcnow(),
-                )
-                db.add(bot_msg)
-
-                await db.execute(
-                    models.Session.__table__.update()
-                    .where(models.Session.id == session_uuid)
-                    .values(last_active_at=datetime.utcnow())
-                )
-
-                await db.commit()
-                await db.refresh(bot_msg)
-
-                bot_payload = {
-                    "id": str(bot_msg.id),
-                    "session_id": str(bot_msg.session_id),
-                    "sender_type": "system",
-                    "content": bot_msg.content,
-                    "attachment_url": bot_msg.attachment_url,
-                    "created_at": bot_msg.created_at.isoformat(),
-                }
-
-                await sio.emit("new_message", bot_payload, room=session_id_str)
-                await sio.emit("new_message", bot_payload, room="operators")
+        except MessageWriterBusy:
+            return {"ok": False, "error": "busy"}
+        if bot_row is None:
+            return {"ok": False, "error": "session not found"}
+
+        await _emit_message(sess, _message_payload(bot_row, "system"))
+
+    return {"ok": True, "id": row["id"]}
+
 
 @sio.event
 async def operator_message(sid, data):
     """
+    オペレーターの発言（接続時に認証済みで、セッションの担当者のみ）。
     data: {
       "session_id": "uuid-string",
       "content": "text...",
       "attachment_url": "/uploads/xxx.png" (optional)
     }
     """
-    session_id_str = data.get("session_id")
+    operator = await sio.get_session(sid)
+    if not operator or "user_id" not in operator:
+        return {"ok": False, "error": "unauthorized"}
+
+    session_id_str = (data or {}).get("session_id")
     content = (data.get("content") or "").strip()
     attachment_url = data.get("attachment_url")
 
@@ -184,44 +264,92 @@ async def operator_message(sid, data):
     if not content and not attachment_url:
         return
 
-    session_uuid = uuid.UUID(session_id_str)
+    try:
+        session_uuid = uuid.UUID(str(session_id_str))
+    except ValueError:
+        return {"ok": False, "error": "invalid params"}
 
     async with AsyncSessionLocal() as db:
-        q = await db.execute(
-            select(models.Session).where(models.Session.id == session_uuid)
-        )
-        sess = q.scalar_one_or_none()
-        if not sess:
-            return
-
-        msg = models.Message(
+        sess = await get_session_meta(db, session_uuid)
+        # 管理画面の一覧と同じく、担当セッションにだけ送れる
+        if (
+            not sess
+            or sess.owner_user_id != operator["user_id"]
+            or sess.company_id != operator["company_id"]
+        ):
+            return {"ok": False, "error": "session not found"}
+
+    try:
+        row = await message_writer.enqueue(
             session_id=session_uuid,
             sender_type=models.SenderType.OPERATOR,
+            sender_id=operator["user_id"],
             content=content,
             attachment_url=attachment_url,
-            created_at=datetime.utcnow(),
-            is_read=False,
-            read_at=None,
         )
-        db.add(msg)
+    except MessageWriterBusy:
+        return {"ok": False, "error": "busy"}
+    if row is None:
+        return {"ok": False, "error": "session not found"}
 
-        await db.execute(
-            models.Session.__table__.update()
-            .where(models.Session.id == session_uuid)
-            .values(last_active_at=datetime.utcnow())
-        )
+    await _emit_message(sess, _message_payload(row, "operator"))
 
+    return {"ok": True, "id": row["id"]}
+
+
+@sio.event
+async def sync(sid, data):
+    """
+    再接続時・取りこぼし検知時の差分同期。
+    data: {"session_id": "uuid-string", "after_seq": 12}
+    ack で sync_messages() の結果を返す。
+    """
+    session_id_str = (data or {}).get("session_id")
+    if not session_id_str:
+        return {"ok": False, "error": "session_id required"}
+
+    try:
+        session_uuid = uuid.UUID(session_id_str)
+        after_seq = int(data.get("after_seq") or 0)
+    except (TypeError, ValueError):
+        return {"ok": False, "error": "invalid params"}
+
+    async with AsyncSessionLocal() as db:
+        result = await sync_messages(db, session_uuid, after_seq)
+
+    if result is None:
+        return {"ok": False, "error": "session not found"}
+    return {"ok": True, **result}
+
+
+@sio.event
+async def mark_read(sid, data):
+    """
+    オペレーターの既読位置を進める（接続時に認証済みのオペレーターのみ）。
+    data: {"session_id": "uuid-string", "seq": 12 (optional)}
+    """
+    operator = await sio.get_session(sid)
+    if not operator or "user_id" not in operator:
+        return {"ok": False, "error": "unauthorized"}
+
+    session_id_str = (data or {}).get("session_id")
+    try:
+        session_uuid = uuid.UUID(session_id_str)
+        seq = data.get("seq")
+        seq = int(seq) if seq is not None else None
+    except (TypeError, ValueError):
+        return {"ok": False, "error": "invalid params"}
+
+    async with AsyncSessionLocal() as db:
+        sess = await get_session_meta(db, session_uuid)
+        if (
+            not sess
+            or sess.owner_user_id != operator["user_id"]
+            or sess.company_id != operator["company_id"]
+        ):
+            return {"ok": False, "error": "session not found"}
+
+        result = await mark_session_read(db, session_uuid, operator["user_id"], seq)
         await db.commit()
-        await db.refresh(msg)
-
-        payload = {
-            "id": str(msg.id),
-            "session_id": str(msg.session_id),
-            "sender_type": "operator",
-            "content": msg.content,
-            "attachment_url": msg.attachment_url,
-            "created_at": msg.created_at.isoformat(),
-        }
-
-        await sio.emit("new_message", payload, room=session_id_str)
-        await sio.emit("new_message", payload, room="operators")
\ No newline at end of file
+
+    return {"ok": True, **result}
@@ -0,0 +1,272 @@
+# backend/app/storage.py
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import BinaryIO, Iterator, Optional
+
+# ==== 添付ファイルの保存先 ====
+#   local → UPLOAD_DIR（既定）
+#   s3    → S3 互換ストレージ（MinIO などは S3_ENDPOINT_URL を指定）
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local")
+UPLOAD_DIR = Path(os.getenv("UPLOAD_DIR", "/app/uploads"))
+
+S3_BUCKET = os.getenv("S3_BUCKET", "")
+S3_PREFIX = os.getenv("S3_PREFIX", "uploads/")
+S3_REGION = os.getenv("S3_REGION", "") or None
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL", "") or None
+# ブラウザから見たエンドポイント（コンテナ内と外でホスト名が違う場合）
+S3_PUBLIC_ENDPOINT_URL = os.getenv("S3_PUBLIC_ENDPOINT_URL", "") or S3_ENDPOINT_URL
+S3_ACCESS_KEY_ID = os.getenv("S3_ACCESS_KEY_ID", "") or None
+S3_SECRET_ACCESS_KEY = os.getenv("S3_SECRET_ACCESS_KEY", "") or None
+
+PRESIGN_EXPIRES = int(os.getenv("STORAGE_PRESIGN_EXPIRES", "900"))
+
+
+class Storage:
+    """
+    添付ファイルの保存先。キーは "ab/<sha256>.png" のような相対パス。
+    メソッドはブロッキングなので、非同期コードからはスレッドで呼ぶこと。
+    """
+
+    name = "base"
+
+    def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def size(self, key: str) -> Optional[int]:
+        raise NotImplementedError
+
+    def put_file(self, src: BinaryIO, key: str, content_type: Optional[str] = None) -> None:
+        raise NotImplementedError
+
+    def put_path(self, path: Path, key: str, content_type: Optional[str] = None) -> None:
+        """ローカルの一時ファイルを保存する（成功したら path は消えていてよい）"""
+        with open(path, "rb") as f:
+            self.put_file(f, key, content_type)
+        Path(path).unlink(missing_ok=True)
+
+    @contextmanager
+    def local_copy(self, key: str) -> Iterator[Path]:
+        """ローカルのファイルパスとして読む（必要なら一時ファイルに落とす）"""
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def local_path(self, key: str) -> Optional[Path]:
+        """ローカルに実体があればそのパス（直接配信できる）"""
+        return None
+
+    def temp_dir(self) -> Path:
+        """put_path に渡す一時ファイルを作る場所"""
+        return Path(tempfile.gettempdir())
+
+    # ---- 署名付き URL（未対応の保存先は None） ----
+    def presign_upload(
+        self, key: str, content_type: Optional[str], size: int, sha256_b64: str
+    ) -> Optional[dict]:
+        return None
+
+    def presign_download(self, key: str, expires: int = PRESIGN_EXPIRES) -> Optional[str]:
+        return None
+
+
+class LocalStorage(Storage):
+    name = "local"
+
+    def __init__(self, root: Path = UPLOAD_DIR):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        path = (self.root / key).resolve()
+        if self.root.resolve() not in path.parents:
+            raise ValueError(f"invalid storage key: {key}")
+        return path
+
+    def exists(self, key: str) -> bool:
+        return self._path(key).is_file()
+
+    def size(self, key: str) -> Optional[int]:
+        try:
+            return self._path(key).stat().st_size
+        except FileNotFoundError:
+            return None
+
+    def put_file(self, src: BinaryIO, key: str, content_type: Optional[str] = None) -> None:
+        """一時ファイルに書いてから置き換える（途中で失敗しても壊れたファイルを残さない）"""
+        dest = self._path(key)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        # 一時ファイル名はリクエストごとに一意にする（同じ内容の同時アップロードで取り合わない）
+        fd, tmp = tempfile.mkstemp(dir=dest.parent, prefix=f".{dest.name}.", suffix=".part")
+        tmp_path = Path(tmp)
+        try:
+            with os.fdopen(fd, "wb") as out:
+                shutil.copyfileobj(src, out, 1024 * 1024)
+                out.flush()
+                os.fsync(out.fileno())
+            os.replace(tmp_path, dest)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+    def put_path(self, path: Path, key: str, content_type: Optional[str] = None) -> None:
+        dest = self._path(key)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(path, dest)
+
+    @contextmanager
+    def local_copy(self, key: str) -> Iterator[Path]:
+        yield self._path(key)
+
+    def delete(self, key: str) -> None:
+        self._path(key).unlink(missing_ok=True)
+
+    def local_path(self, key: str) -> Optional[Path]:
+        return self._path(key)
+
+    def temp_dir(self) -> Path:
+        # 同じファイルシステム上に作れば put_path が rename だけで済む
+        path = self.root / ".tmp"
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+
+
+class S3Storage(Storage):
+    """
+    S3 互換ストレージ。boto3 は使うときだけ import する（local なら不要）。
+    ブラウザからは署名付き URL で直接アップロード / ダウンロードする。
+    """
+
+    name = "s3"
+
+    def __init__(
+        self,
+        bucket: str = S3_BUCKET,
+        prefix: str = S3_PREFIX,
+        endpoint_url: Optional[str] = S3_ENDPOINT_URL,
+        public_endpoint_url: Optional[str] = S3_PUBLIC_ENDPOINT_URL,
+        region: Optional[str] = S3_REGION,
+    ):
+        if not bucket:
+            raise ValueError("S3_BUCKET is not set")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.endpoint_url = endpoint_url
+        self.public_endpoint_url = public_endpoint_url
+        self.region = region
+        self._client = None
+        self._public_client = None
+
+    def _make_client(self, endpoint_url):
+        import boto3
+        from botocore.config import Config
+
+        return boto3.client(
+            "s3",
+            endpoint_url=endpoint_url,
+            region_name=self.region,
+            aws_access_key_id=S3_ACCESS_KEY_ID,
+            aws_secret_access_key=S3_SECRET_ACCESS_KEY,
+            # MinIO などはパス形式でないと名前解決できない
+            config=Config(
+                signature_version="s3v4",
+                s3={"addressing_style": "path" if endpoint_url else "auto"},
+            ),
+        )
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = self._make_client(self.endpoint_url)
+        return self._client
+
+    @property
+    def public_client(self):
+        """署名付き URL はブラウザから届くホスト名で作る"""
+        if self.public_endpoint_url == self.endpoint_url:
+            return self.client
+        if self._public_client is None:
+            self._public_client = self._make_client(self.public_endpoint_url)
+        return self._public_client
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}{key}"
+
+    def _head(self, key: str) -> Optional[dict]:
+        from botocore.exceptions import ClientError
+
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    def exists(self, key: str) -> bool:
+        return self._head(key) is not None
+
+    def size(self, key: str) -> Optional[int]:
+        head = self._head(key)
+        return head["ContentLength"] if head else None
+
+    def put_file(self, src: BinaryIO, key: str, content_type: Optional[str] = None) -> None:
+        extra = {"ContentType": content_type} if content_type else None
+        self.client.upload_fileobj(src, self.bucket, self._key(key), ExtraArgs=extra)
+
+    @contextmanager
+    def local_copy(self, key: str) -> Iterator[Path]:
+        fd, tmp = tempfile.mkstemp(suffix=Path(key).suffix)
+        os.close(fd)
+        try:
+            self.client.download_file(self.bucket, self._key(key), tmp)
+            yield Path(tmp)
+        finally:
+            Path(tmp).unlink(missing_ok=True)
+
+    def delete(self, key: str) -> None:
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+    def presign_upload(
+        self, key: str, content_type: Optional[str], size: int, sha256_b64: str
+    ) -> Optional[dict]:
+        """
+        PUT 用の署名付き URL。サイズと sha256 も署名に含めるので、
+        申告と違う内容は S3 側で拒否される（内容アドレスのキーが壊れない）。
+        """
+        params = {
+            "Bucket": self.bucket,
+            "Key": self._key(key),
+            "ContentLength": size,
+            "ChecksumSHA256": sha256_b64,
+        }
+        headers = {"x-amz-checksum-sha256": sha256_b64}
+        if content_type:
+            params["ContentType"] = content_type
+            headers["Content-Type"] = content_type
+
+        url = self.public_client.generate_presigned_url(
+            "put_object", Params=params, ExpiresIn=PRESIGN_EXPIRES
+        )
+        return {"method": "PUT", "url": url, "headers": headers}
+
+    def presign_download(self, key: str, expires: int = PRESIGN_EXPIRES) -> Optional[str]:
+        return self.public_client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": self._key(key)},
+            ExpiresIn=expires,
+        )
+
+
+def create_storage(backend: str = None) -> Storage:
+    backend = backend or STORAGE_BACKEND
+    if backend == "local":
+        return LocalStorage()
+    if backend == "s3":
+        return S3Storage()
+    raise ValueError(f"unsupported STORAGE_BACKEND: {backend}")
+
+
+storage = create_storage()
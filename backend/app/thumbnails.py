@@ -0,0 +1,161 @@
+# backend/app/thumbnails.py
+import asyncio
+import os
+import re
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+from .attachments import UPLOAD_URL_PREFIX
+from .storage import storage
+
+# ==== プレビュー画像の設定 ====
+THUMBNAIL_WIDTH = int(os.getenv("THUMBNAIL_WIDTH", "320"))
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", "80"))
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", "1"))
+THUMBNAIL_QUEUE_MAX = int(os.getenv("THUMBNAIL_QUEUE_MAX", "1000"))
+
+THUMBNAIL_SUFFIX = ".thumb.webp"
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp"}
+
+# 内容アドレスで保存された添付（/uploads/ab/<sha256>.png）のみプレビューを持つ
+_CONTENT_URL_RE = re.compile(
+    rf"^{re.escape(UPLOAD_URL_PREFIX)}/([0-9a-f]{{2}}/[0-9a-f]{{64}})(\.[a-z0-9]+)$"
+)
+
+
+def thumbnail_key(key: str) -> str:
+    """元ファイルのキー（ab/<sha256>.png）→ プレビューのキー（ab/<sha256>.thumb.webp）"""
+    return str(Path(key).with_suffix("")) + THUMBNAIL_SUFFIX
+
+
+def is_image_key(key: str) -> bool:
+    return Path(key).suffix.lower() in IMAGE_SUFFIXES
+
+
+def preview_url(attachment_url: Optional[str]) -> Optional[str]:
+    """
+    メッセージの添付 URL から、プレビュー画像の URL を求める（DB は見ない）。
+    生成前・生成失敗のときは 404 になるので、クライアントは元画像にフォールバックすること。
+    """
+    if not attachment_url:
+        return None
+    m = _CONTENT_URL_RE.match(attachment_url)
+    if not m or m.group(2) not in IMAGE_SUFFIXES:
+        return None
+    return f"{UPLOAD_URL_PREFIX}/{m.group(1)}{THUMBNAIL_SUFFIX}"
+
+
+def render_thumbnail(src: str, dest: str, width: int, quality: int) -> None:
+    """
+    縮小版を WebP で dest に書き出す（ワーカープロセスで実行される）。
+    元が十分小さくても形式をそろえるため書き出す。
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(src) as img:
+        # JPEG はデコード時点で縮小しておく（大きな写真でも速い）
+        img.draft("RGB", (width, width * 4))
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ("RGB", "RGBA"):
+            has_alpha = img.mode in ("LA", "PA") or "transparency" in img.info
+            img = img.convert("RGBA" if has_alpha else "RGB")
+        img.thumbnail((width, width * 4))
+        img.save(dest, "WEBP", quality=quality, method=4)
+
+
+class Thumbnailer:
+    """
+    画像添付のプレビュー生成をプロセスプールで行うバックグラウンド処理。
+    アップロードのリクエストは enqueue() するだけで、画像処理は待たない。
+    """
+
+    def __init__(
+        self,
+        workers: int = THUMBNAIL_WORKERS,
+        queue_max: int = THUMBNAIL_QUEUE_MAX,
+        width: int = THUMBNAIL_WIDTH,
+        quality: int = THUMBNAIL_QUALITY,
+    ):
+        self._workers = max(1, workers)
+        self._queue_max = queue_max
+        self._width = width
+        self._quality = quality
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks = []
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def running(self) -> bool:
+        return self._executor is not None
+
+    async def start(self):
+        if self.running:
+            return
+        self._executor = ProcessPoolExecutor(max_workers=self._workers)
+        self._queue = asyncio.Queue(maxsize=self._queue_max)
+        self._tasks = [
+            asyncio.create_task(self._run()) for _ in range(self._workers)
+        ]
+
+    async def stop(self):
+        if not self.running:
+            return
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+
+    def enqueue(self, key: str) -> bool:
+        """
+        元ファイルのキーを積む。画像でない / キューが満杯なら積まない
+        （プレビューは無くても元画像で表示できるので、取りこぼしは許容する）。
+        """
+        if not self.running or not is_image_key(key):
+            return False
+        try:
+            self._queue.put_nowait(key)
+        except asyncio.QueueFull:
+            print("[thumbnails] queue full, skip:", key)
+            return False
+        return True
+
+    async def _run(self):
+        while True:
+            key = await self._queue.get()
+            try:
+                await self._process(key)
+            except Exception as e:
+                print("[thumbnails] failed:", key, e)
+            finally:
+                self._queue.task_done()
+
+    async def _process(self, key: str):
+        thumb = thumbnail_key(key)
+        if await asyncio.to_thread(storage.exists, thumb):
+            return
+
+        # 保存先のファイルをローカルで読める形にする（S3 なら一時ファイルにダウンロード）
+        source = storage.local_copy(key)
+        src = await asyncio.to_thread(source.__enter__)
+        tmp = storage.temp_dir() / f"{uuid.uuid4().hex}.webp"
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                self._executor,
+                render_thumbnail,
+                str(src),
+                str(tmp),
+                self._width,
+                self._quality,
+            )
+            await asyncio.to_thread(storage.put_path, tmp, thumb, "image/webp")
+        finally:
+            tmp.unlink(missing_ok=True)
+            await asyncio.to_thread(source.__exit__, None, None, None)
+
+
+thumbnailer = Thumbnailer()
@@ -0,0 +1,119 @@
+# backend/app/transcript_compaction.py
+import asyncio
+import os
+from dataclasses import dataclass
+
+from sqlalchemy import select
+
+from . import models
+from .db import AsyncSessionLocal
+from .transcripts import TRANSCRIPT_BLOCK_MESSAGES, prepare_blocks, write_blocks
+
+# ==== 長い会話の圧縮 ====
+# 最新のこの件数は行のまま残す（差分同期・既読・検索はほぼこの範囲で済む）
+TRANSCRIPT_KEEP_RECENT = int(os.getenv("TRANSCRIPT_KEEP_RECENT", "1000"))
+TRANSCRIPT_COMPACT_BATCH = int(os.getenv("TRANSCRIPT_COMPACT_BATCH", "50"))
+TRANSCRIPT_COMPACT_SLEEP = float(os.getenv("TRANSCRIPT_COMPACT_SLEEP", "0.2"))
+
+
+@dataclass
+class CompactionReport:
+    sessions: int = 0
+    blocks: int = 0
+    messages: int = 0
+
+
+class TranscriptCompactor:
+    """
+    行として残っているメッセージが TRANSCRIPT_KEEP_RECENT + 1 ブロック分を超えたセッション
+    （OPEN のままでもよい）の古い側を、満杯のブロック単位で transcript_blocks に移す。
+    ブロックの中もメッセージ検索の対象（search_grams で候補を絞って展開する）。
+    セッション行のロックは連番の払い出し（MessageWriter）と共有なので、圧縮はロックの外で済ませ、
+    1 ブロックごとにコミットしてロックを短くする。多重実行の防止は呼び出し側（MessageArchiver の
+    advisory lock）で行う。
+    """
+
+    def __init__(
+        self,
+        session_factory=AsyncSessionLocal,
+        keep_recent: int = TRANSCRIPT_KEEP_RECENT,
+        block_messages: int = TRANSCRIPT_BLOCK_MESSAGES,
+        batch: int = TRANSCRIPT_COMPACT_BATCH,
+        batch_sleep: float = TRANSCRIPT_COMPACT_SLEEP,
+    ):
+        self._session_factory = session_factory
+        self._keep_recent = keep_recent
+        self._block_messages = block_messages
+        self._batch = batch
+        self._batch_sleep = batch_sleep
+
+    def _threshold(self) -> int:
+        return self._keep_recent + self._block_messages
+
+    async def run(self, dry_run: bool = False) -> CompactionReport:
+        report = CompactionReport()
+        s = models.Session
+        last_id = None
+        while True:
+            async with self._session_factory() as db:
+                stmt = (
+                    select(s.id)
+                    .where(s.last_seq - s.archived_through_seq >= self._threshold())
+                    .order_by(s.id)
+                    .limit(self._batch)
+                )
+                if last_id is not None:
+                    stmt = stmt.where(s.id > last_id)
+                session_ids = (await db.execute(stmt)).scalars().all()
+            if not session_ids:
+                return report
+            last_id = session_ids[-1]
+
+            for session_id in session_ids:
+                if dry_run:
+                    report.sessions += 1
+                    continue
+                blocks, moved = await self._compact_session(session_id)
+                if moved:
+                    report.sessions += 1
+                    report.blocks += blocks
+                    report.messages += moved
+
+            await asyncio.sleep(self._batch_sleep)
+
+    async def _compact_session(self, session_id):
+        s = models.Session
+        blocks = moved = 0
+        while True:
+            async with self._session_factory() as db:
+                row = (
+                    await db.execute(
+                        select(s.last_seq, s.archived_through_seq).where(s.id == session_id)
+                    )
+                ).first()
+                if row is None or row.last_seq - row.archived_through_seq < self._threshold():
+                    return blocks, moved
+
+                # 満杯の 1 ブロック分だけ移す
+                pending = await prepare_blocks(
+                    db,
+                    session_id,
+                    row.archived_through_seq + self._block_messages,
+                    block_messages=self._block_messages,
+                )
+            if not pending.blocks:
+                return blocks, moved
+
+            async with self._session_factory() as db:
+                # 連番の払い出しと同じ行ロックを取ってから書く（準備の後に他で移されていたら何もしない）
+                locked = (
+                    await db.execute(select(s.id).where(s.id == session_id).with_for_update())
+                ).first()
+                count = await write_blocks(db, pending) if locked else 0
+                await db.commit()
+
+            if not count:
+                # 範囲の行がまだコミットされていない（書き込み待ち）・他で移された。次回に回す
+                return blocks, moved
+            blocks += 1
+            moved += count
@@ -0,0 +1,306 @@
+# backend/app/transcripts.py
+import asyncio
+import json
+import os
+import zlib
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import delete, insert, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models
+from .ngrams import text_bigrams
+
+try:
+    import zstandard
+except ImportError:  # zstandard が無ければ zlib だけを使う
+    zstandard = None
+
+# ==== 圧縮したメッセージ（transcript_blocks）====
+# 1 ブロックに入れるメッセージ数（連番の範囲ごとに区切る）
+TRANSCRIPT_BLOCK_MESSAGES = int(os.getenv("TRANSCRIPT_BLOCK_MESSAGES", "500"))
+TRANSCRIPT_ZSTD_LEVEL = int(os.getenv("TRANSCRIPT_ZSTD_LEVEL", "10"))
+# メッセージの created_at はセッションの作成時刻以降。ノード間の時計のずれの分だけ余裕を見る
+MESSAGE_CLOCK_SKEW = timedelta(seconds=float(os.getenv("MESSAGE_CLOCK_SKEW_SECONDS", "300")))
+
+
+# codec 名 → (圧縮, 展開)。読み出しは行ごとの codec で行うので、方式を変えても古いブロックは読める
+CODECS: Dict[str, Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]] = {
+    "zlib": (lambda data: zlib.compress(data, 6), zlib.decompress),
+}
+
+if zstandard is not None:
+    # ZstdCompressor はスレッドセーフではないので呼び出しごとに作る（ブロック単位なので軽い）
+    CODECS["zstd"] = (
+        lambda data: zstandard.ZstdCompressor(level=TRANSCRIPT_ZSTD_LEVEL).compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data),
+    )
+
+# 新しく作るブロックの圧縮方式（既定は使えれば zstd）
+TRANSCRIPT_CODEC = os.getenv("TRANSCRIPT_CODEC", "zstd" if "zstd" in CODECS else "zlib")
+if TRANSCRIPT_CODEC not in CODECS:
+    print(f"[transcripts] codec {TRANSCRIPT_CODEC} is not available, fallback to zlib")
+    TRANSCRIPT_CODEC = "zlib"
+
+# payload の 1 件分: [id, seq, sender_type, sender_id, content, attachment_url, created_at]
+_FIELDS = ("id", "seq", "sender_type", "sender_id", "content", "attachment_url", "created_at")
+
+
+def encode_messages(messages: List[dict], codec: str = TRANSCRIPT_CODEC) -> bytes:
+    compress, _ = CODECS[codec]
+    raw = json.dumps(
+        [
+            [
+                m["id"],
+                m["seq"],
+                m["sender_type"].value if hasattr(m["sender_type"], "value") else m["sender_type"],
+                m["sender_id"],
+                m["content"],
+                m["attachment_url"],
+                m["created_at"].isoformat(),
+            ]
+            for m in messages
+        ],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return compress(raw.encode("utf-8"))
+
+
+def decode_messages(payload: bytes, codec: str) -> List[dict]:
+    """ブロックを messages の行と同じキーの dict に戻す（seq 順）"""
+    if codec not in CODECS:
+        raise ValueError(f"unknown transcript codec: {codec}")
+    _, decompress = CODECS[codec]
+    items = json.loads(decompress(payload).decode("utf-8"))
+    messages = []
+    for item in items:
+        m = dict(zip(_FIELDS, item))
+        m["sender_type"] = models.SenderType(m["sender_type"])
+        m["created_at"] = datetime.fromisoformat(m["created_at"])
+        messages.append(m)
+    return messages
+
+
+def messages_since(session_created_at):
+    """
+    セッションのメッセージの created_at の下限。条件に付けると、セッションより前の月の
+    パーティションを読まずに済む（session_created_at は datetime でも列の式でもよい）。
+    """
+    return session_created_at - MESSAGE_CLOCK_SKEW
+
+
+# messages から読む列（ORM オブジェクトにせず dict で扱う）
+MESSAGE_COLUMNS = (
+    models.Message.id,
+    models.Message.session_id,
+    models.Message.seq,
+    models.Message.visitor_count,
+    models.Message.sender_type,
+    models.Message.sender_id,
+    models.Message.content,
+    models.Message.attachment_url,
+    models.Message.created_at,
+)
+
+
+class PendingBlocks(NamedTuple):
+    """prepare_blocks() で作った、まだ書き込んでいないブロック"""
+
+    session_id: object
+    # 作成時点の archived_through_seq（書き込み時に変わっていたら捨てる）
+    after_seq: int
+    # (transcript_blocks に入れる値, ブロックに入れたメッセージの id)
+    blocks: List[Tuple[dict, List[int]]]
+
+    @property
+    def message_count(self) -> int:
+        return sum(values["message_count"] for values, _ in self.blocks)
+
+
+async def prepare_blocks(
+    db: AsyncSession,
+    session_id,
+    up_to_seq: int,
+    block_messages: int = TRANSCRIPT_BLOCK_MESSAGES,
+    codec: str = TRANSCRIPT_CODEC,
+) -> PendingBlocks:
+    """
+    session_id の連番 up_to_seq までの（まだブロックにしていない）行を読み、圧縮しておく。
+    セッション行のロックは取らない。JSON 化・圧縮・検索用 2-gram の計算は重いのでスレッドで行う。
+    """
+    m = models.Message
+    session = (
+        await db.execute(
+            select(models.Session.archived_through_seq, models.Session.created_at).where(
+                models.Session.id == session_id
+            )
+        )
+    ).one()
+    since = messages_since(session.created_at)
+    after_seq = session.archived_through_seq
+
+    blocks = []
+    while True:
+        rows = (
+            await db.execute(
+                select(*MESSAGE_COLUMNS)
+                .where(
+                    m.session_id == session_id,
+                    m.created_at >= since,
+                    m.seq > after_seq,
+                    m.seq <= up_to_seq,
+                )
+                .order_by(m.seq)
+                .limit(block_messages)
+            )
+        ).all()
+        if not rows:
+            break
+
+        messages = [row._asdict() for row in rows]
+        payload = await asyncio.to_thread(encode_messages, messages, codec)
+        # ブロックの中もメッセージ検索で見つかるよう、本文の 2-gram を持たせる
+        search_grams = await asyncio.to_thread(text_bigrams, [x["content"] for x in messages])
+        values = dict(
+            session_id=session_id,
+            seq_from=messages[0]["seq"],
+            seq_to=messages[-1]["seq"],
+            message_count=len(messages),
+            first_created_at=min(x["created_at"] for x in messages),
+            last_created_at=max(x["created_at"] for x in messages),
+            # id は払い出し順なので連番順とは限らない。範囲だけ持って id からブロックを引く
+            id_from=min(x["id"] for x in messages),
+            id_to=max(x["id"] for x in messages),
+            visitor_count_to=messages[-1]["visitor_count"],
+            codec=codec,
+            payload=payload,
+            attachment_urls=sorted(
+                {x["attachment_url"] for x in messages if x["attachment_url"]}
+            ),
+            search_grams=search_grams,
+        )
+        blocks.append((values, [x["id"] for x in messages]))
+        after_seq = messages[-1]["seq"]
+        if len(rows) < block_messages:
+            break
+
+    return PendingBlocks(session_id, session.archived_through_seq, blocks)
+
+
+async def write_blocks(db: AsyncSession, pending: PendingBlocks) -> int:
+    """
+    prepare_blocks() の結果を transcript_blocks に入れ、元の行を消す。
+    呼び出し側でセッション行をロック（FOR UPDATE）し、コミットすること。
+    準備の後に別の処理がブロックを作っていたら何もしない。
+    返り値: 移したメッセージ数
+    """
+    if not pending.blocks:
+        return 0
+    archived_through = await db.scalar(
+        select(models.Session.archived_through_seq).where(
+            models.Session.id == pending.session_id
+        )
+    )
+    if archived_through != pending.after_seq:
+        return 0
+
+    m = models.Message
+    now = datetime.utcnow()
+    for values, message_ids in pending.blocks:
+        await db.execute(
+            insert(models.TranscriptBlock.__table__).values(**values, created_at=now)
+        )
+        # 準備の後に保存された（書き込み待ちだった）行を消さないよう id で消す。
+        # パーティションの刈り込みが効くよう created_at の範囲も付ける
+        await db.execute(
+            delete(m).where(
+                m.session_id == pending.session_id,
+                m.id.in_(message_ids),
+                m.created_at >= values["first_created_at"],
+                m.created_at <= values["last_created_at"],
+            )
+        )
+
+    await db.execute(
+        models.Session.__table__.update()
+        .where(models.Session.id == pending.session_id)
+        .values(archived_through_seq=pending.blocks[-1][0]["seq_to"], archived_at=now)
+    )
+    return pending.message_count
+
+
+async def load_block_messages(
+    db: AsyncSession,
+    session_id,
+    *,
+    before_seq: Optional[int] = None,
+    after_seq: Optional[int] = None,
+    limit: int,
+) -> List[dict]:
+    """
+    ブロックから、before_seq より前（新しい順に limit 件）または after_seq より後（古い順に limit 件）
+    のメッセージを取り出す。必要なブロックだけを展開する。返り値は seq 順。
+    """
+    b = models.TranscriptBlock
+    # まず範囲だけを見て、payload は必要な分だけ 1 つずつ読む
+    stmt = select(b.id).where(b.session_id == session_id)
+    if after_seq is not None:
+        stmt = stmt.where(b.seq_to > after_seq).order_by(b.seq_from.asc())
+    else:
+        if before_seq is not None:
+            stmt = stmt.where(b.seq_from < before_seq)
+        stmt = stmt.order_by(b.seq_from.desc())
+    block_ids = (await db.execute(stmt)).scalars().all()
+
+    found: List[dict] = []
+    for block_id in block_ids:
+        block = (
+            await db.execute(select(b.codec, b.payload).where(b.id == block_id))
+        ).one()
+        decoded = await asyncio.to_thread(decode_messages, block.payload, block.codec)
+        messages = [
+            x
+            for x in decoded
+            if (after_seq is None or x["seq"] > after_seq)
+            and (before_seq is None or x["seq"] < before_seq)
+        ]
+        found.extend(messages)
+        if len(found) >= limit:
+            break
+
+    found.sort(key=lambda x: x["seq"])
+    if after_seq is not None:
+        return found[:limit]
+    return found[-limit:]
+
+
+async def find_block_message_seq(db: AsyncSession, session_id, message_id: int) -> Optional[int]:
+    """
+    ブロック内のメッセージ id から連番を探す（古いクライアントの before_id 用）。
+    id の範囲に入るブロックだけを展開する（範囲を持たない古いブロックは総当たり）。
+    """
+    b = models.TranscriptBlock
+    block_ids = (
+        await db.execute(
+            select(b.id)
+            .where(
+                b.session_id == session_id,
+                or_(
+                    (b.id_from <= message_id) & (b.id_to >= message_id),
+                    b.id_from.is_(None),
+                ),
+            )
+            .order_by(b.id_from.is_(None), b.seq_from.desc())
+        )
+    ).scalars().all()
+    for block_id in block_ids:
+        block = (
+            await db.execute(select(b.codec, b.payload).where(b.id == block_id))
+        ).one()
+        decoded = await asyncio.to_thread(decode_messages, block.payload, block.codec)
+        for x in decoded:
+            if x["id"] == message_id:
+                return x["seq"]
+    return None
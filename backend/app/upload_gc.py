@@ -0,0 +1,313 @@
+# backend/app/upload_gc.py
+import asyncio
+import os
+import time
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import List, Optional, Set
+
+from sqlalchemy import delete, exists, func, select, text
+
+from . import models
+from .attachments import UPLOAD_URL_PREFIX, attachment_url
+from .db import AsyncSessionLocal
+from .storage import LocalStorage, storage
+from .thumbnails import IMAGE_SUFFIXES, THUMBNAIL_SUFFIX, is_image_key, thumbnail_key
+
+# ==== 未参照アップロードの掃除 ====
+# 0 なら定期実行しない（スクリプトからは実行できる）
+UPLOAD_GC_INTERVAL = float(os.getenv("UPLOAD_GC_INTERVAL", str(6 * 3600)))
+# アップロードからメッセージ送信までの猶予。これより新しいファイルは消さない
+UPLOAD_GC_GRACE_HOURS = float(os.getenv("UPLOAD_GC_GRACE_HOURS", "24"))
+UPLOAD_GC_BATCH = int(os.getenv("UPLOAD_GC_BATCH", "200"))
+# バッチ間の休み（ディスク / DB を占有しない）
+UPLOAD_GC_BATCH_SLEEP = float(os.getenv("UPLOAD_GC_BATCH_SLEEP", "0.5"))
+UPLOAD_GC_DRY_RUN = os.getenv("UPLOAD_GC_DRY_RUN", "") in ("1", "true", "yes")
+
+# 複数ワーカー / 複数ノードで同時に走らないようにする
+UPLOAD_GC_LOCK_ID = 727_001
+
+GZIP_SUFFIX = ".gz"
+
+
+@dataclass
+class GcReport:
+    dry_run: bool
+    checked: int = 0
+    orphaned: int = 0
+    deleted_files: int = 0
+    deleted_bytes: int = 0
+    skipped: bool = False
+    examples: List[str] = field(default_factory=list)
+
+    def add_orphan(self, key: str):
+        self.orphaned += 1
+        if len(self.examples) < 20:
+            self.examples.append(key)
+
+
+def _derived_keys(key: str) -> List[str]:
+    """元ファイルから作られるファイル（プレビュー / gzip 版）"""
+    keys = [key + GZIP_SUFFIX]
+    if is_image_key(key):
+        keys.append(thumbnail_key(key))
+    return keys
+
+
+def _delete_with_derived(key: str) -> tuple:
+    """元ファイルと派生ファイルを消す（スレッドで実行）。(件数, バイト数)"""
+    count = 0
+    size = 0
+    for k in [key, *_derived_keys(key)]:
+        try:
+            s = storage.size(k)
+            if s is None:
+                continue
+            storage.delete(k)
+            count += 1
+            size += s
+        except Exception as e:
+            print("[upload_gc] delete failed:", k, e)
+    return count, size
+
+
+def _key_from_url(url: str) -> Optional[str]:
+    prefix = f"{UPLOAD_URL_PREFIX}/"
+    return url[len(prefix):] if url.startswith(prefix) else None
+
+
+class UploadGarbageCollector:
+    """
+    どのメッセージからも参照されていないアップロードを少しずつ消す。
+
+    1. attachments 表を id 順にバッチで見て、猶予期間を過ぎた未参照のものを消す
+       （保存先が S3 でも動く。ディレクトリの全走査はしない）
+    2. ローカル保存のときは、attachments に無い古いファイル（内容アドレス化より前の
+       uuid 名のファイル、アップロード途中の一時ファイル、元を失った派生ファイル）を
+       ディレクトリ単位で少しずつ確認して消す
+    """
+
+    def __init__(
+        self,
+        session_factory=AsyncSessionLocal,
+        grace_hours: float = UPLOAD_GC_GRACE_HOURS,
+        batch: int = UPLOAD_GC_BATCH,
+        batch_sleep: float = UPLOAD_GC_BATCH_SLEEP,
+    ):
+        self._session_factory = session_factory
+        self._grace = timedelta(hours=grace_hours)
+        self._batch = batch
+        self._batch_sleep = batch_sleep
+
+    async def run(self, dry_run: bool = UPLOAD_GC_DRY_RUN) -> GcReport:
+        report = GcReport(dry_run=dry_run)
+        cutoff = datetime.utcnow() - self._grace
+
+        async with self._session_factory() as lock_db:
+            locked = (
+                await lock_db.execute(
+                    text("SELECT pg_try_advisory_lock(:id)"), {"id": UPLOAD_GC_LOCK_ID}
+                )
+            ).scalar()
+            if not locked:
+                report.skipped = True
+                return report
+            try:
+                await self._sweep_attachments(cutoff, report)
+                if isinstance(storage, LocalStorage):
+                    cutoff_ts = time.time() - self._grace.total_seconds()
+                    await self._sweep_directory(storage.root, cutoff_ts, report)
+            finally:
+                await lock_db.execute(
+                    text("SELECT pg_advisory_unlock(:id)"), {"id": UPLOAD_GC_LOCK_ID}
+                )
+                await lock_db.commit()
+
+        return report
+
+    # -----------------------------
+    # 1. attachments 表
+    # -----------------------------
+    def _orphan_condition(self, cutoff):
+        a = models.Attachment
+        m = models.Message
+        b = models.TranscriptBlock
+        return (
+            a.last_uploaded_at < cutoff,
+            ~exists().where(m.attachment_url == a.url),
+            # アーカイブ済みのメッセージからの参照（ix_transcript_blocks_attachment_urls）
+            ~exists().where(b.attachment_urls.contains([a.url])),
+        )
+
+    async def _sweep_attachments(self, cutoff: datetime, report: GcReport):
+        a = models.Attachment
+        last_id = 0
+        while True:
+            async with self._session_factory() as db:
+                rows = (
+                    await db.execute(
+                        select(a.id, a.url)
+                        .where(a.id > last_id, *self._orphan_condition(cutoff))
+                        .order_by(a.id)
+                        .limit(self._batch)
+                    )
+                ).all()
+                if not rows:
+                    return
+                last_id = rows[-1].id
+                report.checked += len(rows)
+
+                if report.dry_run:
+                    for row in rows:
+                        report.add_orphan(_key_from_url(row.url) or row.url)
+                else:
+                    # 確認してから消すまでに参照された / 再アップロードされたものは残す
+                    deleted = (
+                        await db.execute(
+                            delete(a)
+                            .where(
+                                a.id.in_([row.id for row in rows]),
+                                *self._orphan_condition(cutoff),
+                            )
+                            .returning(a.url)
+                        )
+                    ).scalars().all()
+                    await db.commit()
+
+                    for url in deleted:
+                        key = _key_from_url(url)
+                        if not key:
+                            continue
+                        report.add_orphan(key)
+                        count, size = await asyncio.to_thread(_delete_with_derived, key)
+                        report.deleted_files += count
+                        report.deleted_bytes += size
+
+            await asyncio.sleep(self._batch_sleep)
+
+    # -----------------------------
+    # 2. ローカルのディレクトリ（attachments に無いファイル）
+    # -----------------------------
+    async def _sweep_directory(self, root: Path, cutoff_ts: float, report: GcReport):
+        dirs = [root] + sorted(
+            await asyncio.to_thread(
+                lambda: [p for p in root.iterdir() if p.is_dir() and len(p.name) == 2]
+            )
+        )
+        dirs.append(root / ".tmp")
+
+        for directory in dirs:
+            entries = await asyncio.to_thread(self._list_old_files, directory, cutoff_ts)
+            for start in range(0, len(entries), self._batch):
+                await self._sweep_entries(root, entries[start:start + self._batch], report)
+                await asyncio.sleep(self._batch_sleep)
+
+    @staticmethod
+    def _list_old_files(directory: Path, cutoff_ts: float) -> List[Path]:
+        """猶予期間より古い通常ファイルのみ"""
+        if not directory.is_dir():
+            return []
+        result = []
+        with os.scandir(directory) as it:
+            for entry in it:
+                try:
+                    if entry.is_file() and entry.stat().st_mtime < cutoff_ts:
+                        result.append(Path(entry.path))
+                except FileNotFoundError:
+                    continue
+        return result
+
+    async def _sweep_entries(self, root: Path, paths: List[Path], report: GcReport):
+        originals = {}
+        leftovers = []
+        for path in paths:
+            key = path.relative_to(root).as_posix()
+            if any(part.startswith(".") for part in key.split("/")):
+                # アップロード途中で残った一時ファイル
+                leftovers.append(key)
+            elif key.endswith(THUMBNAIL_SUFFIX) or key.endswith(GZIP_SUFFIX):
+                # 元ファイルが消えた派生ファイル
+                if not await asyncio.to_thread(self._original_exists, root, key):
+                    leftovers.append(key)
+            else:
+                originals[attachment_url(key)] = key
+        report.checked += len(paths)
+
+        referenced: Set[str] = set()
+        if originals:
+            urls = list(originals)
+            async with self._session_factory() as db:
+                referenced.update(
+                    (
+                        await db.execute(
+                            select(models.Message.attachment_url)
+                            .where(models.Message.attachment_url.in_(urls))
+                            .distinct()
+                        )
+                    ).scalars()
+                )
+                referenced.update(
+                    (
+                        await db.execute(
+                            select(func.unnest(models.TranscriptBlock.attachment_urls))
+                            .where(models.TranscriptBlock.attachment_urls.overlap(urls))
+                            .distinct()
+                        )
+                    ).scalars()
+                )
+                referenced.update(
+                    (
+                        await db.execute(
+                            select(models.Attachment.url).where(models.Attachment.url.in_(urls))
+                        )
+                    ).scalars()
+                )
+
+        orphans = [key for url, key in originals.items() if url not in referenced]
+        for key in orphans + leftovers:
+            report.add_orphan(key)
+            if report.dry_run:
+                continue
+            if key in leftovers:
+                count, size = await asyncio.to_thread(self._delete_local, root / key)
+            else:
+                count, size = await asyncio.to_thread(_delete_with_derived, key)
+            report.deleted_files += count
+            report.deleted_bytes += size
+
+    @staticmethod
+    def _original_exists(root: Path, key: str) -> bool:
+        if key.endswith(GZIP_SUFFIX):
+            return (root / key[: -len(GZIP_SUFFIX)]).exists()
+        # プレビューの元は画像の拡張子のどれか
+        base = key[: -len(THUMBNAIL_SUFFIX)]
+        return any((root / f"{base}{suffix}").exists() for suffix in IMAGE_SUFFIXES)
+
+    @staticmethod
+    def _delete_local(path: Path) -> tuple:
+        try:
+            size = path.stat().st_size
+            path.unlink()
+            return 1, size
+        except FileNotFoundError:
+            return 0, 0
+
+
+upload_gc = UploadGarbageCollector()
+
+
+async def upload_gc_loop(interval: float = UPLOAD_GC_INTERVAL):
+    """lifespan で起動する定期実行（interval が 0 以下なら何もしない）"""
+    if interval <= 0:
+        return
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            report = await upload_gc.run()
+            if not report.skipped:
+                print("[upload_gc]", asdict(report))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print("[upload_gc] failed:", e)
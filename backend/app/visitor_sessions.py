@@ -0,0 +1,127 @@
+# backend/app/visitor_sessions.py
+import uuid
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import func, literal, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models
+from .cache import SessionMeta
+
+
+def owner_by_id(owner_id: int):
+    return select(models.User.id, models.User.company_id).where(models.User.id == owner_id)
+
+
+def default_admin_owner():
+    """owner 未指定のウィジェット用（最初の ADMIN ユーザー）"""
+    return (
+        select(models.User.id, models.User.company_id)
+        .where(models.User.role == models.UserRole.ADMIN)
+        .order_by(models.User.id)
+        .limit(1)
+    )
+
+
+async def upsert_open_session(
+    db: AsyncSession,
+    owner_query,
+    visitor_identifier: str,
+    visitor_name: Optional[str] = None,
+) -> Optional[SessionMeta]:
+    """
+    訪問者の OPEN セッションを取得、無ければ作成する。
+    owner の解決・作成・last_active_at の更新を 1 文（INSERT ... SELECT ... ON CONFLICT）で行う。
+    同時に呼ばれても ux_sessions_open_visitor があるので OPEN セッションは 1 つに収束する。
+    owner_query に該当するユーザーがいなければ None。コミットは呼び出し側で行う。
+    """
+    sessions = models.Session.__table__
+    owner = owner_query.subquery()
+    now = datetime.utcnow()
+
+    source = select(
+        literal(uuid.uuid4(), sessions.c.id.type),
+        literal(visitor_identifier, sessions.c.visitor_identifier.type),
+        literal(visitor_name, sessions.c.visitor_name.type),
+        literal(models.SessionStatus.OPEN, sessions.c.status.type),
+        literal(now, sessions.c.created_at.type),
+        literal(now, sessions.c.last_active_at.type),
+        owner.c.id,
+        owner.c.company_id,
+    )
+
+    stmt = pg_insert(sessions).from_select(
+        [
+            "id",
+            "visitor_identifier",
+            "visitor_name",
+            "status",
+            "created_at",
+            "last_active_at",
+            "owner_user_id",
+            "company_id",
+        ],
+        source,
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[sessions.c.visitor_identifier, sessions.c.owner_user_id],
+        # 部分インデックスの推論に使うのでバインド変数ではなく定数で書く
+        index_where=text("status = 'OPEN'"),
+        set_={
+            "last_active_at": stmt.excluded.last_active_at,
+            "visitor_name": func.coalesce(sessions.c.visitor_name, stmt.excluded.visitor_name),
+        },
+    ).returning(
+        sessions.c.id,
+        sessions.c.company_id,
+        sessions.c.owner_user_id,
+        sessions.c.status,
+    )
+
+    row = (await db.execute(stmt)).first()
+    if row is None:
+        return None
+
+    return SessionMeta(
+        id=row.id,
+        company_id=row.company_id,
+        owner_user_id=row.owner_user_id,
+        status=row.status,
+    )
+
+
+async def find_open_session(
+    db: AsyncSession,
+    owner_query,
+    visitor_identifier: str,
+) -> Optional[SessionMeta]:
+    """訪問者の OPEN セッションを作成せずに探す（ux_sessions_open_visitor を引くだけ）"""
+    sessions = models.Session.__table__
+    owner = owner_query.subquery()
+
+    row = (
+        await db.execute(
+            select(
+                sessions.c.id,
+                sessions.c.company_id,
+                sessions.c.owner_user_id,
+                sessions.c.status,
+            )
+            .join(owner, owner.c.id == sessions.c.owner_user_id)
+            .where(
+                sessions.c.visitor_identifier == visitor_identifier,
+                sessions.c.status == models.SessionStatus.OPEN,
+            )
+        )
+    ).first()
+    if row is None:
+        return None
+
+    return SessionMeta(
+        id=row.id,
+        company_id=row.company_id,
+        owner_user_id=row.owner_user_id,
+        status=row.status,
+    )
@@ -0,0 +1,59 @@
+# backend/tests/bus_node.py
+# プロセス間配送テスト用のノード（1 プロセス = 1 ワーカー）。アプリの app.socket.sio をそのまま動かす。
+#   python tests/bus_node.py --port 8001 --queue-url relay://127.0.0.1:7000 --session-id <uuid>
+#     → socket.io だけを /socket.io で公開する。セッションのメタ情報はキャッシュに入れておくので DB 不要。
+#       test_emit_message イベントで、そのセッションへの new_message を app.socket._emit_message で送る
+#   python tests/bus_node.py --port 8001 --queue-url ... --app
+#     → app.main.app（DATABASE_URL の DB を使う）を /ws/socket.io で公開する
+import argparse
+import os
+import uuid
+
+import uvicorn
+
+
+def create_app(args):
+    # MESSAGE_QUEUE_URL は app.bus の import 時に、マネージャーは app.socket の import 時に決まる
+    os.environ["MESSAGE_QUEUE_URL"] = args.queue_url
+    os.environ["MESSAGE_QUEUE_CHANNEL"] = args.channel
+
+    from app import bus
+    from relay_broker import RelayPubSubManager
+
+    bus.register_client_manager("relay://", RelayPubSubManager)
+
+    if args.app:
+        from app.main import app
+
+        return app
+
+    import socketio
+
+    from app import models
+    from app import socket as app_socket
+    from app.cache import SessionMeta, session_cache
+
+    meta = SessionMeta(
+        id=uuid.UUID(args.session_id),
+        company_id=1,
+        owner_user_id=1,
+        status=models.SessionStatus.OPEN,
+    )
+    session_cache.set(str(meta.id), meta, ttl=3600)
+
+    @app_socket.sio.on("test_emit_message")
+    async def test_emit_message(sid, data):
+        await app_socket._emit_message(meta, data)
+
+    return socketio.ASGIApp(app_socket.sio)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--queue-url", required=True)
+    parser.add_argument("--channel", default="chat-socketio-test")
+    parser.add_argument("--session-id", default=str(uuid.uuid4()))
+    parser.add_argument("--app", action="store_true")
+    args = parser.parse_args()
+    uvicorn.run(create_app(args), host="127.0.0.1", port=args.port, log_level="warning")
@@ -0,0 +1,65 @@
+# backend/tests/relay_broker.py
+# Redis を立てられない環境でプロセス間配送をテストするためのブローカー代替品。
+#   python tests/relay_broker.py --port 7000
+# 接続から届いた 1 行（JSON）を、接続中のすべてのクライアントにそのまま流す。
+import argparse
+import asyncio
+import json
+from urllib.parse import urlparse
+
+from socketio.async_pubsub_manager import AsyncPubSubManager
+
+
+class RelayPubSubManager(AsyncPubSubManager):
+    """relay://host:port の中継ブローカーを使う Pub/Sub マネージャー（テスト用）"""
+
+    name = "relay"
+
+    def __init__(self, url, channel="socketio", write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        parsed = urlparse(url)
+        self._address = (parsed.hostname, parsed.port)
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    async def _publish(self, data):
+        async with self._lock:
+            if self._writer is None:
+                _, self._writer = await asyncio.open_connection(*self._address)
+            self._writer.write(json.dumps(data).encode() + b"\n")
+            await self._writer.drain()
+
+    async def _listen(self):
+        reader, _ = await asyncio.open_connection(*self._address)
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise ConnectionError("relay broker closed the connection")
+            yield line.decode()
+
+
+async def serve(port: int):
+    clients = set()
+
+    async def handle(reader, writer):
+        clients.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                for client in list(clients):
+                    client.write(line)
+        finally:
+            clients.discard(writer)
+            writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", port)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, required=True)
+    asyncio.run(serve(parser.parse_args().port))
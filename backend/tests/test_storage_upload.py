@@ -0,0 +1,284 @@
+# backend/tests/test_storage_upload.py
+# 添付ファイルの保存（app.storage / app.attachments / app.api.routes_upload）のテスト。
+#   cd backend && python -m pytest -q tests
+# 保存先は一時ディレクトリの LocalStorage。アップロード API は ASGI を直接呼ぶ。
+# TEST_DATABASE_URL を設定すると、presign → complete で attachments に登録されるところまで確かめる。
+import asyncio
+import hashlib
+import json
+import os
+import subprocess
+import sys
+from functools import partial
+from pathlib import Path
+
+import pytest
+from fastapi import FastAPI
+
+from app import attachments
+from app.api import routes_upload
+from app.attachments import UploadSink, UploadTooLarge, content_key, parse_content_key
+from app.db import get_db
+from app.storage import LocalStorage
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL", "")
+BOUNDARY = "testboundary1234"
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    local = LocalStorage(tmp_path / "uploads")
+    monkeypatch.setattr(attachments, "storage", local)
+    monkeypatch.setattr(routes_upload, "storage", local)
+    return local
+
+
+def _leftovers(storage: LocalStorage):
+    return sorted(p.name for p in storage.temp_dir().iterdir())
+
+
+# ---- LocalStorage ----
+def test_local_storage_put_size_exists_delete(tmp_path):
+    storage = LocalStorage(tmp_path)
+    key = "ab/abc.txt"
+    assert not storage.exists(key)
+    assert storage.size(key) is None
+
+    with open(tmp_path / "src", "w+b") as src:
+        src.write(b"hello")
+        src.seek(0)
+        storage.put_file(src, key, "text/plain")
+    assert storage.exists(key)
+    assert storage.size(key) == 5
+    assert (tmp_path / key).read_bytes() == b"hello"
+    # 一時ファイルを残さない
+    assert [p.name for p in (tmp_path / "ab").iterdir()] == ["abc.txt"]
+
+    storage.delete(key)
+    assert not storage.exists(key)
+    with pytest.raises(ValueError):
+        storage.exists("../outside")
+
+
+# ---- UploadSink ----
+def _sink_upload(data: bytes, filename: str = "a.PNG", max_bytes: int = 1024):
+    sink = UploadSink(max_bytes=max_bytes)
+    try:
+        for i in range(0, len(data), 7):
+            sink.write(data[i:i + 7])
+        return sink.commit(filename, "image/png")
+    finally:
+        sink.discard()
+
+
+def test_upload_sink_dedupes_same_sha256(storage):
+    data = b"same content" * 10
+    digest = hashlib.sha256(data).hexdigest()
+
+    key, sha256, size, written = _sink_upload(data)
+    assert (key, sha256, size, written) == (content_key(digest, ".png"), digest, len(data), True)
+    assert parse_content_key(key) == digest
+    assert storage.size(key) == len(data)
+
+    again = _sink_upload(data)
+    assert again == (key, digest, len(data), False)
+    assert _leftovers(storage) == []
+
+
+def test_upload_sink_rejects_over_limit(storage):
+    with pytest.raises(UploadTooLarge):
+        _sink_upload(b"x" * 100, max_bytes=50)
+    assert _leftovers(storage) == []
+
+
+# ---- アップロード API ----
+def _app(db=None) -> FastAPI:
+    app = FastAPI()
+    app.include_router(routes_upload.router)
+
+    async def override_db():
+        yield db
+
+    app.dependency_overrides[get_db] = override_db
+    return app
+
+
+async def _request(app, method: str, path: str, chunks, headers=()):
+    """ASGI を直接呼ぶ。chunks は本文のチャンク（Content-Length を付けなければ chunked 扱い）"""
+    chunks = list(chunks)
+    events = [
+        {"type": "http.request", "body": chunk, "more_body": i < len(chunks) - 1}
+        for i, chunk in enumerate(chunks or [b""])
+    ]
+    sent = []
+
+    async def receive():
+        if events:
+            return events.pop(0)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(k.lower().encode(), v.encode()) for k, v in headers],
+        "client": ("127.0.0.1", 1),
+        "server": ("127.0.0.1", 80),
+    }
+    await app(scope, receive, send)
+    status = next(m["status"] for m in sent if m["type"] == "http.response.start")
+    body = b"".join(m.get("body", b"") for m in sent if m["type"] == "http.response.body")
+    return status, json.loads(body) if body else None
+
+
+def _post_json(app, path: str, payload: dict):
+    body = json.dumps(payload).encode()
+    return _request(
+        app,
+        "POST",
+        path,
+        [body],
+        [("content-type", "application/json"), ("content-length", str(len(body)))],
+    )
+
+
+def _multipart(data: bytes, filename: str = "a.png") -> bytes:
+    return (
+        f"--{BOUNDARY}\r\n"
+        'Content-Disposition: form-data; name="note"\r\n\r\nignored\r\n'
+        f"--{BOUNDARY}\r\n"
+        f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        "Content-Type: image/png\r\n\r\n"
+    ).encode() + data + f"\r\n--{BOUNDARY}--\r\n".encode()
+
+
+def test_file_part_reader_extracts_file_only():
+    data = bytes(range(256)) * 4
+    body = _multipart(data)
+    reader = routes_upload._FilePartReader(BOUNDARY.encode())
+    received = b""
+    for i in range(0, len(body), 13):
+        received += b"".join(reader.feed(body[i:i + 13]))
+    reader.finish()
+    assert received == data
+    assert (reader.found, reader.filename, reader.content_type) == (True, "a.png", "image/png")
+
+
+def test_upload_rejects_chunked_body_over_limit(storage, monkeypatch):
+    monkeypatch.setattr(routes_upload, "UPLOAD_MAX_BYTES", 1000)
+    monkeypatch.setattr(routes_upload, "UploadSink", partial(UploadSink, max_bytes=1000))
+    headers = [("content-type", f"multipart/form-data; boundary={BOUNDARY}")]
+
+    # 本文の上限（ファイル + フォームの余裕）を超えた時点で止める
+    body = _multipart(b"x" * (routes_upload.UPLOAD_FORM_OVERHEAD + 2000))
+    chunks = [body[i:i + 4096] for i in range(0, len(body), 4096)]
+    status, _ = asyncio.run(_request(_app(), "POST", "/api/upload", chunks, headers))
+    assert status == 413
+
+    # 本文は余裕の範囲でも、file の中身が上限を超えれば 413
+    status, _ = asyncio.run(_request(_app(), "POST", "/api/upload", [_multipart(b"x" * 1001)], headers))
+    assert status == 413
+    assert _leftovers(storage) == []
+
+
+def test_presign_and_complete_without_database(storage, monkeypatch):
+    monkeypatch.setattr(routes_upload, "UPLOAD_MAX_BYTES", 1000)
+    app = _app()
+    data = b"direct upload"
+    digest = hashlib.sha256(data).hexdigest()
+
+    # ローカルは署名付き URL が無い → POST /api/upload を使う
+    status, body = asyncio.run(
+        _post_json(app, "/api/uploads/presign", {"sha256": digest, "size": len(data), "filename": "a.png"})
+    )
+    assert status == 200
+    assert body == {
+        "key": content_key(digest, ".png"),
+        "url": f"/uploads/{content_key(digest, '.png')}",
+        "exists": False,
+        "upload": None,
+    }
+
+    status, _ = asyncio.run(_post_json(app, "/api/uploads/complete", {"key": body["key"]}))
+    assert status == 404
+    status, _ = asyncio.run(_post_json(app, "/api/uploads/complete", {"key": "../etc/passwd"}))
+    assert status == 400
+
+    # 上限を超えるファイルは消して 413
+    big = content_key(hashlib.sha256(b"big").hexdigest(), ".png")
+    (storage.root / big).parent.mkdir(parents=True, exist_ok=True)
+    (storage.root / big).write_bytes(b"x" * 1001)
+    status, _ = asyncio.run(_post_json(app, "/api/uploads/complete", {"key": big}))
+    assert status == 413
+    assert not storage.exists(big)
+
+
+@pytest.fixture
+def database():
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    subprocess.run(
+        [sys.executable, "-m", "app.scripts.init_db"],
+        cwd=BACKEND_DIR,
+        env={**os.environ, "DATABASE_URL": TEST_DATABASE_URL, "PYTHONPATH": str(BACKEND_DIR)},
+        check=True,
+    )
+    return TEST_DATABASE_URL
+
+
+def test_presign_complete_registers_attachment(storage, database):
+    from sqlalchemy import text
+    from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+    data = os.urandom(64)
+    digest = hashlib.sha256(data).hexdigest()
+    key = content_key(digest, ".png")
+
+    async def scenario():
+        engine = create_async_engine(database)
+        try:
+            async with AsyncSession(engine, expire_on_commit=False) as db:
+                app = _app(db)
+                status, body = await _post_json(
+                    app, "/api/uploads/presign", {"sha256": digest, "size": len(data), "filename": "a.png"}
+                )
+                assert (status, body["exists"], body["upload"]) == (200, False, None)
+
+                # ブラウザの代わりに保存先へ置く
+                with open(storage.temp_dir() / "src", "w+b") as src:
+                    src.write(data)
+                    src.seek(0)
+                    storage.put_file(src, key, "image/png")
+
+                status, body = await _post_json(
+                    app, "/api/uploads/complete", {"key": key, "content_type": "image/png"}
+                )
+                assert (status, body) == (200, {"url": f"/uploads/{key}"})
+
+                row = (
+                    await db.execute(
+                        text("SELECT sha256, size_bytes FROM attachments WHERE url = :u"),
+                        {"u": f"/uploads/{key}"},
+                    )
+                ).one()
+                assert (row.sha256, row.size_bytes) == (digest, len(data))
+
+                # 同じ内容はアップロード不要
+                status, body = await _post_json(
+                    app, "/api/uploads/presign", {"sha256": digest, "size": len(data), "filename": "b.png"}
+                )
+                assert (status, body["exists"], body["url"]) == (200, True, f"/uploads/{key}")
+        finally:
+            await engine.dispose()
+
+    asyncio.run(scenario())
@@ -0,0 +1,65 @@
+// frontend/src/upload.js
+// 添付ファイルのアップロード
+// 1. sha256 を計算して /api/uploads/presign に問い合わせる
+// 2. 同じ内容が既にあればその URL を使う（アップロードしない）
+// 3. 署名付き URL が返ればストレージへ直接 PUT → /api/uploads/complete
+// 4. 使えない保存先なら従来どおり /api/upload に送る
+
+const sha256Hex = async (file) => {
+  const buf = await file.arrayBuffer();
+  const digest = await crypto.subtle.digest("SHA-256", buf);
+  return [...new Uint8Array(digest)]
+    .map((b) => b.toString(16).padStart(2, "0"))
+    .join("");
+};
+
+const postJson = async (url, body) => {
+  const res = await fetch(url, {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify(body),
+  });
+  const data = await res.json().catch(() => ({}));
+  if (!res.ok) throw new Error(data.detail || `HTTP ${res.status}`);
+  return data;
+};
+
+const uploadViaServer = async (apiBase, file) => {
+  const form = new FormData();
+  form.append("file", file);
+
+  const res = await fetch(`${apiBase}/api/upload`, { method: "POST", body: form });
+  const data = await res.json().catch(() => ({}));
+  if (!res.ok || !data.url) throw new Error(data.detail || `HTTP ${res.status}`);
+  return data.url;
+};
+
+// 戻り値: 保存された添付の URL（/uploads/...）
+export const uploadFile = async (apiBase, file) => {
+  // crypto.subtle は https / localhost のみ
+  if (!window.crypto?.subtle) return uploadViaServer(apiBase, file);
+
+  const contentType = file.type || "application/octet-stream";
+  const presign = await postJson(`${apiBase}/api/uploads/presign`, {
+    sha256: await sha256Hex(file),
+    size: file.size,
+    filename: file.name,
+    content_type: contentType,
+  });
+
+  if (presign.exists) return presign.url;
+  if (!presign.upload) return uploadViaServer(apiBase, file);
+
+  const put = await fetch(presign.upload.url, {
+    method: presign.upload.method || "PUT",
+    headers: presign.upload.headers || {},
+    body: file,
+  });
+  if (!put.ok) throw new Error(`storage upload failed: HTTP ${put.status}`);
+
+  const done = await postJson(`${apiBase}/api/uploads/complete`, {
+    key: presign.key,
+    content_type: contentType,
+  });
+  return done.url;
+};